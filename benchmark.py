@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+# Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
+# See the file LICENSE.txt for copying permission.
+
+# Add paths to dependencies
+import sys
+sys.path.append('vendor/fusepy')
+sys.path.append('vendor/paramiko')
+
+from benchmark.runner import Benchmark
+
+# Run the benchmark
+if __name__ == '__main__':
+    Benchmark.run()
@@ -0,0 +1,288 @@
+# Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
+# See the file LICENSE.txt for copying permission.
+
+from argparse import ArgumentParser
+from benchmark.server import BenchmarkSFTPServer
+import json
+from mountload.asyncsource import AsyncMountLoadSource
+from mountload.controller import ControllerPool
+from mountload.source import MountLoadSource
+from mountload.stats import statistics
+import os
+import random
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+from threading import Thread
+import time
+
+class Fixture:
+    """Remote directory tree the scenarios run against; it is created once and reused while its parameters match"""
+    entriesPerDirectory = 100
+
+    def __init__(self, directory, fileSize, numberOfEntries):
+        self.directory = directory
+        self.fileSize = fileSize
+        self.numberOfEntries = numberOfEntries
+
+    def create(self):
+        parameters = {'fileSize': self.fileSize, 'numberOfEntries': self.numberOfEntries}
+        markerPath = self.directory + '/.fixture'
+        if os.path.exists(markerPath):
+            with open(markerPath) as f:
+                if json.load(f) == parameters:
+                    return
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory + '/tree')
+
+        # A large file with incompressible contents, since SSH compresses the stream
+        with open(self.directory + '/large.bin', 'wb') as f:
+            for offset in range(0, self.fileSize, 1024 * 1024):
+                f.write(os.urandom(min(1024 * 1024, self.fileSize - offset)))
+
+        # A wide tree of small files for recursive listings
+        for index in range(self.numberOfEntries):
+            directory = '%s/tree/d%05d' % (self.directory, index // Fixture.entriesPerDirectory)
+            if index % Fixture.entriesPerDirectory == 0:
+                os.mkdir(directory)
+            with open('%s/f%03d' % (directory, index % Fixture.entriesPerDirectory), 'wb') as f:
+                f.write(b'x' * (index % 64))
+
+        with open(markerPath, 'w') as f:
+            json.dump(parameters, f)
+
+class ControllerClient:
+    """Drives a ControllerPool directly, the way FUSEConnector does"""
+
+    def __init__(self, sourceURI, targetDirectory, options):
+        sourceClass = AsyncMountLoadSource if options.engine == 'asyncio' else MountLoadSource
+        self.pool = ControllerPool(sourceURI, targetDirectory, 'benchmark', readAheadSize=options.read_ahead * 1024 * 1024,
+                                   chunkSize=options.chunk_size * 1024 * 1024, sourceClass=sourceClass)
+
+    def close(self):
+        self.pool.close()
+
+    def listRecursive(self, path):
+        """Lists every directory and stats every entry like ls -lR; returns the number of entries"""
+        numberOfEntries = 0
+        directories = [path]
+        while len(directories) > 0:
+            directory = directories.pop()
+            with self.pool.acquire() as controller:
+                entries = controller.getStatsInDirectory(directory)
+            numberOfEntries += len(entries)
+            prefix = directory.rstrip('/') + '/'
+            directories.extend(prefix + basename for basename, attributes in entries if stat.S_ISDIR(attributes['st_mode']))
+        return numberOfEntries
+
+    def read(self, path, offset, size):
+        with self.pool.acquire() as controller:
+            return controller.readData(path, offset, size)
+
+class MountClient:
+    """Drives a real FUSE mount of mountload, served by a separate process"""
+    mountTimeout = 30
+    mountScript = '\n'.join([
+        'import sys',
+        'sys.path.append("vendor/fusepy")',
+        'from mountload.asyncsource import AsyncMountLoadSource',
+        'from mountload.controller import ControllerPool',
+        'from mountload.fuseconnector import FUSEConnector',
+        'from mountload.source import MountLoadSource',
+        'sourceClass = AsyncMountLoadSource if sys.argv[6] == "asyncio" else MountLoadSource',
+        'pool = ControllerPool(sys.argv[1], sys.argv[2], "benchmark", readAheadSize=int(sys.argv[4]), chunkSize=int(sys.argv[5]),',
+        '                      sourceClass=sourceClass)',
+        'FUSEConnector(pool, False).startFUSE(sys.argv[3], isMultiThreaded=True)'])
+
+    def __init__(self, sourceURI, targetDirectory, options):
+        self.mountpoint = tempfile.mkdtemp(prefix='mountpoint-', dir=options.work_directory)
+        self.files = {}
+        repositoryDirectory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.process = subprocess.Popen([sys.executable, '-c', MountClient.mountScript, sourceURI, targetDirectory,
+                                         self.mountpoint, str(options.read_ahead * 1024 * 1024),
+                                         str(options.chunk_size * 1024 * 1024), options.engine], cwd=repositoryDirectory)
+
+        deadline = time.monotonic() + MountClient.mountTimeout
+        while not os.path.ismount(self.mountpoint):
+            if (self.process.poll() is not None) or (time.monotonic() > deadline):
+                self.process.kill()
+                raise RuntimeError('Failed to mount %s' % self.mountpoint)
+            time.sleep(0.1)
+
+    def close(self):
+        for fd in self.files.values():
+            os.close(fd)
+        subprocess.call(['fusermount', '-u', self.mountpoint])
+        self.process.wait()
+        os.rmdir(self.mountpoint)
+
+    def listRecursive(self, path):
+        numberOfEntries = 0
+        for dirpath, dirnames, filenames in os.walk(self.mountpoint + path):
+            for name in dirnames + filenames:
+                os.lstat(os.path.join(dirpath, name))
+            numberOfEntries += len(dirnames) + len(filenames)
+        return numberOfEntries
+
+    def read(self, path, offset, size):
+        # Keep files open like applications do, so we measure reads rather than opens
+        fd = self.files.get(path)
+        if fd is None:
+            fd = os.open(self.mountpoint + path, os.O_RDONLY)
+            self.files[path] = fd
+        return os.pread(fd, size, offset)
+
+class Benchmark:
+    """Runs the benchmark scenarios against a local SFTP server behind an emulated network link"""
+    blockSize = 128 * 1024
+    randomReadSize = 4096
+    scenarioNames = ['sequential-read', 'random-read', 'list-recursive', 'concurrent-readers', 'cold-warm']
+    scenarioMethods = {'sequential-read': 'runSequentialRead', 'random-read': 'runRandomRead',
+                       'list-recursive': 'runListRecursive', 'concurrent-readers': 'runConcurrentReaders'}
+
+    def __init__(self, options, sourceURI, fixture):
+        self.options = options
+        self.sourceURI = sourceURI
+        self.fixture = fixture
+
+    def _createClient(self, targetDirectory):
+        clientClass = MountClient if self.options.mount else ControllerClient
+        return clientClass(self.sourceURI, targetDirectory, self.options)
+
+    @staticmethod
+    def _latencies(durations):
+        durations = sorted(durations)
+        return {'p50': durations[len(durations) // 2], 'p99': durations[int(len(durations) * 0.99)],
+                'max': durations[-1], 'mean': sum(durations) / len(durations)}
+
+    def _readSequentially(self, client):
+        for offset in range(0, self.fixture.fileSize, Benchmark.blockSize):
+            if len(client.read('/large.bin', offset, Benchmark.blockSize)) == 0:
+                raise RuntimeError('Unexpected end of file at offset %d' % offset)
+
+    def _timeSequentialRead(self, client):
+        startTime = time.monotonic()
+        self._readSequentially(client)
+        seconds = time.monotonic() - startTime
+        return {'seconds': seconds, 'bytes': self.fixture.fileSize,
+                'mibPerSecond': self.fixture.fileSize / seconds / 1024 / 1024}
+
+    def runSequentialRead(self, client):
+        return self._timeSequentialRead(client)
+
+    def runRandomRead(self, client):
+        generator = random.Random(0)
+        durations = []
+        startTime = time.monotonic()
+        for _ in range(self.options.random_reads):
+            offset = generator.randrange(self.fixture.fileSize // Benchmark.randomReadSize) * Benchmark.randomReadSize
+            readStart = time.monotonic()
+            client.read('/large.bin', offset, Benchmark.randomReadSize)
+            durations.append(time.monotonic() - readStart)
+        seconds = time.monotonic() - startTime
+        return {'seconds': seconds, 'operations': len(durations), 'operationsPerSecond': len(durations) / seconds,
+                'latency': Benchmark._latencies(durations)}
+
+    def runListRecursive(self, client):
+        startTime = time.monotonic()
+        numberOfEntries = client.listRecursive('/tree')
+        seconds = time.monotonic() - startTime
+        return {'seconds': seconds, 'entries': numberOfEntries, 'entriesPerSecond': numberOfEntries / seconds}
+
+    def runConcurrentReaders(self, client):
+        errors = []
+
+        def readFile():
+            try:
+                self._readSequentially(client)
+            except Exception as e:
+                errors.append(str(e))
+
+        threads = [Thread(target=readFile) for _ in range(self.options.readers)]
+        startTime = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.monotonic() - startTime
+        if len(errors) > 0:
+            raise RuntimeError(errors[0])
+        deliveredBytes = self.fixture.fileSize * self.options.readers
+        return {'seconds': seconds, 'readers': self.options.readers, 'bytes': deliveredBytes,
+                'mibPerSecond': deliveredBytes / seconds / 1024 / 1024}
+
+    def runColdWarm(self, targetDirectory):
+        # The warm run reopens the target after the cold run downloaded everything
+        results = {}
+        for name in ('cold', 'warm'):
+            client = self._createClient(targetDirectory)
+            try:
+                results[name] = self._timeSequentialRead(client)
+            finally:
+                client.close()
+        return results
+
+    def runScenario(self, name):
+        statistics.reset()
+        targetDirectory = tempfile.mkdtemp(prefix='target-', dir=self.options.work_directory)
+        try:
+            if name == 'cold-warm':
+                result = self.runColdWarm(targetDirectory)
+            else:
+                client = self._createClient(targetDirectory)
+                try:
+                    result = getattr(self, self.scenarioMethods[name])(client)
+                finally:
+                    client.close()
+        finally:
+            shutil.rmtree(targetDirectory, ignore_errors=True)
+
+        result['scenario'] = name
+        if not self.options.mount:
+            result['statistics'] = statistics.snapshot()['counters']
+        return result
+
+    @staticmethod
+    def run():
+        """Handles command line parameters, sets up the server and fixture and runs the scenarios"""
+        parser = ArgumentParser(description='Benchmarks mountload against a local SFTP server with an emulated network link.')
+        parser.add_argument('--bandwidth', type=float, default=100.0, metavar='MBIT', help="Link bandwidth in Mbit/s per direction; 0 for unlimited (default: 100)")
+        parser.add_argument('--chunk-size', type=int, default=1, metavar='MIB', help="Download chunk size in MiB (default: 1)")
+        parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads', help="SFTP engine (default: threads)")
+        parser.add_argument('--entries', type=int, default=100000, metavar='N', help="Number of entries in the listed tree (default: 100000)")
+        parser.add_argument('--file-size', type=int, default=64, metavar='MIB', help="Size of the read file in MiB (default: 64)")
+        parser.add_argument('--mount', action='store_true', help="Run the scenarios through a real FUSE mount instead of a controller pool")
+        parser.add_argument('--output', metavar='FILE', help="Write the JSON results to this file instead of stdout")
+        parser.add_argument('--random-reads', type=int, default=500, metavar='N', help="Number of random 4 KiB reads (default: 500)")
+        parser.add_argument('--read-ahead', type=int, default=32, metavar='MIB', help="Maximum read-ahead window in MiB (default: 32)")
+        parser.add_argument('--readers', type=int, default=8, metavar='N', help="Number of concurrent readers (default: 8)")
+        parser.add_argument('--rtt', type=float, default=20.0, metavar='MS', help="Round trip time of the link in milliseconds (default: 20)")
+        parser.add_argument('--work-directory', default=tempfile.gettempdir() + '/mountload-benchmark', metavar='DIR', help="Directory for the fixture and targets")
+        parser.add_argument('scenarios', nargs='*', metavar='SCENARIO', help="Scenarios to run: %s (default: all)" % ', '.join(Benchmark.scenarioNames))
+        options = parser.parse_args()
+        for name in options.scenarios:
+            if name not in Benchmark.scenarioNames:
+                parser.error('unknown scenario %s' % name)
+
+        os.makedirs(options.work_directory, exist_ok=True)
+        fixture = Fixture(options.work_directory + '/remote', options.file_size * 1024 * 1024, options.entries)
+        fixture.create()
+
+        bandwidth = options.bandwidth * 1000 * 1000 / 8 if options.bandwidth > 0 else None
+        server = BenchmarkSFTPServer(fixture.directory, options.rtt / 2000, bandwidth)
+        port = server.start()
+        try:
+            benchmark = Benchmark(options, 'sftp://benchmark@127.0.0.1:%d/' % port, fixture)
+            results = [benchmark.runScenario(name) for name in (options.scenarios or Benchmark.scenarioNames)]
+        finally:
+            server.stop()
+
+        parameters = dict((name, value) for name, value in vars(options).items() if name not in ('output', 'scenarios'))
+        document = json.dumps({'parameters': parameters, 'results': results}, indent=2, sort_keys=True) + '\n'
+        if options.output is None:
+            sys.stdout.write(document)
+        else:
+            with open(options.output, 'w') as f:
+                f.write(document)
@@ -0,0 +1,197 @@
+# Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
+# See the file LICENSE.txt for copying permission.
+
+import os
+from paramiko import (AUTH_SUCCESSFUL, OPEN_SUCCEEDED, RSAKey, ServerInterface, SFTPAttributes, SFTPHandle,
+                      SFTPServer, SFTPServerInterface, Transport)
+from queue import Queue
+import socket
+from threading import Thread
+import time
+
+class LinkEmulator:
+    """
+    TCP proxy that emulates a network link in front of a local port. All data
+    is delayed by a fixed one-way latency and every direction is limited to
+    the given bandwidth in bytes per second.
+    """
+    bufferSize = 64 * 1024
+
+    def __init__(self, targetPort, latency, bandwidth=None):
+        self.targetPort = targetPort
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.listener = None
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                break
+            server = socket.create_connection(('127.0.0.1', self.targetPort))
+            for source, destination in ((client, server), (server, client)):
+                queue = Queue()
+                Thread(target=self._receive, args=(source, queue), daemon=True).start()
+                Thread(target=self._send, args=(queue, destination), daemon=True).start()
+
+    def _receive(self, source, queue):
+        while True:
+            try:
+                data = source.recv(LinkEmulator.bufferSize)
+            except OSError:
+                data = b''
+            queue.put((time.monotonic() + self.latency, data))
+            if len(data) == 0:
+                break
+
+    def _send(self, queue, destination):
+        # The link can only transmit one packet at a time, so packets queue up behind each other
+        linkFreeAt = 0
+        while True:
+            deliverAt, data = queue.get()
+            if self.bandwidth is not None:
+                linkFreeAt = max(linkFreeAt, deliverAt) + len(data) / self.bandwidth
+                deliverAt = linkFreeAt
+            delay = deliverAt - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                if len(data) == 0:
+                    destination.shutdown(socket.SHUT_WR)
+                    break
+                destination.sendall(data)
+            except OSError:
+                break
+
+    def start(self):
+        """Starts accepting connections and returns the port of the emulated link"""
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(100)
+        Thread(target=self._accept, name='benchmark-link', daemon=True).start()
+        return self.listener.getsockname()[1]
+
+    def stop(self):
+        self.listener.close()
+
+class BenchmarkServerInterface(ServerInterface):
+    """Accepts any user with any password"""
+
+    def __init__(self, rootDirectory):
+        self.rootDirectory = rootDirectory
+
+    def check_auth_none(self, username):
+        return AUTH_SUCCESSFUL
+
+    def check_auth_password(self, username, password):
+        return AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, channelId):
+        return OPEN_SUCCEEDED
+
+    def get_allowed_auths(self, username):
+        return 'password,none'
+
+class BenchmarkSFTPHandle(SFTPHandle):
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+class BenchmarkSFTPInterface(SFTPServerInterface):
+    """Read-only SFTP access to the root directory of the server"""
+
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.rootDirectory = server.rootDirectory
+
+    def canonicalize(self, path):
+        return os.path.normpath('/' + path)
+
+    def _localPath(self, path):
+        return self.rootDirectory + self.canonicalize(path)
+
+    def list_folder(self, path):
+        try:
+            entries = []
+            for filename in os.listdir(self._localPath(path)):
+                entry = SFTPAttributes.from_stat(os.lstat(os.path.join(self._localPath(path), filename)))
+                entry.filename = filename
+                entries.append(entry)
+            return entries
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(self._localPath(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        try:
+            f = open(self._localPath(path), 'rb')
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        handle = BenchmarkSFTPHandle(flags)
+        handle.readfile = f
+        handle.filename = self._localPath(path)
+        return handle
+
+    def readlink(self, path):
+        try:
+            return os.readlink(self._localPath(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._localPath(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+class BenchmarkSFTPServer:
+    """
+    Local paramiko SFTP server that serves a directory read-only, optionally
+    behind a LinkEmulator to inject latency and limit bandwidth.
+    """
+
+    def __init__(self, rootDirectory, latency=0.0, bandwidth=None):
+        self.rootDirectory = os.path.abspath(rootDirectory)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.hostKey = RSAKey.generate(2048)
+        self.listener = None
+        self.link = None
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                break
+            Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, client):
+        transport = Transport(client)
+        transport.add_server_key(self.hostKey)
+        transport.set_subsystem_handler('sftp', SFTPServer, BenchmarkSFTPInterface)
+        transport.start_server(server=BenchmarkServerInterface(self.rootDirectory))
+
+    def start(self):
+        """Starts serving and returns the port clients should connect to"""
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(100)
+        Thread(target=self._accept, name='benchmark-sftp', daemon=True).start()
+
+        port = self.listener.getsockname()[1]
+        if (self.latency > 0) or (self.bandwidth is not None):
+            self.link = LinkEmulator(port, self.latency, self.bandwidth)
+            port = self.link.start()
+        return port
+
+    def stop(self):
+        if self.link is not None:
+            self.link.stop()
+        self.listener.close()
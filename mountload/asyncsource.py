@@ -0,0 +1,447 @@
+# Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
+# See the file LICENSE.txt for copying permission.
+
+import asyncio
+from collections import Counter, deque
+from errno import EACCES, ENOENT
+import logging
+from mountload.source import MountLoadSource, SFTPConnection
+from mountload.stats import statistics
+from paramiko.message import Message
+from paramiko.sftp import (CMD_ATTRS, CMD_CLOSE, CMD_DATA, CMD_HANDLE, CMD_NAME, CMD_OPEN, CMD_OPENDIR, CMD_READ,
+                           CMD_READDIR, CMD_READLINK, CMD_STAT, CMD_STATUS, SFTP_EOF, SFTP_FLAG_READ,
+                           SFTP_NO_SUCH_FILE, SFTP_OK, SFTP_PERMISSION_DENIED)
+from paramiko.sftp_attr import SFTPAttributes
+import struct
+from threading import Lock, Thread
+
+class AsyncSFTPFile:
+    """A remote file handle shared by the operations on a channel"""
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.numberOfUsers = 0
+
+class AsyncSFTPChannel:
+    """
+    SFTP protocol client on a single SSH channel, driven by an asyncio event
+    loop. Any number of requests can be outstanding at once; responses are
+    matched to their requests by ID. All methods must be called from the
+    event loop thread.
+    """
+
+    def __init__(self, loop, connection, sftp):
+        self.loop = loop
+        self.connection = connection
+        self.sftp = sftp
+        self.channel = sftp.sock
+
+        # Futures of the outstanding requests by request ID
+        self.requests = {}
+        self.nextRequestId = 1
+        self.buffer = bytearray()
+        self.isClosed = False
+
+        # Open remote files by path
+        self.files = {}
+
+        # Paramiko signals incoming data through a pipe, which the event loop can poll
+        self.loop.add_reader(self.channel.fileno(), self._onReadable)
+
+    def close(self):
+        if self.isClosed:
+            return
+        self.isClosed = True
+        self.loop.remove_reader(self.channel.fileno())
+        try:
+            self.sftp.close()
+        except Exception:
+            pass
+        self._failRequests(ConnectionError('SFTP channel closed'))
+
+    def _failRequests(self, exception):
+        requests = self.requests
+        self.requests = {}
+        for future in requests.values():
+            if not future.done():
+                future.set_exception(exception)
+
+    def getNumberOfRequests(self):
+        return len(self.requests)
+
+    def isHealthy(self):
+        return (not self.isClosed) and self.connection.isActive() and not self.channel.closed
+
+    def _onReadable(self):
+        while self.channel.recv_ready():
+            self.buffer += self.channel.recv(65536)
+
+        # Every packet consists of its length, type and request ID, followed by the response payload
+        while len(self.buffer) >= 4:
+            length, = struct.unpack('>I', self.buffer[:4])
+            if len(self.buffer) < length + 4:
+                break
+            packetType = self.buffer[4]
+            msg = Message(bytes(self.buffer[5:length + 4]))
+            del self.buffer[:length + 4]
+
+            future = self.requests.pop(msg.get_int(), None)
+            if (future is not None) and not future.done():
+                future.set_result((packetType, msg))
+
+        if (not self.channel.recv_ready()) and (self.channel.closed or self.channel.eof_received):
+            self.close()
+
+    async def _request(self, packetType, *arguments):
+        """Sends a request and waits for its (packetType, msg) response; arguments are (type, value) tuples"""
+        if self.isClosed:
+            raise ConnectionError('SFTP channel closed')
+        requestId = self.nextRequestId
+        self.nextRequestId = (self.nextRequestId + 1) & 0xffffffff
+
+        msg = Message()
+        msg.add_int(requestId)
+        for argumentType, value in arguments:
+            getattr(msg, 'add_' + argumentType)(value)
+        packet = msg.asbytes()
+
+        future = self.loop.create_future()
+        self.requests[requestId] = future
+        try:
+            # Requests are small, so sending only blocks the event loop if the channel window is exhausted
+            self.channel.sendall(struct.pack('>IB', len(packet) + 1, packetType) + packet)
+        except Exception as e:
+            self.requests.pop(requestId, None)
+            self.close()
+            raise ConnectionError('SFTP channel failed: %s' % e)
+        return await future
+
+    @staticmethod
+    def _checkStatus(packetType, msg, expectedType, path):
+        """Raises EOFError or IOError for status responses; otherwise checks the response type"""
+        if packetType == CMD_STATUS:
+            code = msg.get_int()
+            text = msg.get_text()
+            if code == SFTP_OK:
+                return
+            elif code == SFTP_EOF:
+                raise EOFError(text)
+            elif code == SFTP_NO_SUCH_FILE:
+                raise IOError(ENOENT, text, path)
+            elif code == SFTP_PERMISSION_DENIED:
+                raise IOError(EACCES, text, path)
+            raise IOError('%s: %s' % (text, path))
+        if packetType != expectedType:
+            raise IOError('Unexpected SFTP response type %d for %s' % (packetType, path))
+
+    async def _closeHandle(self, handle):
+        try:
+            await self._request(CMD_CLOSE, ('string', handle))
+        except Exception:
+            pass
+
+    async def acquireFile(self, path):
+        """Returns the remote handle of a file, opening it if this channel does not have it open yet"""
+        entry = self.files.get(path)
+        if entry is None:
+            entry = AsyncSFTPFile(self.loop.create_task(self._open(path)))
+            self.files[path] = entry
+        entry.numberOfUsers += 1
+        try:
+            return await asyncio.shield(entry.handle)
+        except:
+            await self.releaseFile(path, False)
+            raise
+
+    async def releaseFile(self, path, isPinned):
+        """Closes the handle of a file once it is no longer used, unless it is pinned"""
+        entry = self.files.get(path)
+        if entry is None:
+            return
+        entry.numberOfUsers -= 1
+        if (entry.numberOfUsers > 0) or isPinned:
+            return
+        del self.files[path]
+        await self._closeFile(entry)
+
+    async def closeIdleFile(self, path):
+        """Closes the handle of a file if it is not in use"""
+        entry = self.files.get(path)
+        if (entry is not None) and (entry.numberOfUsers == 0):
+            del self.files[path]
+            await self._closeFile(entry)
+
+    async def _closeFile(self, entry):
+        try:
+            handle = await entry.handle
+        except Exception:  # The file was never opened
+            return
+        await self._closeHandle(handle)
+
+    async def getDirectoryEntries(self, path):
+        packetType, msg = await self._request(CMD_OPENDIR, ('string', path))
+        AsyncSFTPChannel._checkStatus(packetType, msg, CMD_HANDLE, path)
+        handle = msg.get_binary()
+        entries = []
+        try:
+            while True:
+                packetType, msg = await self._request(CMD_READDIR, ('string', handle))
+                try:
+                    AsyncSFTPChannel._checkStatus(packetType, msg, CMD_NAME, path)
+                except EOFError:
+                    break
+                for _ in range(msg.get_int()):
+                    filename = msg.get_text()
+                    longname = msg.get_text()
+                    entry = SFTPAttributes._from_msg(msg, filename, longname)
+                    if filename not in ('.', '..'):
+                        entries.append(entry)
+        finally:
+            await self._closeHandle(handle)
+        return entries
+
+    async def getEntry(self, path):
+        packetType, msg = await self._request(CMD_STAT, ('string', path))
+        AsyncSFTPChannel._checkStatus(packetType, msg, CMD_ATTRS, path)
+        return SFTPAttributes._from_msg(msg)
+
+    async def getLinkTarget(self, path):
+        packetType, msg = await self._request(CMD_READLINK, ('string', path))
+        AsyncSFTPChannel._checkStatus(packetType, msg, CMD_NAME, path)
+        if msg.get_int() != 1:
+            raise IOError('Unexpected number of names in readlink response for %s' % path)
+        return msg.get_text()
+
+    async def _open(self, path):
+        attributes = Message()
+        SFTPAttributes()._pack(attributes)
+        packetType, msg = await self._request(CMD_OPEN, ('string', path), ('int', SFTP_FLAG_READ),
+                                              ('bytes', attributes.asbytes()))
+        AsyncSFTPChannel._checkStatus(packetType, msg, CMD_HANDLE, path)
+        return msg.get_binary()
+
+    async def read(self, handle, offset, size, path):
+        """Reads exactly size bytes, issuing follow-up requests if the server returns less than requested"""
+        parts = []
+        while size > 0:
+            packetType, msg = await self._request(CMD_READ, ('string', handle), ('int64', offset), ('int', size))
+            try:
+                AsyncSFTPChannel._checkStatus(packetType, msg, CMD_DATA, path)
+            except EOFError:
+                raise IOError('Unexpected end of file at offset %d of %s' % (offset, path))
+            data = msg.get_binary()
+            if len(data) == 0:
+                raise IOError('Empty read at offset %d of %s' % (offset, path))
+            parts.append(data)
+            offset += len(data)
+            size -= len(data)
+        return b''.join(parts)
+
+class AsyncMountLoadSource:
+    """
+    SFTP source with the same interface as MountLoadSource that runs all remote
+    operations on an asyncio event loop in a dedicated thread. Every channel
+    multiplexes any number of outstanding stat, listdir and read requests, so
+    many FUSE threads can be served by a few SSH connections. Other threads
+    schedule coroutines with submit(), which returns a thread-safe future.
+    """
+    maximumRequestSize = 32768
+    requestsPerChannel = 64
+    streamChunksInFlight = 2
+
+    def __init__(self, sourceURI, password, readWindow=None, maximumConnections=None, channelsPerConnection=None):
+        hostname, port, username, self.remoteDirectory = MountLoadSource.parseSourceURI(sourceURI)
+        self.connectionArguments = {'hostname': hostname, 'port': port, 'username': username, 'password': password}
+        self.maximumConnections = MountLoadSource.defaultMaximumConnections if maximumConnections is None \
+            else maximumConnections
+        self.channelsPerConnection = MountLoadSource.defaultChannelsPerConnection if channelsPerConnection is None \
+            else channelsPerConnection
+        self.readWindow = MountLoadSource.defaultReadWindow if readWindow is None else readWindow
+        self.log = logging.getLogger('mountload.asyncsource')
+
+        # Number of FUSE file handles per remote path; channels keep pinned files open while idle
+        self.pinnedFilesLock = Lock()
+        self.pinnedFiles = Counter()
+
+        # Connections and channels are only touched from the event loop
+        self.connections = []
+        self.channels = []
+        self.channelLock = None
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, name='mountload-asyncsource', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+        self._run(self._close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def discardFile(self, path):
+        """Closes the idle handles of a remote file, so the next read opens it again; used when the file was replaced"""
+        if not self.loop.is_closed():
+            self._run(self._closeIdleFile(self.remoteDirectory + path))
+
+    async def _close(self):
+        for channel in self.channels:
+            channel.close()
+        self.channels = []
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+
+    async def _acquireChannel(self):
+        """Returns the least busy healthy channel, opening another one while all channels are busy"""
+        if self.channelLock is None:
+            self.channelLock = asyncio.Lock()
+        async with self.channelLock:
+            for channel in [c for c in self.channels if not c.isHealthy()]:
+                self._discard(channel)
+
+            channel = min(self.channels, key=lambda c: c.getNumberOfRequests(), default=None)
+            maximumChannels = self.maximumConnections * self.channelsPerConnection
+            if (channel is None) or ((channel.getNumberOfRequests() >= AsyncMountLoadSource.requestsPerChannel)
+                                     and (len(self.channels) < maximumChannels)):
+                try:
+                    channel = await self._openChannel()
+                except Exception:
+                    if channel is None:
+                        raise
+                    self.log.exception('Failed to open an additional SFTP channel')
+            return channel
+
+    async def _openChannel(self):
+        # Connecting and opening the SFTP subsystem involve blocking round trips, so they run in the executor
+        connection = next((c for c in self.connections
+                           if c.isActive() and c.numberOfChannels < self.channelsPerConnection), None)
+        if connection is None:
+            connection = await self.loop.run_in_executor(None, lambda: SFTPConnection(**self.connectionArguments))
+            self.connections.append(connection)
+        connection.numberOfChannels += 1
+        try:
+            sftp = await self.loop.run_in_executor(None, connection.client.open_sftp)
+        except:
+            connection.numberOfChannels -= 1
+            raise
+        channel = AsyncSFTPChannel(self.loop, connection, sftp)
+        self.channels.append(channel)
+        return channel
+
+    def _discard(self, channel):
+        channel.close()
+        self.channels.remove(channel)
+        channel.connection.numberOfChannels -= 1
+        if (not channel.connection.isActive()) or (channel.connection.numberOfChannels == 0):
+            if channel.connection in self.connections:
+                self.connections.remove(channel.connection)
+            channel.connection.close()
+
+    async def _execute(self, name, operation):
+        """Awaits operation(channel) on the least busy channel, retrying once on another channel if the channel failed"""
+        for attempt in range(2):
+            channel = await self._acquireChannel()
+            try:
+                with statistics.timer('sftp.' + name):
+                    return await operation(channel)
+            except ConnectionError:
+                if attempt > 0:
+                    raise
+                self.log.warning('SFTP connection failed; reconnecting')
+
+    def getDirectoryEntries(self, path):
+        return self._run(self._execute('listdir', lambda channel: channel.getDirectoryEntries(self.remoteDirectory + path)))
+
+    def getEntry(self, path):
+        try:
+            return self._run(self._execute('stat', lambda channel: channel.getEntry(self.remoteDirectory + path)))
+        except IOError as e:
+            if e.errno == ENOENT:
+                return None
+            raise
+
+    def getLinkTarget(self, path):
+        return self._run(self._execute('readlink', lambda channel: channel.getLinkTarget(self.remoteDirectory + path)))
+
+    def getMaximumConcurrency(self):
+        """Returns the number of remote operations that can run at once, since every channel multiplexes many requests"""
+        return self.maximumConnections * self.channelsPerConnection * AsyncMountLoadSource.requestsPerChannel
+
+    def getRemoteDirectory(self):
+        return self.remoteDirectory
+
+    def _isFilePinned(self, remotePath):
+        return self.pinnedFiles[remotePath] > 0
+
+    def pinFile(self, path):
+        """Keeps the remote file open on the channels that read it until unpinFile() is called"""
+        with self.pinnedFilesLock:
+            self.pinnedFiles[self.remoteDirectory + path] += 1
+
+    async def _readChunk(self, path, offset, size):
+        remotePath = self.remoteDirectory + path
+
+        async def readChunk(channel):
+            handle = await channel.acquireFile(remotePath)
+            try:
+                # Keep at most readWindow read requests in flight for this chunk
+                semaphore = asyncio.Semaphore(self.readWindow)
+
+                async def readPart(partOffset):
+                    async with semaphore:
+                        partSize = min(AsyncMountLoadSource.maximumRequestSize, offset + size - partOffset)
+                        return await channel.read(handle, partOffset, partSize, path)
+
+                parts = await asyncio.gather(*[readPart(partOffset) for partOffset in
+                                               range(offset, offset + size, AsyncMountLoadSource.maximumRequestSize)])
+            finally:
+                await channel.releaseFile(remotePath, self._isFilePinned(remotePath))
+            statistics.increment('sftp.bytesRead', size)
+            return b''.join(parts)
+
+        return await self._execute('readChunk', readChunk)
+
+    def readData(self, path, offset, size):
+        return b''.join(self.readStream(path, offset, size))
+
+    def readStream(self, path, offset, size):
+        """
+        Yields the data for a range of a remote file as consecutive chunks of at
+        most MountLoadSource.streamChunkSize bytes. The next chunks are already
+        being read on the event loop while the caller processes a chunk.
+        """
+        chunks = deque((chunkOffset, min(MountLoadSource.streamChunkSize, offset + size - chunkOffset))
+                       for chunkOffset in range(offset, offset + size, MountLoadSource.streamChunkSize))
+        futures = deque()
+        try:
+            while (len(chunks) > 0) or (len(futures) > 0):
+                while (len(chunks) > 0) and (len(futures) < AsyncMountLoadSource.streamChunksInFlight):
+                    chunkOffset, chunkSize = chunks.popleft()
+                    futures.append(self.submit(self._readChunk(path, chunkOffset, chunkSize)))
+                yield futures.popleft().result()
+        finally:
+            # The caller may stop early; don't leave reads running on the event loop
+            for future in futures:
+                future.cancel()
+
+    def _run(self, coroutine):
+        return self.submit(coroutine).result()
+
+    def submit(self, coroutine):
+        """Schedules a coroutine on the event loop from any thread and returns its concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def unpinFile(self, path):
+        remotePath = self.remoteDirectory + path
+        with self.pinnedFilesLock:
+            self.pinnedFiles[remotePath] -= 1
+            if self.pinnedFiles[remotePath] > 0:
+                return
+            del self.pinnedFiles[remotePath]
+        self.submit(self._closeIdleFile(remotePath))
+
+    async def _closeIdleFile(self, remotePath):
+        for channel in list(self.channels):
+            await channel.closeIdleFile(remotePath)
@@ -0,0 +1,29 @@
+# Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
+# See the file LICENSE.txt for copying permission.
+
+import logging
+import os
+import subprocess
+
+class CompletionHook:
+    """
+    Completion listener for the metadata that logs that the target is complete
+    and optionally runs a shell command. The command gets the target directory
+    in the MOUNTLOAD_TARGET environment variable and is not waited for.
+    """
+
+    def __init__(self, targetDirectory, command=None):
+        self.targetDirectory = targetDirectory
+        self.command = command
+        self.log = logging.getLogger('mountload.completion')
+
+    def __call__(self):
+        self.log.warning('All files have been downloaded to %s', self.targetDirectory)
+        if self.command is None:
+            return
+
+        environment = dict(os.environ, MOUNTLOAD_TARGET=self.targetDirectory)
+        try:
+            subprocess.Popen(self.command, shell=True, env=environment)
+        except OSError:
+            self.log.exception('Failed to run the completion command %s', self.command)
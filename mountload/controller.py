@@ -2,34 +2,54 @@
 # See the file LICENSE.txt for copying permission.
 
 from contextlib import contextmanager
+from mountload.fetches import FetchRegistry
+from mountload.lru import LRUCache
 from mountload.metadata import MountLoadMetaData
+from mountload.readahead import ReadAhead
+from mountload.scheduler import IOScheduler, ScheduledSource
+from mountload.stats import statistics
 from mountload.source import MountLoadSource
 from mountload.target import MountLoadTarget
 from os import getgid, getuid
 import os.path
 import stat
-from threading import Semaphore
+from threading import Lock, Semaphore
+from weakref import WeakSet
 
 class Controller:
-    def __init__(self, sourceURI, targetDirectory, password):
+    defaultChunkSize = 1024 * 1024
+    stagingSize = 1024 * 1024
+
+    def __init__(self, sourceURI, targetDirectory, password, readWindow=None, readAhead=None, metadata=None, source=None,
+                 target=None, statCache=None, fetches=None, chunkSize=None, sourceClass=MountLoadSource,
+                 discardRemoteFile=None):
         self.gid = getgid()
         self.uid = getuid()
+        self.chunkSize = Controller.defaultChunkSize if chunkSize is None else chunkSize
+        self.readAhead = readAhead
+        self.statCache = statCache
+        self.fetches = FetchRegistry() if fetches is None else fetches
 
         # Initialize target and metadata
-        self.target = MountLoadTarget(targetDirectory)
-        self.metadata = MountLoadMetaData(self.target.getDBPath())
+        self.ownsTarget = target is None
+        self.target = MountLoadTarget(targetDirectory) if self.ownsTarget else target
+        self.ownsMetaData = metadata is None
+        self.metadata = MountLoadMetaData(self.target.getDBPath(), self.target.syncFiles) if self.ownsMetaData else metadata
 
-        # Store and check source URI
+        # Check source URI
         knownSourceURI = self.metadata.getConfigString('sourceURI')
-        if sourceURI is None:
-            if knownSourceURI is None:
-                raise RuntimeError('No source URI supplied')
-            sourceURI = knownSourceURI
-        elif knownSourceURI is not None and knownSourceURI != sourceURI:
-            raise RuntimeError('Given source URI differs from known source URI')
+        sourceURI = Controller._resolveSourceURI(sourceURI, knownSourceURI)
 
-        # Initialize SFTP source
-        self.source = MountLoadSource(sourceURI, password)
+        # Initialize SFTP source; remote operations always go through a scheduler
+        self.ownsSource = source is None
+        if self.ownsSource:
+            source = sourceClass(sourceURI, password, readWindow)
+            source = ScheduledSource(source, IOScheduler(source.getMaximumConcurrency()), IOScheduler.foregroundMetaData,
+                                     IOScheduler.foregroundData, ownsSource=True)
+        self.source = source
+
+        # Closes the open handles of a replaced remote file on every source that may have it open
+        self.discardRemoteFile = self.source.discardFile if discardRemoteFile is None else discardRemoteFile
 
         # Bootstrap the remote root
         self.metadata.begin()
@@ -45,57 +65,252 @@ class Controller:
             self.metadata.setConfig('sourceURI', sourceURI)
 
     def close(self):
-        self.source.close()
-        self.metadata.close()
-        self.target.close()
-
-    def _downloadFileData(self, pathInfo, offset, size):
-        # Read data from source
-        path = pathInfo['dirname'] + pathInfo['basename']
-        data = self.source.readData(path, offset, size)
-
-        # Write data to target
-        self.target.writeData(path, offset, data)
-
-        # Remove the remote segments we've overwritten
+        if self.ownsSource:
+            self.source.close()
+        if self.ownsMetaData:
+            self.metadata.close()
+        if self.ownsTarget:
+            self.target.close()
+
+    def _alignRange(self, begin, end, segmentBegin, segmentEnd):
+        """Rounds the range [begin, end] out to whole chunks, without extending it beyond the remote segment"""
+        return (max(segmentBegin, begin - begin % self.chunkSize),
+                min(segmentEnd, end - end % self.chunkSize + self.chunkSize - 1))
+
+    def _downloadFileData(self, pathInfo, offset, size, fetch, chunkCallback=None, buffer=None, bufferOffset=0):
+        """
+        Streams a range of a file from source to target, updating the remote
+        segments as chunks land. Received chunks are staged and written to the
+        target in larger blocks. If given, buffer holds the file data starting
+        at bufferOffset and received data that overlaps it is copied into it
+        right away. chunkCallback is called with the size of every received
+        chunk; the callback can abort the download by returning False. The
+        transfer is scheduled in the priority of the fetch it belongs to. Returns
+        the number of bytes downloaded.
+        """
+        path = pathInfo['path']
         pathId = pathInfo['pathId']
-        self.metadata.begin()
-        self.metadata.removeRemoteSegments(pathId, offset, offset + size - 1)
-
-        # If all remote segments have been downloaded, we mark the file as synced
-        if len(self.metadata.getRemoteSegments(pathId)) == 0:
-            self.metadata.setPathSynced(pathId)
-        self.metadata.commit()
+        position = offset
+        stagedOffset = offset
+        stagedChunks = []
+        try:
+            for chunk in self.source.readStream(path, offset, size, fetch):
+                if buffer is not None:
+                    copyBegin = max(position, bufferOffset)
+                    copyEnd = min(position + len(chunk), bufferOffset + len(buffer))
+                    if copyBegin < copyEnd:
+                        buffer[copyBegin - bufferOffset:copyEnd - bufferOffset] = \
+                            memoryview(chunk)[copyBegin - position:copyEnd - position]
+                stagedChunks.append(chunk)
+                position += len(chunk)
+
+                if position - stagedOffset >= Controller.stagingSize:
+                    self._writeStagedData(pathInfo, stagedOffset, stagedChunks)
+                    stagedOffset = position
+                    stagedChunks = []
+
+                if (chunkCallback is not None) and (chunkCallback(len(chunk)) is False):
+                    break
+        finally:
+            # Data that was received before an error is still valid
+            self._writeStagedData(pathInfo, stagedOffset, stagedChunks)
+
+        return position - offset
+
+    def downloadRange(self, pathInfo, begin, end, chunkCallback=None):
+        """
+        Downloads the parts of the remote segments of a file that overlap the
+        range [begin, end], skipping parts other threads are downloading already
+        """
+        for segmentBegin, segmentEnd in self.metadata.getRemoteSegmentsRange(pathInfo['pathId'], begin, end):
+            fetchBegin, fetchEnd = self._alignRange(max(begin, segmentBegin), min(end, segmentEnd), segmentBegin, segmentEnd)
+            _, _, isAborted = self._fetchRange(pathInfo, fetchBegin, fetchEnd, chunkCallback)
+            if isAborted:
+                break
+
+    def downloadNextSegment(self, pathInfo, maximumSize, chunkCallback=None):
+        """
+        Downloads at most maximumSize bytes of the first remote segment of a file,
+        waiting for other threads that are downloading parts of it. Returns the
+        number of bytes processed, which is 0 once the file is synced.
+        """
+        # Another thread may finish the file at any time, so we only look at the segments once
+        segments = self.metadata.getRemoteSegments(pathInfo['pathId'])
+        if len(segments) == 0:
+            # The file is marked synced together with its last remote segment changes, once its data is durable
+            self.metadata.markDownloaded(pathInfo['pathId'])
+            return 0
+
+        segmentBegin, segmentEnd = segments[0]
+        fetchBegin, fetchEnd = self._alignRange(segmentBegin, segmentBegin + maximumSize - 1, segmentBegin, segmentEnd)
+        downloaded, others, isAborted = self._fetchRange(pathInfo, fetchBegin, fetchEnd, chunkCallback)
+        processed = sum(end - begin + 1 for begin, end in downloaded)
+        for begin, end, fetch in others:
+            self._waitForFetch(fetch)
+            processed += end - begin + 1
+        return processed
+
+    def _fetchRange(self, pathInfo, begin, end, chunkCallback=None, buffer=None, bufferOffset=0):
+        """
+        Downloads the parts of the range [begin, end] that no other thread is
+        downloading, copying our data into buffer if given (see
+        _downloadFileData()). Returns the (begin, end) ranges we downloaded,
+        the (begin, end, fetch) parts that other threads are downloading and
+        whether the download was aborted by chunkCallback.
+        """
+        pathId = pathInfo['pathId']
+        parts = self.fetches.claim(pathId, begin, end)
+        downloaded = []
+        others = []
+        isAborted = False
+        try:
+            for partBegin, partEnd, fetch, isOwner in parts:
+                if not isOwner:
+                    others.append((partBegin, partEnd, fetch))
+                    continue
+                if isAborted:
+                    continue
+
+                size = partEnd - partBegin + 1
+                try:
+                    partSize = self._downloadFileData(pathInfo, partBegin, size, fetch, chunkCallback, buffer,
+                                                      bufferOffset)
+                finally:
+                    self.fetches.finish(pathId, fetch)
+                if partSize > 0:
+                    downloaded.append((partBegin, partBegin + partSize - 1))
+                isAborted = partSize < size
+        finally:
+            # Release the parts we skipped because of an abort or an error
+            for partBegin, partEnd, fetch, isOwner in parts:
+                if isOwner:
+                    self.fetches.finish(pathId, fetch)
+        return (downloaded, others, isAborted)
 
-        # Return the data
-        return data
+    def _waitForFetch(self, fetch):
+        # The thread downloading the range continues in our priority class while we wait for it
+        self.source.raisePriority(fetch)
+        fetch.wait()
 
     def getEntriesInDirectory(self, dirpath):
         # Determine directory
         pathInfo = self._getPath(dirpath)
         if pathInfo is None:
             raise RuntimeError('Unknown path')
-        if dirpath != '/':
-            dirpath += '/'
 
         # Download all the entries in the directory if not synced
         if not pathInfo['isSynced']:
+            self.syncDirectory(pathInfo)
+
+        # Return subpaths
+        return self.metadata.getSubPaths(pathInfo['path'])
+
+    def revalidateDirectory(self, pathInfo):
+        """
+        Lists a synced directory at the source again and compares its entries
+        with the metadata. Files of which the size or modification time changed
+        are reset, so they are downloaded again, and new entries are registered.
+        Changed files that are being downloaded are skipped until the next pass.
+        Returns the number of files that were reset.
+        """
+        dirpath = self.getPathForInfo(pathInfo)
+        if dirpath != '/':
+            dirpath += '/'
+        entries = self.source.getDirectoryEntries(dirpath)
+        knownPaths = dict((row['name'], row) for row in self.metadata.getSubPaths(pathInfo['path']))
+
+        numberOfResetFiles = 0
+        newEntries = []
+        for entry in entries:
+            row = knownPaths.get(entry.filename)
+            if row is None:
+                newEntries.append(entry)
+            elif (row['type'] == 'file') and stat.S_ISREG(entry.st_mode) and \
+                    ((entry.st_size != row['size']) or (entry.st_mtime != row['mtime'])):
+                if self._resetFile(row, entry):
+                    numberOfResetFiles += 1
+
+        # Register entries that were added at the source, resolving symlinks before taking the write lock
+        linkTargets = dict((entry.filename, self.source.getLinkTarget(dirpath + entry.filename))
+                           for entry in newEntries if stat.S_ISLNK(entry.st_mode))
+        if len(newEntries) > 0:
             self.metadata.begin()
-            for entry in self.source.getDirectoryEntries(dirpath):
-                if not self.metadata.getPath(dirpath, entry.filename):  # Entry can already exist
-                    entryPath = dirpath + entry.filename
-                    self._registerPath(entryPath, entry)
-            self.metadata.setPathSynced(pathInfo['pathId'])
+            try:
+                knownBasenames = set(row['name'] for row in self.metadata.getSubPaths(pathInfo['path']))
+                rows = [self._createTargetPath(dirpath + entry.filename, entry.filename, entry, linkTargets.get(entry.filename))
+                        for entry in newEntries if entry.filename not in knownBasenames]
+                self.metadata.addPaths(pathInfo['path'], rows)
+            except:
+                self.metadata.rollback()
+                raise
             self.metadata.commit()
+            self._preallocateFiles(dirpath, rows)
 
-        # Return subpaths
-        return self.metadata.getSubPaths(dirpath)
+        return numberOfResetFiles
+
+    def _resetFile(self, pathInfo, entry):
+        """
+        Truncates a file that changed at the source and resets its metadata, so
+        it is downloaded again. Claiming the entire file keeps other threads from
+        downloading or reading it meanwhile; returns False if someone is using it.
+        """
+        pathId = pathInfo['pathId']
+        parts = self.fetches.claim(pathId, 0, max(1, pathInfo['size'], entry.st_size) - 1)
+        try:
+            if not all(isOwner for _, _, _, isOwner in parts):
+                return False
+
+            # Cached SFTP handles still refer to the file that was replaced
+            self.discardRemoteFile(self.getPathForInfo(pathInfo))
+
+            # Reset the metadata first; if we crash before truncating, the old data is simply overwritten
+            self.metadata.resetFile(pathId, entry.st_size, entry.st_mode, entry.st_atime, entry.st_mtime)
+            self.target.createFile(self.getPathForInfo(pathInfo), entry.st_mode | stat.S_IRUSR | stat.S_IWUSR,  # Mode u+rw
+                                   entry.st_size)
+            return True
+        finally:
+            for _, _, fetch, isOwner in parts:
+                if isOwner:
+                    self.fetches.finish(pathId, fetch)
+
+    def syncDirectory(self, pathInfo):
+        """
+        Lists a directory at the source, bulk registers all entries that are
+        not known yet and marks the directory as synced. Returns the rows of
+        the subdirectories that still need to be listed.
+        """
+        dirpath = self.getPathForInfo(pathInfo)
+        if dirpath != '/':
+            dirpath += '/'
+        entries = self.source.getDirectoryEntries(dirpath)
+
+        # Resolve symlinks before taking the write lock, since this involves round trips
+        knownBasenames = set(row['name'] for row in self.metadata.getSubPaths(pathInfo['path']))
+        linkTargets = {}
+        for entry in entries:
+            if stat.S_ISLNK(entry.st_mode) and (entry.filename not in knownBasenames):
+                linkTargets[entry.filename] = self.source.getLinkTarget(dirpath + entry.filename)
+
+        self.metadata.begin()
+        try:
+            knownBasenames = set(row['name'] for row in self.metadata.getSubPaths(pathInfo['path']))  # Entries can already exist
+            rows = [self._createTargetPath(dirpath + entry.filename, entry.filename, entry, linkTargets.get(entry.filename))
+                    for entry in entries if entry.filename not in knownBasenames]
+            self.metadata.addPaths(pathInfo['path'], rows)
+            self.metadata.setPathSynced(pathInfo['pathId'])
+            subdirectories = [row for row in self.metadata.getSubPaths(pathInfo['path'])
+                              if (row['type'] == 'directory') and not row['isSynced']]
+        except:
+            self.metadata.rollback()
+            raise
+        self.metadata.commit()
+        self._preallocateFiles(dirpath, rows)
+        return subdirectories
 
     def _getPath(self, path):
         """Returns the metadata structure for a given path by recursively resolving the path components."""
         path = os.path.normpath(path)
-        dirname, basename = Controller._splitPath(path)
-        pathInfo = self.metadata.getPath(dirname, basename)
+        pathInfo = self.metadata.getPath(path)
 
         # If no path was found, recursively check parent directory for sync
         if (pathInfo is None) and (path != '/'):
@@ -107,15 +322,37 @@ class Controller:
             entry = self.source.getEntry(path)
             if entry is None:  # We checked with the source, but this path really doesn't exist
                 return None
-            self._registerPath(path, entry)
-            pathInfo = self.metadata.getPath(dirname, basename)
+            self.metadata.begin()
+            rows = []
+            try:
+                if self.metadata.getPath(path) is None:  # Another thread may have registered it meanwhile
+                    rows = [self._registerPath(path, entry)]
+            except:
+                self.metadata.rollback()
+                raise
+            self.metadata.commit()
+            self._preallocateFiles(os.path.dirname(path).rstrip('/') + '/', rows)
+            pathInfo = self.metadata.getPath(path)
 
         return pathInfo
 
+    def getPathForInfo(self, pathInfo):
+        return pathInfo['path']
+
+    def getProgress(self):
+        return self.metadata.getProgress()
+
     def getStatForPath(self, path):
         pathInfo = self._getPath(path)
         if pathInfo is None:
             return None
+        return self._getStatForPathInfo(path, pathInfo)
+
+    def _getStatForPathInfo(self, path, pathInfo):
+        # Stat structures are cached for as long as metadata keeps returning the same row
+        cachedStat = self.statCache.get(path) if self.statCache is not None else None
+        if (cachedStat is not None) and (cachedStat[0] is pathInfo):
+            return cachedStat[1]
 
         # Compose a stat structure; fake some fields because SFTP gives us limited info:
         # 1. We fake st_blocks, assuming FS block size of 4 KiB and stat block size of 512 bytes:
@@ -129,15 +366,79 @@ class Controller:
             stat['st_nlink'] = 2
         elif pathInfo['type'] == 'file':
             stat['st_nlink'] = 1
+
+        if self.statCache is not None:
+            self.statCache.put(path, (pathInfo, stat))
         return stat
 
+    def getStatsInDirectory(self, dirpath):
+        """Returns (name, stat) tuples for all entries in a directory"""
+        return [(pathInfo['name'], self._getStatForPathInfo(pathInfo['path'], pathInfo))
+                for pathInfo in self.getEntriesInDirectory(dirpath)]
+
     def getSymlinkTarget(self, path):
         pathInfo = self._getPath(path)
         if (pathInfo is None) or (pathInfo['type'] != 'symlink') or not pathInfo['isSynced']:
             raise RuntimeError('Unknown symlink')
         return self.target.getSymlink(path)
 
+    def getUnsyncedDirectories(self):
+        return self.metadata.getUnsyncedDirectories()
+
+    def getUnsyncedPaths(self, afterPathId, limit):
+        return self.metadata.getUnsyncedPaths(afterPathId, limit)
+
+    def openFile(self, path, allowLocal=True):
+        """
+        Opens a file for reading. If the file is synced and allowLocal is set,
+        a local file descriptor is returned that can be read directly and must
+        be closed by the caller. Otherwise None is returned and the source and
+        target files are kept open until releaseFile() is called.
+        """
+        pathInfo = self._getPath(path)
+        if (pathInfo is None) or (pathInfo['type'] != 'file'):
+            raise RuntimeError('Invalid path for opening')
+        if pathInfo['isSynced'] and allowLocal:
+            return self.target.openLocalFile(path)
+
+        self.source.pinFile(path)
+        self.target.pinFile(path)
+        return None
+
     def readData(self, path, offset, size):
+        while True:
+            data = self._tryReadData(path, offset, size)
+            if data is not None:
+                return data
+
+    def _readLocal(self, pathInfo, offset, view):
+        """
+        Reads a range of a file from the target into view. The range is claimed
+        while reading, so a reset of the file can not truncate it underneath us.
+        Returns False without reading if the range is in use or the file changed
+        since pathInfo was retrieved.
+        """
+        pathId = pathInfo['pathId']
+        end = offset + len(view) - 1
+        parts = self.fetches.claim(pathId, offset, end)
+        others = [fetch for _, _, fetch, isOwner in parts if not isOwner]
+        try:
+            if len(others) == 0:
+                currentInfo = self.metadata.getPath(pathInfo['path'])
+                if (currentInfo is None) or (currentInfo['size'] != pathInfo['size']) or \
+                        (len(self.metadata.getRemoteSegmentsRange(pathId, offset, end)) > 0):
+                    return False
+                self.target.readInto(pathInfo['path'], offset, view)
+        finally:
+            for _, _, fetch, isOwner in parts:
+                if isOwner:
+                    self.fetches.finish(pathId, fetch)
+        for fetch in others:
+            self._waitForFetch(fetch)
+        return len(others) == 0
+
+    def _tryReadData(self, path, offset, size):
+        """Reads data like readData(), but returns None if the file was reset meanwhile so the read must be retried"""
         pathInfo = self._getPath(path)
         if (pathInfo is None) or (pathInfo['type'] != 'file'):
             raise RuntimeError('Invalid path for reading')
@@ -146,105 +447,201 @@ class Controller:
         if (offset + size) > pathInfo['size']:
             size = max(0, pathInfo['size'] - offset)
         if size == 0:
-            return ''
+            return b''
 
-        # If this path is synced, we immediately return the data from source
+        # If this path is synced, we immediately return the data from the target
         if pathInfo['isSynced']:
-            return self.target.readData(path, offset, size)
+            data = bytearray(size)
+            if not self._readLocal(pathInfo, offset, memoryview(data)):
+                return None
+            statistics.increment('read.localBytes', size)
+            return bytes(data)
+
+        # Let read-ahead prefetch the data following this read if the file is being streamed
+        if self.readAhead is not None:
+            self.readAhead.registerRead(pathInfo, offset, size)
 
         # Unlike read(2) suggests, many applications expect us to return exactly [size] bytes of data.
         # So we need to compile this chunk using local and remote sources, whatever is available, as long
         # as we end up with enough bytes.
-        data = b''
-        remoteSegments = self.metadata.getRemoteSegmentsRange(pathInfo['pathId'], offset, offset + size - 1)
-        segmentIdx = 0
-        currentPos = 0
-        while currentPos < size:
-            # Determine current remote segment properties
-            if segmentIdx >= len(remoteSegments):
-                segmentBegin = size
-                segmentEnd = size - 1
-            else:
-                currentSegment = remoteSegments[segmentIdx]
-                segmentBegin = currentSegment['begin'] - offset
-                segmentEnd = currentSegment['end'] - offset
-
-            # Append local data if available
-            if currentPos < segmentBegin:
-                data += self.target.readData(path, offset + currentPos, segmentBegin - currentPos)
-                currentPos = segmentBegin
-
-            # Append remote data
-            remoteReadSize = min(size - currentPos, segmentEnd - segmentBegin + 1)
-            if remoteReadSize > 0:
-                data += self._downloadFileData(pathInfo, offset + currentPos, remoteReadSize)
-                currentPos += remoteReadSize
-                segmentIdx += 1
-
-        return data
-
-    def _registerPath(self, path, entry):
+        data = bytearray(size)
+        view = memoryview(data)
+        if len(self.metadata.getRemoteSegmentsRange(pathInfo['pathId'], offset, offset + size - 1)) == 0:
+            if not self._readLocal(pathInfo, offset, view):
+                return None
+            statistics.increment('read.localBytes', size)
+            return bytes(data)
+
+        # Assemble the data in a preallocated buffer so every byte is only copied once from disk or network. Ranges
+        # other threads are downloading are waited for and then read locally; if such a download failed or was
+        # aborted, we find its remote segments again and download them ourselves.
+        end = offset + size - 1
+        filled = []
+        pending = [(offset, end)]
+        while len(pending) > 0:
+            waiting = []
+            for pendingBegin, pendingEnd in pending:
+                for segmentBegin, segmentEnd in self.metadata.getRemoteSegmentsRange(pathInfo['pathId'], pendingBegin,
+                                                                                     pendingEnd):
+                    # Fetch whole chunks, so adjacent small reads share a single SFTP read and segments stay coarse
+                    fetchBegin, fetchEnd = self._alignRange(max(pendingBegin, segmentBegin), min(pendingEnd, segmentEnd),
+                                                            segmentBegin, segmentEnd)
+                    downloaded, others, _ = self._fetchRange(pathInfo, fetchBegin, fetchEnd, buffer=view,
+                                                             bufferOffset=offset)
+                    filled.extend((max(b, offset), min(e, end)) for b, e in downloaded if (b <= end) and (e >= offset))
+                    waiting.extend((max(b, offset), min(e, end), fetch) for b, e, fetch in others
+                                   if (b <= end) and (e >= offset))
+
+            pending = []
+            for waitBegin, waitEnd, fetch in waiting:
+                self._waitForFetch(fetch)
+                pending.append((waitBegin, waitEnd))
+
+        # Read everything we did not download ourselves from the target
+        currentPos = offset
+        localBytes = 0
+        for filledBegin, filledEnd in sorted(filled) + [(end + 1, end)]:
+            if currentPos < filledBegin:
+                if not self._readLocal(pathInfo, currentPos, view[currentPos - offset:filledBegin - offset]):
+                    return None
+                localBytes += filledBegin - currentPos
+            currentPos = max(currentPos, filledEnd + 1)
+        statistics.increment('read.localBytes', localBytes)
+        statistics.increment('read.remoteBytes', size - localBytes)
+
+        # FUSE needs an immutable bytes object
+        return bytes(data)
+
+    def releaseFile(self, path):
+        self.source.unpinFile(path)
+        self.target.unpinFile(path)
+
+    def _createTargetPath(self, path, basename, entry, linkTarget=None):
+        """Creates the target counterpart of a remote entry and returns its metadata row"""
         if stat.S_ISDIR(entry.st_mode):
-            self._registerPathDirectory(path, entry)
+            self.target.createDirectory(path, entry.st_mode | stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)  # Mode u+rwx
+            return (basename, 'directory', entry.st_size, entry.st_mode, entry.st_atime, entry.st_mtime, 0)
         elif stat.S_ISREG(entry.st_mode):
-            self._registerPathFile(path, entry)
+            self.target.createFile(path, entry.st_mode | stat.S_IRUSR | stat.S_IWUSR)  # Mode u+rw; see _preallocateFiles()
+            isSynced = 1 if entry.st_size == 0 else 0
+            return (basename, 'file', entry.st_size, entry.st_mode, entry.st_atime, entry.st_mtime, isSynced)
         elif stat.S_ISLNK(entry.st_mode):
-            self._registerPathSymlink(path, entry)
+            if linkTarget is None:
+                linkTarget = self.source.getLinkTarget(path)
+            self.target.createSymlink(path, linkTarget)
+            return (basename, 'symlink', entry.st_size, entry.st_mode, entry.st_atime, entry.st_mtime, 1)
         else:
             raise RuntimeError('Unsupported path mode %d for path %s' % (entry.st_mode, path))
 
-    def _registerPathDirectory(self, path, entry):
-        dirname, basename = Controller._splitPath(os.path.normpath(path))
-        self.metadata.addPath(dirname, basename, 'directory', entry.st_size, entry.st_mode, entry.st_atime, entry.st_mtime, 0)
-
-        self.target.createDirectory(path, entry.st_mode | stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)  # Mode u+rwx
+    def _preallocateFiles(self, dirpath, rows):
+        """Preallocates the newly registered files in rows; this can take a while, so it is done after committing"""
+        for name, pathType, size, _, _, _, isSynced in rows:
+            if (pathType == 'file') and not isSynced:
+                self.target.preallocateFile(dirpath + name, size)
 
-    def _registerPathFile(self, path, entry):
-        dirname, basename = Controller._splitPath(os.path.normpath(path))
-        size = entry.st_size
-        isSynced = 1 if size == 0 else 0
-
-        self.metadata.begin()
-        pathId = self.metadata.addPath(dirname, basename, 'file', size, entry.st_mode, entry.st_atime, entry.st_mtime, isSynced)
-        if not isSynced:
-            self.metadata.addRemoteSegment(pathId, 0, size - 1)
-        self.metadata.commit()
-
-        self.target.createFile(path, entry.st_mode | stat.S_IRUSR | stat.S_IWUSR)  # Mode u+rw
-
-    def _registerPathSymlink(self, path, entry):
-        target = self.source.getLinkTarget(path)
-        self.target.createSymlink(path, target)
+    def _registerPath(self, path, entry):
+        """Registers a single path and returns its metadata row"""
+        directoryPath, name = Controller._splitPath(os.path.normpath(path))
+        row = self._createTargetPath(path, name, entry)
+        self.metadata.addPaths(directoryPath, [row])
+        return row
+
+    def _writeStagedData(self, pathInfo, offset, chunks):
+        """Writes staged chunks to the target and removes the remote segments they cover"""
+        if len(chunks) == 0:
+            return
+        data = chunks[0] if len(chunks) == 1 else b''.join(chunks)
+        self.target.writeData(pathInfo['path'], offset, data)
+
+        # Metadata marks the file as synced once all remote segments have been downloaded; the removal is only
+        # committed after the target data has been synced to disk
+        self.metadata.removeRemoteSegments(pathInfo['pathId'], offset, offset + len(data) - 1)
 
-        dirname, basename = Controller._splitPath(os.path.normpath(path))
-        self.metadata.addPath(dirname, basename, 'symlink', entry.st_size, entry.st_mode, entry.st_atime, entry.st_mtime, 1)
+    @staticmethod
+    def _resolveSourceURI(sourceURI, knownSourceURI):
+        if sourceURI is None:
+            if knownSourceURI is None:
+                raise RuntimeError('No source URI supplied')
+            return knownSourceURI
+        elif knownSourceURI is not None and knownSourceURI != sourceURI:
+            raise RuntimeError('Given source URI differs from known source URI')
+        return sourceURI
 
     @staticmethod
     def _splitPath(path):
-        dirname, basename = os.path.split(path)
-        if dirname != '/':
-            dirname += '/'
-        return (dirname, basename)
+        """Splits a normalized path into its directory and name; the root has no directory and an empty name"""
+        if path == '/':
+            return (None, '')
+        return os.path.split(path)
 
 class ControllerPool:
-    """ControllerPool is a Controller factory which maintains a pool of Controller instances"""
-    maximumNumberOfInstances = 4
+    """
+    ControllerPool is a Controller factory which maintains a pool of Controller
+    instances. Pooled controllers share the target, metadata and SFTP source, which
+    lends out its SSH connections per remote operation. They also share a registry
+    of the downloads in progress, so concurrent reads of the same range are only
+    fetched once. All remote operations, including those on separate sources,
+    go through an IOScheduler, so interactive operations go before read-ahead
+    and background transfers.
+    """
+    defaultMaximumNumberOfInstances = 16
+    idleInterval = 0.05
+    statCacheCapacity = 65536
+
+    def __init__(self, sourceURI, targetDirectory, password, readWindow=None, readAheadSize=0, maximumConnections=None,
+                 channelsPerConnection=None, maximumNumberOfInstances=None, chunkSize=None, sourceClass=MountLoadSource,
+                 preallocate=False):
+        self.readAhead = ReadAhead(self, readAheadSize) if readAheadSize > 0 else None
+
+        # All controllers share a single target, metadata instance and SFTP source
+        self.target = MountLoadTarget(targetDirectory, preallocate)
+        self.metadata = MountLoadMetaData(self.target.getDBPath(), self.target.syncFiles)
+        knownSourceURI = self.metadata.getConfigString('sourceURI')
+        sourceURI = Controller._resolveSourceURI(sourceURI, knownSourceURI)
+        if knownSourceURI is None:  # Store it before controllers are created concurrently
+            self.metadata.setConfig('sourceURI', sourceURI)
+        self.source = sourceClass(sourceURI, password, readWindow, maximumConnections, channelsPerConnection)
+
+        # All sources handed out, so a replaced remote file can be closed on each of them
+        self.sourcesLock = Lock()
+        self.sources = WeakSet([self.source])
+
+        # Admit as many concurrent remote operations as the engine of the source can handle
+        self.scheduler = IOScheduler(self.source.getMaximumConcurrency())
+        self.foregroundSource = ScheduledSource(self.source, self.scheduler, IOScheduler.foregroundMetaData,
+                                                IOScheduler.foregroundData)
 
-    def __init__(self, sourceURI, targetDirectory, password):
-        self.instanceArguments = {'sourceURI': sourceURI, 'targetDirectory': targetDirectory, 'password': password}
+        self.instanceArguments = {'sourceURI': sourceURI, 'targetDirectory': targetDirectory, 'password': password,
+                                  'readWindow': readWindow, 'readAhead': self.readAhead, 'metadata': self.metadata,
+                                  'target': self.target, 'statCache': LRUCache(ControllerPool.statCacheCapacity),
+                                  'fetches': FetchRegistry(), 'chunkSize': chunkSize, 'sourceClass': sourceClass,
+                                  'discardRemoteFile': self.discardRemoteFile}
 
         # Instance pool
+        if maximumNumberOfInstances is None:
+            maximumNumberOfInstances = ControllerPool.defaultMaximumNumberOfInstances
         self.availableInstances = []
-        self.semaphore = Semaphore(ControllerPool.maximumNumberOfInstances)
+        self.semaphore = Semaphore(maximumNumberOfInstances)
+
+        # Keep track of the number of threads using or waiting for a controller
+        self.activityLock = Lock()
+        self.numberOfActiveThreads = 0
 
     @contextmanager
     def acquire(self):
         """Acquires a controller from the pool or waits while one becomes available"""
-        self.semaphore.acquire()
+        with self.activityLock:
+            self.numberOfActiveThreads += 1
+        try:
+            with statistics.timer('pool.wait'):
+                self.semaphore.acquire()
+        except:
+            self._decreaseActivity()
+            raise
 
         # Take a controller from the stack or create a new one
         if len(self.availableInstances) == 0:
-            controller = Controller(**self.instanceArguments)
+            controller = Controller(source=self.foregroundSource, **self.instanceArguments)
         else:
             controller = self.availableInstances.pop()
 
@@ -260,8 +657,58 @@ class ControllerPool:
             self.availableInstances.append(controller)
         finally:
             self.semaphore.release()
+            self._decreaseActivity()
 
     def close(self):
+        if self.readAhead is not None:
+            self.readAhead.close()
         for instance in self.availableInstances:
             instance.close()
         del self.availableInstances
+        self.source.close()
+        self.metadata.close()
+        self.target.close()
+
+    def createController(self, source=None, priorityClass=IOScheduler.bulk):
+        """
+        Creates a controller outside of the pool; the caller is responsible for
+        closing it. Unless a source from createSource() is given, it uses the
+        shared SFTP source with all of its remote operations scheduled in the
+        given priority class.
+        """
+        if source is None:
+            source = ScheduledSource(self.source, self.scheduler, priorityClass, priorityClass)
+        return Controller(source=source, **self.instanceArguments)
+
+    def createSource(self, maximumConnections, channelsPerConnection):
+        """
+        Creates a separate SFTP source for background work, scheduled in its own
+        lane of the shared scheduler; the caller is responsible for closing it
+        """
+        source = self.instanceArguments['sourceClass'](self.instanceArguments['sourceURI'], self.instanceArguments['password'],
+                                                       self.instanceArguments['readWindow'], maximumConnections,
+                                                       channelsPerConnection)
+        with self.sourcesLock:
+            self.sources.add(source)
+        lane = self.scheduler.addLane(source.getMaximumConcurrency(), isBackground=True)
+        return ScheduledSource(source, self.scheduler, IOScheduler.bulk, IOScheduler.bulk, lane, ownsSource=True)
+
+    def discardRemoteFile(self, path):
+        """Closes the handles of a replaced remote file on the shared source and all separate sources"""
+        with self.sourcesLock:
+            sources = list(self.sources)
+        for source in sources:
+            source.discardFile(path)
+
+    def _decreaseActivity(self):
+        with self.activityLock:
+            self.numberOfActiveThreads -= 1
+
+    def isBusy(self):
+        """Returns whether any thread is currently using or waiting for a pooled controller"""
+        return self.numberOfActiveThreads > 0
+
+    def waitUntilIdle(self, stopEvent):
+        """Waits until no thread uses or waits for a pooled controller, so background work yields to FUSE operations"""
+        while self.isBusy() and not stopEvent.is_set():
+            stopEvent.wait(ControllerPool.idleInterval)
@@ -0,0 +1,104 @@
+# Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
+# See the file LICENSE.txt for copying permission.
+
+from collections import deque
+import logging
+from threading import Condition, Thread
+import time
+
+class MetaDataCrawler:
+    """
+    Walks the remote tree breadth-first with many concurrent directory listings
+    and bulk registers all entries, so getattr() and readdir() can be answered
+    from the metadata database from the start. If directories are given, only
+    those and their subdirectories are crawled.
+    """
+    channelsPerThread = 1
+
+    def __init__(self, controllerPool, numberOfThreads, directories=None):
+        self.pool = controllerPool
+        self.numberOfThreads = numberOfThreads
+        self.directories = directories
+        self.log = logging.getLogger('mountload.crawler')
+
+        # Directories to list, protected by the condition
+        self.condition = Condition()
+        self.queue = deque()
+        self.numberOfBusyThreads = 0
+        self.numberOfDirectories = 0
+        self.isStopped = False
+
+        self.source = None
+        self.threads = []
+
+    def _nextDirectory(self):
+        with self.condition:
+            while not self.isStopped:
+                if len(self.queue) > 0:
+                    self.numberOfBusyThreads += 1
+                    return self.queue.popleft()
+
+                # We are done if nobody can discover new directories anymore
+                if self.numberOfBusyThreads == 0:
+                    self.condition.notify_all()
+                    return None
+                self.condition.wait()
+        return None
+
+    def _run(self):
+        controller = self.pool.createController(self.source)
+        try:
+            while True:
+                pathInfo = self._nextDirectory()
+                if pathInfo is None:
+                    break
+
+                subdirectories = []
+                try:
+                    subdirectories = controller.syncDirectory(pathInfo)
+                except Exception:
+                    self.log.exception('Failed to list directory %s', controller.getPathForInfo(pathInfo))
+                finally:
+                    with self.condition:
+                        self.queue.extend(subdirectories)
+                        self.numberOfBusyThreads -= 1
+                        self.numberOfDirectories += 1
+                        self.condition.notify_all()
+        finally:
+            controller.close()
+
+    def run(self):
+        """Crawls the entire tree and returns once all directories have been listed"""
+        self.start()
+        self.wait()
+        self.stop()
+
+    def start(self):
+        self.startTime = time.monotonic()
+        self.source = self.pool.createSource(1, self.numberOfThreads * MetaDataCrawler.channelsPerThread)
+        if self.directories is None:
+            with self.pool.acquire() as controller:
+                self.queue.extend(controller.getUnsyncedDirectories())
+        else:
+            self.queue.extend(self.directories)
+
+        for _ in range(self.numberOfThreads):
+            thread = Thread(target=self._run, name='mountload-crawler', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        with self.condition:
+            self.isStopped = True
+            self.condition.notify_all()
+        self.wait()
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+
+    def wait(self):
+        for thread in self.threads:
+            thread.join()
+        if len(self.threads) > 0 and not self.isStopped:
+            self.log.info('Crawled %d directories in %.1f seconds', self.numberOfDirectories, time.monotonic() - self.startTime)
+        self.threads = []
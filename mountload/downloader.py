@@ -0,0 +1,255 @@
+# Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
+# See the file LICENSE.txt for copying permission.
+
+from collections import Counter
+import logging
+from mountload.striping import StripedDownload
+from threading import Condition, Event, Lock, Thread
+import time
+
+class RateLimiter:
+    """Token bucket that limits the number of bytes per second for all threads sharing it"""
+    pollInterval = 0.05
+
+    def __init__(self, bytesPerSecond):
+        self.bytesPerSecond = bytesPerSecond
+        self.lock = Lock()
+        self.available = bytesPerSecond
+        self.lastRefill = time.monotonic()
+
+    def consume(self, numberOfBytes, isInterrupted=None):
+        """
+        Blocks until numberOfBytes may be transferred; returns False as soon as
+        isInterrupted() returns True while waiting. The bytes are accounted for
+        either way, so the next transfer waits for them.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.available = min(self.bytesPerSecond, self.available + (now - self.lastRefill) * self.bytesPerSecond)
+            self.lastRefill = now
+
+            # Allow going into debt so chunks larger than the bucket still pass; the sleep pays it back
+            self.available -= numberOfBytes
+            delay = -self.available / self.bytesPerSecond if self.available < 0 else 0
+        deadline = time.monotonic() + delay
+        while delay > 0:
+            if (isInterrupted is not None) and isInterrupted():
+                return False
+            time.sleep(min(delay, RateLimiter.pollInterval))
+            delay = deadline - time.monotonic()
+        return True
+
+class BackgroundDownloader:
+    """
+    Downloads all unsynced paths in the background while FUSE is idle. Files of
+    at least stripeThreshold bytes are striped over numberOfStripes separate
+    SSH connections; one file is striped at a time, while the other threads
+    continue with regular downloads. If a path filter is given, only paths for
+    which it returns True are processed. Paths that keep failing are given up
+    on after maximumAttempts attempts.
+    """
+    segmentSize = 16 * 1024 * 1024
+    maximumAttempts = 3
+    retryInterval = 5
+    scanBatchSize = 256
+
+    def __init__(self, controllerPool, numberOfThreads, bandwidthLimit=None, numberOfStripes=1, stripeThreshold=None,
+                 pathFilter=None):
+        self.pool = controllerPool
+        self.numberOfThreads = numberOfThreads
+        self.pathFilter = pathFilter
+        self.rateLimiter = None if bandwidthLimit is None else RateLimiter(bandwidthLimit)
+        self.log = logging.getLogger('mountload.downloader')
+
+        # Controllers with their own SSH connection for striped downloads, created when first needed
+        self.numberOfStripes = numberOfStripes
+        self.stripeThreshold = stripeThreshold
+        self.stripingLock = Lock()
+        self.stripeControllers = []
+
+        # Work distribution state, protected by the condition
+        self.condition = Condition()
+        self.queuedPaths = []
+        self.pathIdsInProgress = set()
+        self.lastPathId = 0
+        self.foundPathsInPass = False
+        self.numberOfRunningThreads = 0
+
+        # Number of failed attempts by path ID, and the paths we gave up on by path ID
+        self.failures = Counter()
+        self.failedPaths = {}
+
+        self.stopEvent = Event()
+        self.threads = []
+
+    def _chunkReceived(self, chunkSize):
+        # Abort instead of waiting for the foreground, since a FUSE read might be waiting for this very download; that
+        # includes waiting for the rate limiter
+        if self.rateLimiter is not None:
+            return self.rateLimiter.consume(chunkSize, self._isInterrupted) and not self._isInterrupted()
+        return not self._isInterrupted()
+
+    def _closeStripeControllers(self):
+        for controller in self.stripeControllers:
+            controller.close()
+            controller.source.close()
+        self.stripeControllers = []
+
+    def _downloadFile(self, controller, pathInfo):
+        if (self.numberOfStripes > 1) and (self.stripeThreshold is not None) and \
+                (pathInfo['size'] >= self.stripeThreshold):
+            self._downloadStriped(pathInfo)
+
+        # Download whatever is left, and find out whether the file is complete
+        while not self.stopEvent.is_set():
+            self.pool.waitUntilIdle(self.stopEvent)
+            if controller.downloadNextSegment(pathInfo, BackgroundDownloader.segmentSize, self._chunkReceived) == 0:
+                break
+
+    def _downloadStriped(self, pathInfo):
+        """Downloads a file over the stripe controllers, unless another thread is using them already"""
+        if not self.stripingLock.acquire(blocking=False):
+            return
+        try:
+            self.pool.waitUntilIdle(self.stopEvent)
+            if len(self.stripeControllers) == 0:
+                self.stripeControllers = [self.pool.createController(source=self.pool.createSource(1, 1))
+                                          for _ in range(self.numberOfStripes)]
+            StripedDownload(self.stripeControllers, pathInfo, self._chunkReceived).run()
+        except:
+            # Their connections may be broken, so start over with new ones next time
+            self._closeStripeControllers()
+            raise
+        finally:
+            self.stripingLock.release()
+
+    def _isInterrupted(self):
+        return self.stopEvent.is_set() or self.pool.isBusy()
+
+    def _nextPath(self, controller):
+        """Returns the next unsynced path to process, or None if everything has been downloaded"""
+        with self.condition:
+            while not self.stopEvent.is_set():
+                if len(self.queuedPaths) > 0:
+                    pathInfo = self.queuedPaths.pop(0)
+                    self.pathIdsInProgress.add(pathInfo['pathId'])
+                    return pathInfo
+
+                # Fetch the next batch of unsynced paths, skipping paths other threads are working on
+                batch = controller.getUnsyncedPaths(self.lastPathId, BackgroundDownloader.scanBatchSize)
+                if len(batch) > 0:
+                    self.lastPathId = batch[-1]['pathId']
+                    if self.pathFilter is not None:
+                        batch = [p for p in batch if self.pathFilter(p)]
+                    # Paths other threads are working on don't warrant another pass; finishing them does
+                    self.queuedPaths = [p for p in batch
+                                        if (p['pathId'] not in self.pathIdsInProgress) and (p['pathId'] not in self.failedPaths)]
+                    self.foundPathsInPass = self.foundPathsInPass or (len(self.queuedPaths) > 0)
+                    continue
+
+                # We reached the end of the path table; start a new pass if this one found anything
+                if self.foundPathsInPass:
+                    self.lastPathId = 0
+                    self.foundPathsInPass = False
+                    continue
+
+                # Nothing left to queue; wait for the other threads since they can discover new paths
+                if len(self.pathIdsInProgress) == 0:
+                    self.numberOfRunningThreads -= 1
+                    self.condition.notify_all()
+                    return None
+                self.condition.wait()
+        return None
+
+    def _processPath(self, controller, pathInfo):
+        if pathInfo['type'] == 'directory':
+            self.pool.waitUntilIdle(self.stopEvent)
+            controller.getEntriesInDirectory(controller.getPathForInfo(pathInfo))
+        elif pathInfo['type'] == 'file':
+            self._downloadFile(controller, pathInfo)
+
+    def _pathFailed(self, controller, pathInfo):
+        """Counts a failed attempt at a path; returns whether it may be tried again"""
+        pathId = pathInfo['pathId']
+        with self.condition:
+            self.failures[pathId] += 1
+            if self.failures[pathId] < BackgroundDownloader.maximumAttempts:
+                return True
+            del self.failures[pathId]
+            self.failedPaths[pathId] = controller.getPathForInfo(pathInfo)
+        self.log.error('Giving up on %s after %d failed attempts', self.failedPaths[pathId], BackgroundDownloader.maximumAttempts)
+        return False
+
+    def getFailedPaths(self):
+        """Returns the sorted paths that were given up on"""
+        with self.condition:
+            return sorted(self.failedPaths.values())
+
+    def _run(self):
+        controller = None
+        while not self.stopEvent.is_set():
+            try:
+                if controller is None:
+                    controller = self.pool.createController()
+
+                pathInfo = self._nextPath(controller)
+                if pathInfo is None:
+                    break
+                warrantsNewPass = True
+                try:
+                    self._processPath(controller, pathInfo)
+                except Exception:
+                    warrantsNewPass = self._pathFailed(controller, pathInfo)
+                    raise
+                finally:
+                    # Finishing a path can reveal new paths, and a failed path is tried again in the next pass
+                    with self.condition:
+                        self.pathIdsInProgress.discard(pathInfo['pathId'])
+                        self.foundPathsInPass = self.foundPathsInPass or warrantsNewPass
+                        self.condition.notify_all()
+            except Exception:
+                # Discard the controller since its connection may be broken, and retry later
+                self.log.exception('Background download failed; retrying in %d seconds', BackgroundDownloader.retryInterval)
+                if controller is not None:
+                    controller.close()
+                    controller = None
+                self.stopEvent.wait(BackgroundDownloader.retryInterval)
+
+        if controller is not None:
+            controller.close()
+
+    def resume(self):
+        """Makes the threads look for unsynced paths again, restarting them if they finished because everything was synced"""
+        with self.condition:
+            if self.stopEvent.is_set():
+                return
+            self.foundPathsInPass = True
+            self.condition.notify_all()
+            if self.numberOfRunningThreads > 0:
+                return
+            self.lastPathId = 0
+            self.start()
+
+    def start(self):
+        with self.condition:
+            self.numberOfRunningThreads += self.numberOfThreads
+        self.threads = [thread for thread in self.threads if thread.is_alive()]
+        for _ in range(self.numberOfThreads):
+            thread = Thread(target=self._run, name='mountload-downloader', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopEvent.set()
+        with self.condition:
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        with self.stripingLock:
+            self._closeStripeControllers()
+
+    def wait(self):
+        """Waits until the threads finish, which they do once everything has been downloaded or the downloader is stopped"""
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,68 @@
+# Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
+# See the file LICENSE.txt for copying permission.
+
+from threading import Event, Lock
+
+class Fetch:
+    """A range [begin, end] of a file that is being downloaded by a single thread"""
+
+    def __init__(self, begin, end):
+        self.begin = begin
+        self.end = end
+        self.finishedEvent = Event()
+
+        # Raised by the IOScheduler when a more urgent thread waits for this download
+        self.priorityClass = None
+
+    def wait(self):
+        """Blocks until the download has finished; it may have failed or been aborted, so recheck the remote segments"""
+        self.finishedEvent.wait()
+
+class FetchRegistry:
+    """
+    Thread-safe registry of the ranges that are being downloaded by path ID.
+    Threads claim a range before downloading it, so concurrent readers of the
+    same data wait for the download in progress instead of fetching it twice.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.fetches = {}
+
+    def claim(self, pathId, begin, end):
+        """
+        Splits the range [begin, end] into ascending (begin, end, fetch, isOwner)
+        parts. Parts that were not being downloaded yet are registered for the
+        caller, who must download them and call finish(); the other parts refer
+        to the fetches of other threads.
+        """
+        with self.lock:
+            fetches = self.fetches.setdefault(pathId, [])
+            overlapping = sorted((f for f in fetches if (f.end >= begin) and (f.begin <= end)), key=lambda f: f.begin)
+
+            parts = []
+            position = begin
+            for fetch in overlapping:
+                if fetch.begin > position:
+                    parts.append(self._register(fetches, position, fetch.begin - 1))
+                parts.append((max(position, fetch.begin), min(end, fetch.end), fetch, False))
+                position = fetch.end + 1
+            if position <= end:
+                parts.append(self._register(fetches, position, end))
+            return parts
+
+    def finish(self, pathId, fetch):
+        """Unregisters a claimed fetch and wakes up the threads waiting for it; finishing twice is harmless"""
+        with self.lock:
+            fetches = self.fetches.get(pathId)
+            if (fetches is not None) and (fetch in fetches):
+                fetches.remove(fetch)
+                if len(fetches) == 0:
+                    del self.fetches[pathId]
+        fetch.finishedEvent.set()
+
+    @staticmethod
+    def _register(fetches, begin, end):
+        fetch = Fetch(begin, end)
+        fetches.append(fetch)
+        return (begin, end, fetch, True)
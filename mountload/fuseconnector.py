@@ -3,11 +3,37 @@
 
 from errno import ENOENT
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
+from itertools import count
+import json
 import logging
+from mountload.stats import statistics
+import os
+import stat
+import time
 
 class FUSEConnector(LoggingMixIn, Operations):
-    def __init__(self, controllerPool, isDebugMode):
+    maximumReadSize = 128 * 1024
+
+    # Virtual control files in the root of the mount that return the statistics and the sync progress as JSON
+    statisticsPath = '/.mountload-stats'
+    statusPath = '/.mountload-status'
+
+    def __init__(self, controllerPool, isDebugMode, backgroundTasks=(), useKernelCache=True, filesCanChange=False):
         self.pool = controllerPool
+        self.isDebugMode = isDebugMode
+        self.backgroundTasks = backgroundTasks
+        self.useKernelCache = useKernelCache
+
+        # Synced files may be reset when they change at the source, which local file descriptors and the kernel's page
+        # cache would not notice; in that case all reads go through the controllers
+        self.filesCanChange = filesCanChange
+
+        # Local file descriptors of synced files by FUSE file handle; reads on these bypass the controllers
+        self.localFiles = {}
+        self.fileHandles = count(1)
+
+        # Snapshots by FUSE file handle of opened control files
+        self.controlFiles = {}
 
         # Setup logger
         loglevel = logging.DEBUG if isDebugMode else logging.WARNING
@@ -17,28 +43,108 @@ class FUSEConnector(LoggingMixIn, Operations):
         sh.setLevel(loglevel)
         self.log.addHandler(sh)
 
+    def __call__(self, op, *args):
+        # LoggingMixIn formats the arguments and results of every operation, so we only use it in debug mode
+        startTime = time.monotonic()
+        try:
+            if self.isDebugMode:
+                return LoggingMixIn.__call__(self, op, *args)
+            return Operations.__call__(self, op, *args)
+        except OSError:
+            statistics.increment('fuse.%s.errors' % op)
+            raise
+        finally:
+            statistics.record('fuse.' + op, time.monotonic() - startTime)
+
     def destroy(self, path):
+        for task in self.backgroundTasks:
+            task.stop()
         self.pool.close()
 
     def getattr(self, path, fh=None):
+        if path in (FUSEConnector.statisticsPath, FUSEConnector.statusPath):
+            now = time.time()
+            return {'st_mode': stat.S_IFREG | 0o444, 'st_nlink': 1, 'st_size': 0, 'st_uid': os.getuid(),
+                    'st_gid': os.getgid(), 'st_atime': now, 'st_mtime': now}
         with self.pool.acquire() as controller:
             attr = controller.getStatForPath(path)
         if attr is None:
             raise FuseOSError(ENOENT)
         return attr
 
-    def read(self, path, size, offset, fh):
+    def init(self, path):
+        for task in self.backgroundTasks:
+            task.start()
+
+    def open(self, path, fi):
+        # Control files have no known size, so their reads need to bypass the page cache
+        if path in (FUSEConnector.statisticsPath, FUSEConnector.statusPath):
+            fh = next(self.fileHandles)
+            self.controlFiles[fh] = self._readControlFile(path).encode()
+            fi.fh = fh
+            fi.direct_io = 1
+            return 0
+
+        with self.pool.acquire() as controller:
+            fd = controller.openFile(path, allowLocal=not self.filesCanChange)
+        if fd is None:
+            fi.fh = 0
+            fi.keep_cache = 0
+            return 0
+
+        # Synced files will never change, so the kernel can keep their pages cached between opens
+        fh = next(self.fileHandles)
+        self.localFiles[fh] = fd
+        fi.fh = fh
+        fi.keep_cache = 1 if self.useKernelCache else 0
+        return 0
+
+    def read(self, path, size, offset, fi):
+        fd = self.localFiles.get(fi.fh)
+        if fd is not None:
+            data = os.pread(fd, size, offset)
+            statistics.increment('read.localBytes', len(data))
+            return data
+        if fi.fh in self.controlFiles:
+            return self.controlFiles[fi.fh][offset:offset + size]
         with self.pool.acquire() as controller:
             return controller.readData(path, offset, size)
 
+    def _readControlFile(self, path):
+        if path == FUSEConnector.statisticsPath:
+            return statistics.toJSON()
+        with self.pool.acquire() as controller:
+            return json.dumps(controller.getProgress(), indent=2, sort_keys=True) + '\n'
+
     def readdir(self, path, fh):
+        # The kernel still looks up every entry separately; listing the directory primes the path and stat caches
+        # those lookups are answered from. The attributes only tell libfuse the type of each entry.
         with self.pool.acquire() as controller:
-            return ['.', '..'] + [entry['basename'] for entry in controller.getEntriesInDirectory(path)]
+            return ['.', '..'] + [(basename, stat, 0) for basename, stat in controller.getStatsInDirectory(path)]
 
     def readlink(self, path):
         with self.pool.acquire() as controller:
             return controller.getSymlinkTarget(path)
 
-    def startFUSE(self, mountpoint, isMultiThreaded):
-        """Starts FUSE using itself as the connector"""
-        FUSE(self, mountpoint, foreground=True, nothreads=not isMultiThreaded)
+    def release(self, path, fi):
+        fd = self.localFiles.pop(fi.fh, None)
+        if fd is not None:
+            os.close(fd)
+            return 0
+        if self.controlFiles.pop(fi.fh, None) is not None:
+            return 0
+        with self.pool.acquire() as controller:
+            controller.releaseFile(path)
+        return 0
+
+    def startFUSE(self, mountpoint, isMultiThreaded, fuseOptions=None):
+        """Starts FUSE using itself as the connector; fuseOptions are passed on as mount options"""
+        options = {'ro': True}
+        if self.useKernelCache:
+            # Request large reads and read-ahead so the kernel bothers us less often
+            options.update({'big_writes': True, 'max_read': FUSEConnector.maximumReadSize,
+                            'max_readahead': FUSEConnector.maximumReadSize})
+        options.update(fuseOptions or {})
+
+        # We need raw_fi to control keep_cache per opened file
+        FUSE(self, mountpoint, raw_fi=True, foreground=True, nothreads=not isMultiThreaded, **options)
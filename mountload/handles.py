@@ -0,0 +1,104 @@
+# Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
+# See the file LICENSE.txt for copying permission.
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+import time
+
+class HandleCacheEntry:
+    def __init__(self, handle):
+        self.handle = handle
+        self.numberOfUsers = 0
+        self.lastUsed = time.monotonic()
+        self.isDiscarded = False
+
+class HandleCache:
+    """
+    Thread-safe LRU cache of open handles by path. Handles are opened on first
+    use and closed when they have been idle for idleTimeout seconds or when the
+    cache exceeds its capacity. Handles that are in use are never closed, and
+    pinned paths (e.g. opened through FUSE) are not closed for being idle.
+    """
+
+    def __init__(self, opener, closer, capacity, idleTimeout, isPinned=None):
+        self.opener = opener
+        self.closer = closer
+        self.capacity = capacity
+        self.idleTimeout = idleTimeout
+        self.isPinned = (lambda path: False) if isPinned is None else isPinned
+
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.lastSweep = time.monotonic()
+
+    @contextmanager
+    def acquire(self, path):
+        """Yields the open handle for a path, opening it if necessary"""
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                self.entries.move_to_end(path)
+                entry.numberOfUsers += 1
+        if entry is None:
+            entry = HandleCacheEntry(self.opener(path))
+            entry.numberOfUsers = 1
+            with self.lock:
+                # Another thread may have opened the same path in the meantime; keep both until ours is released
+                if path in self.entries:
+                    entry.isDiscarded = True
+                else:
+                    self.entries[path] = entry
+
+        try:
+            yield entry.handle
+        finally:
+            with self.lock:
+                entry.numberOfUsers -= 1
+                entry.lastUsed = time.monotonic()
+                toClose = self._collect()
+                if entry.isDiscarded and entry.numberOfUsers == 0:
+                    toClose.append(entry)
+            self._close(toClose)
+
+    def close(self):
+        with self.lock:
+            toClose = list(self.entries.values())
+            self.entries.clear()
+        self._close(toClose)
+
+    def _close(self, entries):
+        for entry in entries:
+            self.closer(entry.handle)
+
+    def _collect(self):
+        """Removes and returns the unused entries that exceed capacity or have been idle for too long"""
+        toClose = []
+        now = time.monotonic()
+        isSweepDue = now - self.lastSweep >= self.idleTimeout / 2
+        if isSweepDue:
+            self.lastSweep = now
+        excess = len(self.entries) - self.capacity
+        if (excess <= 0) and not isSweepDue:
+            return toClose
+
+        for path, entry in list(self.entries.items()):
+            if entry.numberOfUsers > 0:
+                continue
+            isIdle = (now - entry.lastUsed >= self.idleTimeout) and not self.isPinned(path)
+            if (excess > 0) or isIdle:
+                del self.entries[path]
+                toClose.append(entry)
+                excess -= 1
+        return toClose
+
+    def discard(self, path):
+        """Closes the handle for a path as soon as it is no longer in use"""
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is None:
+                return
+            if entry.numberOfUsers > 0:
+                entry.isDiscarded = True
+                return
+        self._close([entry])
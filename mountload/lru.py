@@ -0,0 +1,38 @@
+# Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
+# See the file LICENSE.txt for copying permission.
+
+from collections import OrderedDict
+from threading import Lock
+
+class LRUCache:
+    """Thread-safe mapping that evicts its least recently used entries beyond a fixed capacity"""
+    missing = object()
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.lock = Lock()
+        self.entries = OrderedDict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get(self, key, default=None):
+        """Returns the value for a key, or default if it is not cached; use LRUCache.missing to cache None values"""
+        with self.lock:
+            value = self.entries.get(key, LRUCache.missing)
+            if value is not LRUCache.missing:
+                self.entries.move_to_end(key)
+                return value
+        return default
+
+    def pop(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
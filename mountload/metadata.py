@@ -1,130 +1,629 @@
 # Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
 # See the file LICENSE.txt for copying permission.
 
+from contextlib import contextmanager
+import logging
+from mountload.lru import LRUCache
+from mountload.segments import RemoteSegmentCache
+from mountload.stats import statistics
 import sqlite3
+from threading import Condition, Lock, RLock, Thread, local
+import time
 
 class MountLoadMetaData:
-    metaDataVersion = 1
+    """
+    Metadata database shared by all controllers. The database runs in WAL mode
+    so reads are served concurrently from a pool of read connections, while all
+    writes go through a single write connection. Remote segment changes and the
+    resulting synced flags are group committed by a writer thread. If given,
+    syncData is called before each group commit to make the downloaded data
+    durable, so the remote segments never claim data that could still be lost.
 
-    def __init__(self, dbpath):
-        self.conn = sqlite3.connect(database=dbpath, check_same_thread=False, isolation_level=None)
-        self.conn.row_factory = sqlite3.Row
-        self.transactionDepth = 0
+    Paths are stored as (parentId, name) rows; the root has no parent. Rows
+    are returned as dicts that also hold the full path. The IDs and paths of
+    directories never change, so they are cached to resolve paths without
+    walking the tree in the database every time.
+
+    The progress table holds aggregate counters of the sync progress, which are
+    updated in the same transactions as the paths and remote segments they
+    describe. A copy is kept in memory, so progress checks never scan tables.
+    """
+    metaDataVersion = 3
+    progressCounters = ['totalBytes', 'downloadedBytes', 'filesPending', 'directoriesUnlisted']
+    flushInterval = 0.5
+    pathCacheCapacity = 65536
+    directoryCacheCapacity = 65536
+
+    def __init__(self, dbpath, syncData=None):
+        self.dbpath = dbpath
+        self.syncData = syncData
+        self.log = logging.getLogger('mountload.metadata')
+        self.conn = self._connect()
+        self.conn.execute('PRAGMA journal_mode = WAL')
+
+        # Transactions are owned by a single thread at a time
+        self.writeLock = RLock()
+        self.threadState = local()
+
+        # Idle read connections
+        self.readConnectionsLock = Lock()
+        self.readConnections = []
+
+        # Protects the writer state and the path cache generation
+        self.writerCondition = Condition()
+
+        # Remote segments are kept in memory; paths that have been fully downloaded are marked synced by the writer and
+        # stay pending until that has been committed
+        self.segmentCache = RemoteSegmentCache()
+        self.pendingSyncedPathIds = set()
+        self.flushLock = Lock()
+
+        # Path rows by path, including None for paths that do not exist. Entries are invalidated after the transaction
+        # changing them commits; the generation prevents readers from caching rows they read before that.
+        self.pathCache = LRUCache(MountLoadMetaData.pathCacheCapacity)
+        self.pathCacheGeneration = 0
+
+        # Directory IDs by path and paths by directory ID; only committed directories are cached, since IDs of rolled
+        # back rows can be reused
+        self.directoryIds = LRUCache(MountLoadMetaData.directoryCacheCapacity)
+        self.directoryPaths = LRUCache(MountLoadMetaData.directoryCacheCapacity)
+
+        # Committed progress counters and the listeners to call once everything has been synced
+        self.progressLock = Lock()
+        self.progress = dict((name, 0) for name in MountLoadMetaData.progressCounters)
+        self.completionListeners = []
 
         # Check whether the config table exists
-        c = self.conn.execute('SELECT 1 FROM sqlite_master WHERE type = \'table\' AND name = \'config\'')
-        if not c.fetchone():
+        if not self._fetchOne('SELECT 1 FROM sqlite_master WHERE type = \'table\' AND name = \'config\''):
             self._createEmptyDB()
-            return
+        else:
+            # Check whether we need to upgrade the metadata database
+            version = self.getConfigInteger('version')
+            if version is None:
+                raise RuntimeError('Corrupted metadata configuration')
+            elif version < MountLoadMetaData.metaDataVersion:
+                self._upgradeDB(version)
+        self.progress = dict((row['name'], row['value']) for row in self._fetchAll('SELECT name, value FROM progress'))
 
-        # Check whether we need to upgrade the metadata database
-        version = self.getConfigInteger('version')
-        if version is None:
-            raise RuntimeError('Corrupted metadata configuration')
-        elif version < MountLoadMetaData.metaDataVersion:
-            self._upgradeDB(version)
+        # Start the writer thread
+        self.isClosing = False
+        self.writerThread = Thread(target=self._runWriter, name='mountload-metadata-writer', daemon=True)
+        self.writerThread.start()
 
-    def addPath(self, dirname, basename, pathType, size, mode, atime, mtime, isSynced):
-        c = self.conn.cursor()
-        c.execute('INSERT INTO path (dirname, basename, type, size, mode, atime, mtime, isSynced) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (dirname, basename, pathType, size, mode, atime, mtime, isSynced))
-        return c.lastrowid
+    def addPaths(self, directoryPath, paths):
+        """
+        Bulk inserts (name, type, size, mode, atime, mtime, isSynced) rows into
+        a directory, or registers the root if directoryPath is None. Every
+        unsynced file gets a remote segment spanning the entire file.
+        """
+        with self._transaction():
+            parentId = None if directoryPath is None else self._getDirectoryId(directoryPath)
+            if (directoryPath is not None) and (parentId is None):
+                raise RuntimeError('Unknown directory %s' % directoryPath)
+
+            c = self.conn.cursor()
+            c.executemany('INSERT INTO path (parentId, name, type, size, mode, atime, mtime, isSynced) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                          [(parentId,) + tuple(path) for path in paths])
+            c.executemany('INSERT INTO remoteSegment (path, begin, end) SELECT pathId, 0, size - 1 FROM path WHERE parentId = ? AND name = ?',
+                          [(parentId, path[0]) for path in paths if (path[1] == 'file') and not path[6]])
+            for name, pathType, size, mode, atime, mtime, isSynced in paths:
+                self._invalidatePath('/' if directoryPath is None else MountLoadMetaData._joinPath(directoryPath, name))
+                if pathType == 'file':
+                    self._changeProgress('totalBytes', size)
+                    self._changeProgress('downloadedBytes' if isSynced else 'filesPending', size if isSynced else 1)
+                elif (pathType == 'directory') and not isSynced:
+                    self._changeProgress('directoriesUnlisted', 1)
 
-    def addRemoteSegment(self, pathId, begin, end):
-        self.conn.execute('INSERT INTO remoteSegment (path, begin, end) VALUES (?, ?, ?)', (pathId, begin, end))
+    def addCompletionListener(self, listener):
+        """
+        Registers a callable that is called without arguments once all known
+        paths have been synced. It runs on the thread that committed the last
+        change, so it should return quickly.
+        """
+        self.completionListeners.append(listener)
 
     def begin(self):
-        if self.transactionDepth == 0:
-            self.conn.execute('BEGIN IMMEDIATE')
-        self.transactionDepth += 1
+        if self._getTransactionDepth() == 0:
+            startTime = time.monotonic()
+            self.writeLock.acquire()
+            try:
+                self.conn.execute('BEGIN IMMEDIATE')
+            except:
+                self.writeLock.release()
+                raise
+            self.threadState.transactionStartTime = time.monotonic()
+            statistics.record('sqlite.lockWait', self.threadState.transactionStartTime - startTime)
+        if self._getTransactionDepth() == 0:
+            self.threadState.invalidatedPaths = []
+            self.threadState.progressChanges = {}
+        self.threadState.transactionDepth = self._getTransactionDepth() + 1
 
     def close(self):
-        if self.transactionDepth > 0:
+        if self._getTransactionDepth() > 0:
             self.rollback()
+
+        # Stop the writer thread, which flushes all remaining changes
+        with self.writerCondition:
+            self.isClosing = True
+            self.writerCondition.notify()
+        self.writerThread.join()
+
         self.conn.close()
+        with self.readConnectionsLock:
+            for conn in self.readConnections:
+                conn.close()
+            self.readConnections = []
 
     def commit(self):
-        if self.transactionDepth == 0:
+        depth = self._getTransactionDepth()
+        if depth == 0:
             raise RuntimeError('No transaction started')
-        self.transactionDepth -= 1
-        if self.transactionDepth == 0:
-            self.conn.execute('COMMIT')
+        self.threadState.transactionDepth = depth - 1
+        if depth == 1:
+            progressChanges = self.threadState.progressChanges
+            self.threadState.progressChanges = {}
+            try:
+                self.conn.executemany('UPDATE progress SET value = value + ? WHERE name = ?',
+                                      [(change, name) for name, change in progressChanges.items() if change != 0])
+                self.conn.execute('COMMIT')
+            except:
+                self.pathCache.clear()
+                raise
+            finally:
+                self.writeLock.release()
+            statistics.record('sqlite.transaction', time.monotonic() - self.threadState.transactionStartTime)
+            self._applyInvalidations()
+            self._applyProgressChanges(progressChanges)
+
+    def _connect(self):
+        conn = sqlite3.connect(database=self.dbpath, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+
+        # With WAL, NORMAL only syncs on checkpoints while still guaranteeing consistency
+        conn.execute('PRAGMA synchronous = NORMAL')
+        return conn
 
     def _createEmptyDB(self):
         # Create tables
+        self.begin()
         c = self.conn.cursor()
         c.execute('CREATE TABLE config (name TEXT PRIMARY KEY, value TEXT)')
-        c.execute('CREATE TABLE path (pathId INTEGER PRIMARY KEY, dirname TEXT, basename TEXT, type TEXT, size INTEGER, mode INTEGER, atime INTEGER, mtime INTEGER, isSynced INTEGER, UNIQUE (dirname, basename))')
+        self._createPathTable('path')
         c.execute('CREATE TABLE remoteSegment (remoteSegmentId INTEGER PRIMARY KEY, path INTEGER, begin INTEGER, end INTEGER, FOREIGN KEY (path) REFERENCES path (pathId))')
         c.execute('CREATE INDEX remoteSegment_path_idx ON remoteSegment (path)')
+        self._createProgressTable()
 
         # Register current scheme version
         self.setConfig('version', MountLoadMetaData.metaDataVersion)
+        self.commit()
+
+    def _createPathTable(self, tableName):
+        # The unique index on (parentId, name) also serves listing the entries of a directory
+        self.conn.execute('CREATE TABLE %s (pathId INTEGER PRIMARY KEY, parentId INTEGER, name TEXT, type TEXT, size INTEGER, mode INTEGER, atime INTEGER, mtime INTEGER, isSynced INTEGER, UNIQUE (parentId, name), FOREIGN KEY (parentId) REFERENCES path (pathId))' % tableName)
+
+    def _createProgressTable(self):
+        c = self.conn.cursor()
+        c.execute('CREATE TABLE progress (name TEXT PRIMARY KEY, value INTEGER)')
+        c.executemany('INSERT INTO progress (name, value) VALUES (?, 0)',
+                      [(name,) for name in MountLoadMetaData.progressCounters])
+
+    def _fetchAll(self, sql, parameters=()):
+        with self._readConnection() as conn:
+            return conn.execute(sql, parameters).fetchall()
+
+    def _fetchOne(self, sql, parameters=()):
+        with self._readConnection() as conn:
+            return conn.execute(sql, parameters).fetchone()
 
     def getConfigInteger(self, name):
         v = self.getConfigString(name)
         return None if v is None else int(v)
 
     def getConfigString(self, name):
-        c = self.conn.cursor()
-        c.execute('SELECT value FROM config WHERE name = ?', (name,))
-        r = c.fetchone()
+        r = self._fetchOne('SELECT value FROM config WHERE name = ?', (name,))
         return None if r is None else r[0]
 
-    def getPath(self, dirname, basename):
-        return self.conn.execute('SELECT * FROM path WHERE dirname = ? AND basename = ?', (dirname, basename)).fetchone()
+    def _getDirectoryId(self, directoryPath):
+        """Resolves the ID of a directory component by component; the walk stops at the first cached ancestor"""
+        directoryId = self.directoryIds.get(directoryPath)
+        if directoryId is not None:
+            return directoryId
+
+        pathInfo = self.getPath(directoryPath)
+        if (pathInfo is None) or (pathInfo['type'] != 'directory'):
+            return None
+        if self._getTransactionDepth() == 0:
+            self.directoryIds.put(directoryPath, pathInfo['pathId'])
+            self.directoryPaths.put(pathInfo['pathId'], directoryPath)
+        return pathInfo['pathId']
+
+    def _getDirectoryPath(self, directoryId):
+        directoryPath = self.directoryPaths.get(directoryId)
+        if directoryPath is not None:
+            return directoryPath
+
+        row = self._fetchOne('SELECT parentId, name FROM path WHERE pathId = ?', (directoryId,))
+        if row is None:
+            raise RuntimeError('Unknown directory ID %d' % directoryId)
+        directoryPath = '/' if row['parentId'] is None else \
+            MountLoadMetaData._joinPath(self._getDirectoryPath(row['parentId']), row['name'])
+        if self._getTransactionDepth() == 0:
+            self.directoryPaths.put(directoryId, directoryPath)
+            self.directoryIds.put(directoryPath, directoryId)
+        return directoryPath
+
+    def getPath(self, path):
+        """Returns the row of a normalized absolute path, or None if it is not known"""
+        # Rows read inside a transaction may not be committed yet, so we only cache rows read outside of them
+        if self._getTransactionDepth() > 0:
+            return self._loadPath(path)
+
+        pathInfo = self.pathCache.get(path, LRUCache.missing)
+        if pathInfo is not LRUCache.missing:
+            return pathInfo
+        generation = self.pathCacheGeneration
+        pathInfo = self._loadPath(path)
+        with self.writerCondition:
+            if generation == self.pathCacheGeneration:
+                self.pathCache.put(path, pathInfo)
+        return pathInfo
+
+    def getProgress(self):
+        """
+        Returns the committed progress counters, plus whether all known paths
+        have been synced. Downloaded bytes lag behind by at most one flush.
+        """
+        with self.progressLock:
+            progress = dict(self.progress)
+        progress['isComplete'] = (progress['filesPending'] == 0) and (progress['directoriesUnlisted'] == 0)
+        return progress
+
+    def getSubtreeProgress(self, path):
+        """
+        Returns the same progress information as getProgress() for a path and
+        everything below it, or None if the path is unknown. Unlike
+        getProgress(), this scans the subtree.
+        """
+        pathInfo = self.getPath(path)
+        if pathInfo is None:
+            return None
+        subtree = 'WITH RECURSIVE subtree (pathId) AS (SELECT ? UNION ALL SELECT path.pathId FROM path JOIN subtree ON path.parentId = subtree.pathId) '
+        row = self._fetchOne(subtree + 'SELECT COALESCE(SUM(CASE WHEN type = \'file\' THEN size END), 0) AS totalBytes, COALESCE(SUM(type = \'file\' AND isSynced = 0), 0) AS filesPending, COALESCE(SUM(type = \'directory\' AND isSynced = 0), 0) AS directoriesUnlisted FROM path JOIN subtree USING (pathId)', (pathInfo['pathId'],))
+        remoteBytes = self._fetchOne(subtree + 'SELECT COALESCE(SUM(end - begin + 1), 0) FROM remoteSegment JOIN subtree ON remoteSegment.path = subtree.pathId', (pathInfo['pathId'],))[0]
+        progress = {'totalBytes': row['totalBytes'], 'downloadedBytes': row['totalBytes'] - remoteBytes,
+                    'filesPending': row['filesPending'], 'directoriesUnlisted': row['directoriesUnlisted']}
+        progress['isComplete'] = (progress['filesPending'] == 0) and (progress['directoriesUnlisted'] == 0)
+        return progress
 
     def getRemoteSegments(self, pathId):
-        return self.conn.execute('SELECT * FROM remoteSegment WHERE path = ?', (pathId,)).fetchall()
+        """Returns all remote segments of a path as ascending (begin, end) tuples"""
+        return self.segmentCache.get(pathId, self._loadRemoteSegments).getSegments()
 
     def getRemoteSegmentsRange(self, pathId, begin, end):
-        sql = '''
-            SELECT *
-            FROM remoteSegment
-            WHERE path = ?
-                AND begin <= ?
-                AND end >= ?
-            ORDER BY begin ASC
-        '''
-        return self.conn.execute(sql, (pathId, end, begin)).fetchall()
+        """Returns the remote segments of a path overlapping [begin, end] as ascending (begin, end) tuples"""
+        return self.segmentCache.get(pathId, self._loadRemoteSegments).getRange(begin, end)
+
+    def getSyncedDirectories(self, afterPathId, limit):
+        return self._toPathInfos(self._fetchAll('SELECT * FROM path WHERE type = \'directory\' AND isSynced = 1 AND pathId > ? ORDER BY pathId ASC LIMIT ?', (afterPathId, limit)))
+
+    def getUnsyncedDirectories(self):
+        return self._toPathInfos(self._fetchAll('SELECT * FROM path WHERE type = \'directory\' AND isSynced = 0 ORDER BY pathId ASC'))
+
+    def getUnsyncedPaths(self, afterPathId, limit):
+        """
+        Returns at most limit unsynced paths after afterPathId, skipping files
+        that only wait for the writer to mark them synced. An empty list means
+        there are no unsynced paths after afterPathId.
+        """
+        with self.writerCondition:
+            pendingSyncedPathIds = set(self.pendingSyncedPathIds)
+        while True:
+            rows = self._fetchAll('SELECT * FROM path WHERE isSynced = 0 AND pathId > ? ORDER BY pathId ASC LIMIT ?', (afterPathId, limit))
+            paths = [pathInfo for pathInfo in self._toPathInfos(rows) if pathInfo['pathId'] not in pendingSyncedPathIds]
+            if (len(paths) > 0) or (len(rows) < limit):
+                return paths
+            afterPathId = rows[-1]['pathId']
 
     def getSubPaths(self, directoryPath):
-        return self.conn.execute('SELECT * FROM path WHERE dirname = ? AND basename <> \'\'', (directoryPath,)).fetchall()
+        directoryId = self._getDirectoryId(directoryPath)
+        if directoryId is None:
+            return []
+        generation = self.pathCacheGeneration
+        pathInfos = [MountLoadMetaData._toPathInfo(row, MountLoadMetaData._joinPath(directoryPath, row['name']))
+                     for row in self._fetchAll('SELECT * FROM path WHERE parentId = ?', (directoryId,))]
+
+        # A directory listing is usually followed by a lookup of each entry, so prime the cache with the same rows
+        if self._getTransactionDepth() == 0:
+            with self.writerCondition:
+                if generation == self.pathCacheGeneration:
+                    for pathInfo in pathInfos:
+                        self.pathCache.put(pathInfo['path'], pathInfo)
+        return pathInfos
+
+    def flushRemoteSegments(self):
+        """
+        Writes the in-memory remote segments of all changed paths to the
+        database in a single transaction. The downloaded data is synced before
+        the write lock is taken, so other transactions don't wait for the disk.
+        """
+        with self.flushLock:
+            self._flushRemoteSegments()
+
+    def _flushRemoteSegments(self):
+        with self.writerCondition:
+            syncedPathIds = set(self.pendingSyncedPathIds)
+        if (len(syncedPathIds) == 0) and not self.segmentCache.hasDirty():
+            return
+
+        # Everything removed from the snapshot has been written to the target before, so syncing afterwards covers it
+        segmentsByPathId, removedBytes = self.segmentCache.takeDirty()
+        try:
+            if self.syncData is not None:
+                self.syncData()
+
+            self.begin()
+            c = self.conn.cursor()
+            for pathId, segments in segmentsByPathId.items():
+                # Files that were reset after the snapshot already have their new segments in the database
+                if not self.segmentCache.isFlushing(pathId):
+                    continue
+                c.execute('DELETE FROM remoteSegment WHERE path = ?', (pathId,))
+                c.executemany('INSERT INTO remoteSegment (path, begin, end) VALUES (?, ?, ?)',
+                              [(pathId, begin, end) for begin, end in segments])
+            self._changeProgress('downloadedBytes', removedBytes)
+
+            # Only files are synced here; files that were marked synced meanwhile are not counted twice, and files that
+            # were reset meanwhile have remote segments again
+            syncedPathIds = set(pathId for pathId in syncedPathIds if self.isFullyDownloaded(pathId))
+            c.executemany('UPDATE path SET isSynced = 1 WHERE pathId = ? AND isSynced = 0', [(pathId,) for pathId in syncedPathIds])
+            self._changeProgress('filesPending', -max(0, c.rowcount))
+            for pathId in syncedPathIds:
+                self._invalidatePathId(pathId)
+            self.commit()
+        except:
+            # Keep the changes in memory, so the next flush tries again
+            if self._getTransactionDepth() > 0:
+                self.rollback()
+            self.segmentCache.abortFlush(removedBytes)
+            raise
+        self.segmentCache.finishFlush()
+        with self.writerCondition:
+            self.pendingSyncedPathIds -= syncedPathIds
+
+    def _invalidatePath(self, path):
+        """Removes a path from the path cache once the current transaction commits"""
+        self.threadState.invalidatedPaths.append(path)
+
+    def _invalidatePathId(self, pathId):
+        row = self.conn.execute('SELECT parentId, name FROM path WHERE pathId = ?', (pathId,)).fetchone()
+        if row is not None:
+            self._invalidatePath(self._getPathForRow(row))
+
+    def isFullyDownloaded(self, pathId):
+        return self.segmentCache.get(pathId, self._loadRemoteSegments).isEmpty()
+
+    def _applyProgressChanges(self, progressChanges):
+        if len(progressChanges) == 0:
+            return
+        with self.progressLock:
+            wasComplete = (self.progress['filesPending'] == 0) and (self.progress['directoriesUnlisted'] == 0)
+            for name, change in progressChanges.items():
+                self.progress[name] += change
+            isComplete = (self.progress['filesPending'] == 0) and (self.progress['directoriesUnlisted'] == 0)
+        if isComplete and not wasComplete:
+            for listener in self.completionListeners:
+                listener()
+
+    def _applyInvalidations(self):
+        invalidatedPaths = self.threadState.invalidatedPaths
+        self.threadState.invalidatedPaths = []
+        if len(invalidatedPaths) == 0:
+            return
+        with self.writerCondition:
+            self.pathCacheGeneration += 1
+            for path in invalidatedPaths:
+                self.pathCache.pop(path)
+
+    def _changeProgress(self, name, change):
+        """Adds to a progress counter once the current transaction commits"""
+        self.threadState.progressChanges[name] = self.threadState.progressChanges.get(name, 0) + change
+
+    def _getTransactionDepth(self):
+        return getattr(self.threadState, 'transactionDepth', 0)
+
+    def _getPathForRow(self, row):
+        if row['parentId'] is None:
+            return '/'
+        return MountLoadMetaData._joinPath(self._getDirectoryPath(row['parentId']), row['name'])
+
+    @staticmethod
+    def _joinPath(directoryPath, name):
+        return directoryPath + name if directoryPath == '/' else directoryPath + '/' + name
+
+    def _loadPath(self, path):
+        if path == '/':
+            row = self._fetchOne('SELECT * FROM path WHERE parentId IS NULL')
+        else:
+            directoryPath, name = path.rsplit('/', 1)
+            parentId = self._getDirectoryId(directoryPath or '/')
+            if parentId is None:
+                return None
+            row = self._fetchOne('SELECT * FROM path WHERE parentId = ? AND name = ?', (parentId, name))
+        return None if row is None else MountLoadMetaData._toPathInfo(row, path)
+
+    def _loadRemoteSegments(self, pathId):
+        # Rows can not be compared, and the segment set sorts what we return
+        return [(row['begin'], row['end']) for row in self._fetchAll('SELECT begin, end FROM remoteSegment WHERE path = ?', (pathId,))]
+
+    @contextmanager
+    def _readConnection(self):
+        """Borrows a read connection; threads inside a transaction use the write connection to see their own changes"""
+        if self._getTransactionDepth() > 0:
+            yield self.conn
+            return
+
+        with self.readConnectionsLock:
+            conn = self.readConnections.pop() if len(self.readConnections) > 0 else None
+        if conn is None:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            with self.readConnectionsLock:
+                self.readConnections.append(conn)
+
+    def markDownloaded(self, pathId):
+        """Marks a file of which all remote segments have been removed as synced with the next flush"""
+        with self.writerCondition:
+            self.pendingSyncedPathIds.add(pathId)
 
     def removeRemoteSegments(self, pathId, begin, end):
-        self.begin()
-        c = self.conn.cursor()
-        for segment in self.getRemoteSegmentsRange(pathId, begin, end):
-            segId = segment['remoteSegmentId']
-            if (segment['begin'] >= begin) and (segment['end'] <= end):
-                # Segment is contained by region to delete
-                c.execute('DELETE FROM remoteSegment WHERE remoteSegmentId = ?', (segId,))
-            elif (begin > segment['begin']) and (end < segment['end']):
-                # Segment contains region to delete, so split it
-                c.execute('UPDATE remoteSegment SET end = ? WHERE remoteSegmentId = ?', (begin - 1, segId))
-                self.addRemoteSegment(pathId, end + 1, segment['end'])
-            elif (begin > segment['begin']) and (begin <= segment['end']):
-                # Segment ends with region to delete, so shorten it
-                c.execute('UPDATE remoteSegment SET end = ? WHERE remoteSegmentId = ?', (begin - 1, segId))
-            elif (end >= segment['begin']) and (end < segment['end']):
-                # Segment begins with region to delete, so shorten it
-                c.execute('UPDATE remoteSegment SET begin = ? WHERE remoteSegmentId = ?', (end + 1, segId))
-            else:
-                # Should never happen
-                raise RuntimeError('Invalid remote segment matched')
-        self.commit()
+        """
+        Removes the range [begin, end] from the remote segments of a path. The
+        change is applied in memory and group committed by the writer thread,
+        which also marks the path as synced once it has been fully downloaded.
+        Returns whether the path has been fully downloaded.
+        """
+        isEmpty = self.segmentCache.remove(pathId, begin, end, self._loadRemoteSegments)
+        with self.writerCondition:
+            if isEmpty:
+                self.pendingSyncedPathIds.add(pathId)
+            if self.segmentCache.isFlushDue():
+                self.writerCondition.notify()
+        return isEmpty
+
+    def resetFile(self, pathId, size, mode, atime, mtime):
+        """
+        Updates the attributes of a file that changed at the source and replaces
+        its remote segments by a single segment spanning the new size, so the
+        file is downloaded again. The caller must make sure nobody downloads
+        parts of the file meanwhile.
+        """
+        with self._transaction():
+            row = self.conn.execute('SELECT parentId, name, size, isSynced FROM path WHERE pathId = ?', (pathId,)).fetchone()
+            segments = [(0, size - 1)] if size > 0 else []
+            try:
+                # Readers see the new segments right away; the pending removals of the old ones are still flushed as
+                # downloaded bytes, so we subtract everything downloaded of the old file
+                remainingBytes = self.segmentCache.replace(pathId, segments, self._loadRemoteSegments)
+                with self.writerCondition:
+                    self.pendingSyncedPathIds.discard(pathId)
+
+                c = self.conn.cursor()
+                c.execute('DELETE FROM remoteSegment WHERE path = ?', (pathId,))
+                c.executemany('INSERT INTO remoteSegment (path, begin, end) VALUES (?, ?, ?)',
+                              [(pathId, begin, end) for begin, end in segments])
+                c.execute('UPDATE path SET size = ?, mode = ?, atime = ?, mtime = ?, isSynced = ? WHERE pathId = ?',
+                          (size, mode, atime, mtime, 1 if size == 0 else 0, pathId))
+            except:
+                self.segmentCache.invalidate(pathId)
+                raise
+            self._invalidatePath(self._getPathForRow(row))
+
+            self._changeProgress('totalBytes', size - row['size'])
+            self._changeProgress('downloadedBytes', remainingBytes - row['size'])
+            self._changeProgress('filesPending', (0 if size == 0 else 1) - (0 if row['isSynced'] else 1))
 
     def rollback(self):
-        if self.transactionDepth == 0:
+        if self._getTransactionDepth() == 0:
             raise RuntimeError('No active transaction')
-        self.conn.execute('ROLLBACK')
-        self.transactionDepth = 0
+        self.threadState.transactionDepth = 0
+        self.threadState.invalidatedPaths = []
+        self.threadState.progressChanges = {}
+        try:
+            self.conn.execute('ROLLBACK')
+        finally:
+            self.pathCache.clear()
+            self.writeLock.release()
+
+    def _runWriter(self):
+        isClosing = False
+        while not isClosing:
+            with self.writerCondition:
+                if not self.isClosing:
+                    self.writerCondition.wait(MountLoadMetaData.flushInterval)
+                isClosing = self.isClosing
+            try:
+                self.flushRemoteSegments()
+            except Exception:
+                self.log.exception('Failed to flush remote segments; retrying')
 
     def setConfig(self, name, value):
-        self.conn.execute('INSERT INTO config (name, value) VALUES (?, ?)', (name, value))
+        with self._transaction():
+            self.conn.execute('INSERT INTO config (name, value) VALUES (?, ?)', (name, value))
 
     def setPathSynced(self, pathId):
-        self.conn.execute('UPDATE path SET isSynced = 1 WHERE pathId = ?', (pathId,))
+        with self._transaction():
+            row = self.conn.execute('SELECT type, isSynced FROM path WHERE pathId = ?', (pathId,)).fetchone()
+            if (row is None) or row['isSynced']:
+                return
+            self.conn.execute('UPDATE path SET isSynced = 1 WHERE pathId = ?', (pathId,))
+            self._invalidatePathId(pathId)
+            if row['type'] == 'file':
+                self._changeProgress('filesPending', -1)
+            elif row['type'] == 'directory':
+                self._changeProgress('directoriesUnlisted', -1)
+
+    @staticmethod
+    def _toPathInfo(row, path):
+        pathInfo = dict(row)
+        pathInfo['path'] = path
+        return pathInfo
+
+    def _toPathInfos(self, rows):
+        return [MountLoadMetaData._toPathInfo(row, self._getPathForRow(row)) for row in rows]
+
+    @contextmanager
+    def _transaction(self):
+        self.begin()
+        try:
+            yield
+        except:
+            self.rollback()
+            raise
+        self.commit()
 
     def _upgradeDB(self, fromVersion):
-        raise NotImplementedError('No upgrade paths available yet')
+        self.begin()
+        try:
+            if fromVersion < 2:
+                # Initialize the progress counters by scanning the tables one last time
+                self._createProgressTable()
+                row = self.conn.execute('SELECT COALESCE(SUM(size), 0) AS totalBytes, COALESCE(SUM(isSynced = 0), 0) AS filesPending FROM path WHERE type = \'file\'').fetchone()
+                remoteBytes = self.conn.execute('SELECT COALESCE(SUM(end - begin + 1), 0) FROM remoteSegment').fetchone()[0]
+                directoriesUnlisted = self.conn.execute('SELECT COUNT(*) FROM path WHERE type = \'directory\' AND isSynced = 0').fetchone()[0]
+                self._changeProgress('totalBytes', row['totalBytes'])
+                self._changeProgress('downloadedBytes', row['totalBytes'] - remoteBytes)
+                self._changeProgress('filesPending', row['filesPending'])
+                self._changeProgress('directoriesUnlisted', directoriesUnlisted)
+            if fromVersion < 3:
+                self._upgradePathTable()
+            self.conn.execute('UPDATE config SET value = ? WHERE name = \'version\'', (MountLoadMetaData.metaDataVersion,))
+        except:
+            self.rollback()
+            raise
+        self.commit()
+
+        # Give the space of the old path table back to the filesystem
+        if fromVersion < 3:
+            self.conn.execute('VACUUM')
+
+    def _upgradePathTable(self):
+        """Converts (dirname, basename) path rows to (parentId, name) rows, keeping all path IDs"""
+        c = self.conn.cursor()
+        c.execute('CREATE TEMPORARY TABLE directory (pathId INTEGER, path TEXT PRIMARY KEY)')
+        c.execute('INSERT INTO directory (pathId, path) SELECT pathId, dirname || basename FROM path WHERE type = \'directory\'')
+        self._createPathTable('newPath')
+        c.execute('INSERT INTO newPath (pathId, parentId, name, type, size, mode, atime, mtime, isSynced) '
+                  'SELECT pathId, NULL, \'\', type, size, mode, atime, mtime, isSynced FROM path WHERE basename = \'\'')
+
+        # The parent of an entry in dirname '/a/b/' is the directory with path '/a/b'
+        c.execute('INSERT INTO newPath (pathId, parentId, name, type, size, mode, atime, mtime, isSynced) '
+                  'SELECT p.pathId, d.pathId, p.basename, p.type, p.size, p.mode, p.atime, p.mtime, p.isSynced FROM path p '
+                  'JOIN directory d ON d.path = CASE WHEN p.dirname = \'/\' THEN \'/\' ELSE substr(p.dirname, 1, length(p.dirname) - 1) END '
+                  'WHERE p.basename <> \'\'')
+        c.execute('DROP TABLE directory')
+        c.execute('DROP TABLE path')
+        c.execute('ALTER TABLE newPath RENAME TO path')
+        c.execute('DELETE FROM remoteSegment WHERE path NOT IN (SELECT pathId FROM path)')
 
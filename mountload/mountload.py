@@ -2,34 +2,98 @@
 # See the file LICENSE.txt for copying permission.
 
 from argparse import ArgumentParser
+from mountload.asyncsource import AsyncMountLoadSource
+from mountload.completion import CompletionHook
 from mountload.controller import ControllerPool
-from mountload.fuseconnector import FUSEConnector
+from mountload.crawler import MetaDataCrawler
+from mountload.downloader import BackgroundDownloader
+from mountload.revalidator import Revalidator
+from mountload.source import MountLoadSource
+from mountload.stats import StatisticsDumper
+from mountload.sync import Synchronizer
 from getpass import getpass
+import logging
+import sys
 
 class MountLoad:
     @staticmethod
-    def run():
-        """Handles command line parameters, configuration and sets up the mountload components"""
-
-        # Parse the command line arguments
-        parser = ArgumentParser(description='Mountload mounts a remote directory using SFTP and simultaneously downloads it to another target directory.')
-
+    def _createParser():
+        parser = ArgumentParser(description='Mountload mounts a remote directory using SFTP and simultaneously downloads it to another target directory. With --sync, it downloads the directory without mounting it and exits when done.')
         grp_ml = parser.add_argument_group('Mountload arguments')
+        grp_ml.add_argument('--bandwidth-limit', type=int, metavar='KIBPS', help="Limit background downloading to this many KiB/s")
+        grp_ml.add_argument('--channels', type=int, metavar='N', help="Number of SFTP channels per SSH connection (default: %d)" % MountLoadSource.defaultChannelsPerConnection)
+        grp_ml.add_argument('--chunk-size', type=int, default=1, metavar='MIB', help="Download files in aligned chunks of this many MiB, between 1 and 16 (default: 1)")
+        grp_ml.add_argument('--connections', type=int, metavar='N', help="Maximum number of SSH connections for filesystem access (default: %d)" % MountLoadSource.defaultMaximumConnections)
+        grp_ml.add_argument('--crawl', action='store_true', help="List the entire remote tree in the background after mounting")
+        grp_ml.add_argument('--crawl-threads', type=int, default=16, metavar='N', help="Number of concurrent directory listings while crawling (default: 16)")
         grp_ml.add_argument('--debug', action='store_true', help="Enable debug mode")
+        grp_ml.add_argument('--download-threads', type=int, metavar='N', help="Number of background download threads; 0 disables background downloading (default: 2, or 8 with --sync)")
+        grp_ml.add_argument('--engine', choices=['threads', 'asyncio'], default='threads', help="SFTP engine: blocking requests on pooled channels, or requests multiplexed by an asyncio event loop (default: threads)")
+        grp_ml.add_argument('--on-complete', metavar='COMMAND', help="Shell command to run once all files have been downloaded; the target directory is passed in MOUNTLOAD_TARGET")
         grp_ml.add_argument('--password', action='store_true', help="Ask for an SSH password")
+        grp_ml.add_argument('--preallocate', action='store_true', help="Allocate disk space for files when they are registered, so files downloaded out of order do not get fragmented")
+        grp_ml.add_argument('--read-ahead', type=int, default=32, metavar='MIB', help="Maximum read-ahead window for sequentially read files in MiB; 0 disables read-ahead (default: 32)")
+        grp_ml.add_argument('--revalidate-interval', type=float, metavar='SECONDS', help="Detect remote changes by listing all synced directories again, starting a new pass this many seconds after the previous one finished")
+        grp_ml.add_argument('--revalidate-rate', type=float, default=20.0, metavar='N', help="Maximum number of directories to list per second while revalidating (default: 20)")
+        grp_ml.add_argument('--sftp-window', type=int, metavar='N', help="Number of SFTP read requests to keep in flight per transfer (default: %d)" % MountLoadSource.defaultReadWindow)
+        grp_ml.add_argument('--stats-interval', type=float, metavar='SECONDS', help="Periodically write performance statistics as JSON to .mountload/stats.json in the target")
+        grp_ml.add_argument('--stripe-threshold', type=int, default=64, metavar='MIB', help="Only stripe files of at least this many MiB (default: 64)")
+        grp_ml.add_argument('--stripes', type=int, metavar='N', help="Download large files over this many separate SSH connections at once; 1 disables striping (default: 1, or 4 with --sync)")
+        grp_ml.add_argument('--sync', action='store_true', help="Download without mounting and exit when done; an interrupted sync resumes where it left off")
         grp_ml.add_argument('source', help="The SFTP source URI, eg: sftp://user@example.org/path/to/remote/dir", nargs='?')
         grp_ml.add_argument('target', help="The directory in which all the files should be stored")
-        grp_ml.add_argument('mountpoint', help="Path to the mountpoint")
+        grp_ml.add_argument('mountpoint', help="Path to the mountpoint; omitted with --sync", nargs='?')
+
+        grp_sync = parser.add_argument_group('Sync arguments')
+        grp_sync.add_argument('--path', action='append', dest='paths', metavar='PATH', help="Only download this remote path, relative to the source directory; can be given multiple times")
+        grp_sync.add_argument('--report-interval', type=float, default=10.0, metavar='SECONDS', help="Log the progress, throughput and ETA this often (default: 10)")
 
         grp_fuse = parser.add_argument_group('FUSE arguments')
+        grp_fuse.add_argument('--attr-timeout', type=float, default=60.0, metavar='SECONDS', help="How long the kernel caches file attributes (default: 60)")
+        grp_fuse.add_argument('--entry-timeout', type=float, default=60.0, metavar='SECONDS', help="How long the kernel caches name lookups (default: 60)")
+        grp_fuse.add_argument('--no-kernel-cache', action='store_true', help="Do not let the kernel cache synced files between opens and do not tune read sizes")
         grp_fuse.add_argument('--multithreaded', action='store_true', help="Use multiple threads for filesystem access")
+        return parser
 
+    @staticmethod
+    def run():
+        """Handles command line parameters, configuration and sets up the mountload components"""
+
+        # Parse the command line arguments
+        parser = MountLoad._createParser()
         args = parser.parse_args()
+        if args.sync:
+            if args.mountpoint is not None:
+                parser.error('a mountpoint can not be used with --sync')
+        elif args.mountpoint is None:
+            # Without a source URI, the target and mountpoint end up one position early
+            if args.source is None:
+                parser.error('the following arguments are required: mountpoint')
+            args.source, args.target, args.mountpoint = None, args.source, args.target
+        if (args.paths is not None) and not args.sync:
+            parser.error('--path can only be used with --sync')
+        if args.download_threads is None:
+            args.download_threads = 8 if args.sync else 2
+        if args.stripes is None:
+            args.stripes = 4 if args.sync else 1
 
         # Determine configuration
         source = args.source
         target = args.target
-        mountpoint = args.mountpoint
+
+        if not 1 <= args.chunk_size <= 16:
+            parser.error('chunk size must be between 1 and 16 MiB')
+
+        if args.sync and (args.download_threads < 1):
+            parser.error('number of download threads must be at least 1')
+
+        if args.revalidate_rate <= 0:
+            parser.error('revalidate rate must be positive')
+
+        if args.stripes < 1:
+            parser.error('number of stripes must be at least 1')
+
+        sourceClass = AsyncMountLoadSource if args.engine == 'asyncio' else MountLoadSource
 
         # Determine password
         password = None
@@ -37,14 +101,69 @@ class MountLoad:
             password = getpass('Enter SSH password: ')
 
         # Initialize a controller pool and acquire a controller to check for any initial errors
-        controllerPool = ControllerPool(source, target, password)
         try:
+            readAheadSize = 0 if args.sync else args.read_ahead * 1024 * 1024
+            controllerPool = ControllerPool(source, target, password, args.sftp_window, readAheadSize,
+                                            args.connections, args.channels, chunkSize=args.chunk_size * 1024 * 1024, sourceClass=sourceClass,
+                                            preallocate=args.preallocate)
             with controllerPool.acquire():
                 pass
         except RuntimeError as e:
             parser.error('controller error: %s' % str(e))
 
-        # Start FUSE; this will keep mountload running until unmount
-        connector = FUSEConnector(controllerPool, args.debug)
-        connector.startFUSE(mountpoint, isMultiThreaded=args.multithreaded)
+        # Report when the target is complete
+        controllerPool.metadata.addCompletionListener(CompletionHook(target, args.on_complete))
+
+        bandwidthLimit = None if args.bandwidth_limit is None else args.bandwidth_limit * 1024
+        if args.sync:
+            sys.exit(0 if MountLoad._sync(args, controllerPool, bandwidthLimit) else 1)
+
+        # Setup metadata crawling and background downloading; FUSE starts them after mounting
+        backgroundTasks = []
+        if args.crawl:
+            backgroundTasks.append(MetaDataCrawler(controllerPool, args.crawl_threads))
+        downloader = None
+        if args.download_threads > 0:
+            downloader = BackgroundDownloader(controllerPool, args.download_threads, bandwidthLimit, args.stripes,
+                                              args.stripe_threshold * 1024 * 1024)
+            backgroundTasks.append(downloader)
+        if args.revalidate_interval is not None:
+            backgroundTasks.append(Revalidator(controllerPool, args.revalidate_interval, args.revalidate_rate, downloader))
+        if args.stats_interval is not None:
+            backgroundTasks.append(StatisticsDumper(controllerPool.target.metaDirectory + '/stats.json', args.stats_interval))
 
+        # Start FUSE; this will keep mountload running until unmount. Loading libfuse is deferred until here, so syncing
+        # works on hosts without FUSE.
+        from mountload.fuseconnector import FUSEConnector
+        connector = FUSEConnector(controllerPool, args.debug, backgroundTasks, useKernelCache=not args.no_kernel_cache,
+                                  filesCanChange=args.revalidate_interval is not None)
+        fuseOptions = {'attr_timeout': args.attr_timeout, 'entry_timeout': args.entry_timeout}
+        connector.startFUSE(args.mountpoint, isMultiThreaded=args.multithreaded, fuseOptions=fuseOptions)
+
+    @staticmethod
+    def _sync(args, controllerPool, bandwidthLimit):
+        """Downloads without mounting and returns whether everything was synced; the controller pool is closed afterwards"""
+        log = logging.getLogger('mountload')
+        log.setLevel(logging.INFO)
+        sh = logging.StreamHandler()
+        sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        log.addHandler(sh)
+
+        statisticsDumper = None
+        if args.stats_interval is not None:
+            statisticsDumper = StatisticsDumper(controllerPool.target.metaDirectory + '/stats.json', args.stats_interval)
+            statisticsDumper.start()
+        try:
+            synchronizer = Synchronizer(controllerPool, args.paths, args.crawl_threads, args.download_threads, bandwidthLimit,
+                                        args.stripes, args.stripe_threshold * 1024 * 1024, args.report_interval)
+            return synchronizer.run()
+        except KeyboardInterrupt:
+            log.warning('Interrupted; run the same command again to resume')
+            return False
+        except RuntimeError as e:
+            log.error('%s', str(e))
+            return False
+        finally:
+            if statisticsDumper is not None:
+                statisticsDumper.stop()
+            controllerPool.close()
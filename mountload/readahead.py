@@ -0,0 +1,135 @@
+# Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
+# See the file LICENSE.txt for copying permission.
+
+from collections import OrderedDict
+import logging
+from mountload.scheduler import IOScheduler
+from threading import Condition, Thread
+
+class AccessPattern:
+    """Keeps track of the reads on a single path"""
+
+    def __init__(self, offset):
+        self.nextOffset = offset
+        self.sequentialReads = 0
+        self.windowSize = 0
+        self.prefetchedUntil = offset
+        self.generation = 0
+
+class ReadAhead:
+    """Detects sequential reads on files and asynchronously prefetches data ahead of the reader"""
+    initialWindowSize = 1024 * 1024
+    maximumNumberOfPatterns = 256
+    numberOfThreads = 2
+    sequentialReadsThreshold = 2
+    sequentialTolerance = 256 * 1024
+
+    def __init__(self, controllerPool, maximumWindowSize):
+        self.pool = controllerPool
+        self.maximumWindowSize = maximumWindowSize
+        self.log = logging.getLogger('mountload.readahead')
+
+        # Access patterns by path and pending prefetch jobs, protected by the condition
+        self.condition = Condition()
+        self.patterns = OrderedDict()
+        self.jobs = OrderedDict()
+        self.isStopped = False
+        self.threads = []
+
+    def close(self):
+        with self.condition:
+            self.isStopped = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _isCurrent(self, path, generation):
+        pattern = self.patterns.get(path)
+        return (pattern is not None) and (pattern.generation == generation) and not self.isStopped
+
+    def registerRead(self, pathInfo, offset, size):
+        """Updates the access pattern for a path and schedules a prefetch if the path is being streamed"""
+        path = pathInfo['path']
+        with self.condition:
+            pattern = self.patterns.get(path)
+            if pattern is None:
+                pattern = AccessPattern(offset)
+                self.patterns[path] = pattern
+                while len(self.patterns) > ReadAhead.maximumNumberOfPatterns:
+                    self.patterns.popitem(last=False)
+            self.patterns.move_to_end(path)
+
+            # Random access collapses the window and cancels any prefetch in progress
+            if abs(offset - pattern.nextOffset) > ReadAhead.sequentialTolerance:
+                pattern.sequentialReads = 0
+                pattern.windowSize = 0
+                pattern.prefetchedUntil = offset + size
+                pattern.generation += 1
+                self.jobs.pop(path, None)
+            else:
+                pattern.sequentialReads += 1
+            pattern.nextOffset = max(pattern.nextOffset, offset + size)
+            pattern.prefetchedUntil = max(pattern.prefetchedUntil, pattern.nextOffset)
+            if pattern.sequentialReads < ReadAhead.sequentialReadsThreshold:
+                return
+
+            # Grow the window each time the reader consumes half of it
+            if pattern.prefetchedUntil - pattern.nextOffset > pattern.windowSize // 2:
+                return
+            pattern.windowSize = min(self.maximumWindowSize, max(ReadAhead.initialWindowSize, pattern.windowSize * 2))
+            prefetchUntil = min(pathInfo['size'], pattern.nextOffset + pattern.windowSize)
+            if prefetchUntil <= pattern.prefetchedUntil:
+                return
+
+            # Schedule the prefetch, extending a job that has not been picked up yet
+            job = self.jobs.get(path)
+            if job is None:
+                self.jobs[path] = {'pathInfo': pathInfo, 'begin': pattern.prefetchedUntil, 'end': prefetchUntil - 1,
+                                   'generation': pattern.generation}
+            else:
+                job['end'] = prefetchUntil - 1
+            pattern.prefetchedUntil = prefetchUntil
+
+            self._ensureThreadsStarted()
+            self.condition.notify()
+
+    def _ensureThreadsStarted(self):
+        while len(self.threads) < ReadAhead.numberOfThreads:
+            thread = Thread(target=self._run, name='mountload-readahead', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _nextJob(self):
+        with self.condition:
+            while not self.isStopped:
+                if len(self.jobs) > 0:
+                    return self.jobs.popitem(last=False)
+                self.condition.wait()
+        return None
+
+    def _run(self):
+        controller = None
+        while True:
+            item = self._nextJob()
+            if item is None:
+                break
+            path, job = item
+
+            # Stop prefetching as soon as the reader no longer streams this path
+            def chunkCallback(chunkSize):
+                with self.condition:
+                    return self._isCurrent(path, job['generation'])
+
+            try:
+                if controller is None:
+                    controller = self.pool.createController(priorityClass=IOScheduler.readAhead)
+                controller.downloadRange(job['pathInfo'], job['begin'], job['end'], chunkCallback)
+            except Exception:
+                self.log.exception('Read-ahead of %s failed', path)
+                if controller is not None:
+                    controller.close()
+                    controller = None
+
+        if controller is not None:
+            controller.close()
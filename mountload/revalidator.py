@@ -0,0 +1,88 @@
+# Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
+# See the file LICENSE.txt for copying permission.
+
+import logging
+from mountload.downloader import RateLimiter
+from mountload.scheduler import IOScheduler
+from mountload.stats import statistics
+from threading import Event, Thread
+import time
+
+class Revalidator:
+    """
+    Detects changes at the source by listing all synced directories again in
+    the background, in batches and at a limited rate. Files of which the size
+    or modification time changed are reset so they are downloaded again; new
+    entries are registered. A new pass starts interval seconds after the
+    previous one finished.
+    """
+    batchSize = 256
+    retryInterval = 5
+
+    def __init__(self, controllerPool, interval, directoriesPerSecond, downloader=None):
+        self.pool = controllerPool
+        self.interval = interval
+        self.rateLimiter = RateLimiter(directoriesPerSecond)
+        self.downloader = downloader
+        self.log = logging.getLogger('mountload.revalidator')
+
+        self.stopEvent = Event()
+        self.thread = None
+
+    def _revalidate(self, controller):
+        """Runs a single pass over all synced directories"""
+        startTime = time.monotonic()
+        numberOfDirectories = 0
+        numberOfResetFiles = 0
+        lastPathId = 0
+        while not self.stopEvent.is_set():
+            batch = controller.metadata.getSyncedDirectories(lastPathId, Revalidator.batchSize)
+            if len(batch) == 0:
+                self.log.info('Revalidated %d directories in %.1f seconds; %d files changed', numberOfDirectories,
+                              time.monotonic() - startTime, numberOfResetFiles)
+                break
+            lastPathId = batch[-1]['pathId']
+
+            for pathInfo in batch:
+                self.rateLimiter.consume(1)
+                self.pool.waitUntilIdle(self.stopEvent)
+                if self.stopEvent.is_set():
+                    break
+                resetFiles = controller.revalidateDirectory(pathInfo)
+                numberOfDirectories += 1
+                numberOfResetFiles += resetFiles
+                statistics.increment('revalidate.directories')
+                statistics.increment('revalidate.changedFiles', resetFiles)
+
+                # Changed files need to be downloaded again, even if the downloader had finished
+                if (resetFiles > 0) and (self.downloader is not None):
+                    self.downloader.resume()
+
+    def _run(self):
+        controller = None
+        while not self.stopEvent.is_set():
+            try:
+                if controller is None:
+                    controller = self.pool.createController(priorityClass=IOScheduler.bulk)
+                self._revalidate(controller)
+                self.stopEvent.wait(self.interval)
+            except Exception:
+                # Start over with a new controller after a while, in case the failure was a dropped connection
+                self.log.exception('Revalidation failed; retrying in %d seconds', Revalidator.retryInterval)
+                if controller is not None:
+                    controller.close()
+                    controller = None
+                self.stopEvent.wait(Revalidator.retryInterval)
+
+        if controller is not None:
+            controller.close()
+
+    def start(self):
+        self.thread = Thread(target=self._run, name='mountload-revalidator', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,188 @@
+# Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
+# See the file LICENSE.txt for copying permission.
+
+from collections import deque
+from contextlib import contextmanager
+from mountload.stats import statistics
+from threading import Condition
+import time
+
+class IOLane:
+    """
+    Concurrency limits of the remote operations on a single source. Lanes of
+    sources that only carry background work don't keep slots free for
+    interactive operations; the operations are waiting for their slots in a
+    queue per priority class.
+    """
+
+    def __init__(self, maximumConcurrency, isBackground=False):
+        self.maximumConcurrency = maximumConcurrency
+        if isBackground:
+            self.limits = [maximumConcurrency] * len(IOScheduler.classNames)
+        else:
+            self.limits = [maximumConcurrency, max(1, maximumConcurrency - 1), max(1, maximumConcurrency // 2),
+                           max(1, maximumConcurrency // 2)]
+        self.numberOfRunning = [0] * len(self.limits)
+        self.queues = [deque() for _ in self.limits]
+
+    def canRun(self, priorityClass):
+        return (sum(self.numberOfRunning) < self.maximumConcurrency) and \
+            (self.numberOfRunning[priorityClass] < self.limits[priorityClass])
+
+class IOScheduler:
+    """
+    Admits remote operations by priority class. Every source has its own lane
+    that runs at most as many operations at once as the source can handle,
+    and every class has its own concurrency limit, so one slot always remains
+    for interactive metadata operations and background transfers can not take
+    over the link. Waiting operations of a higher class go first; within a
+    class, operations are admitted in arrival order. Since all sources share
+    the link, background operations on any lane wait while interactive
+    operations are queued.
+    """
+    foregroundMetaData = 0
+    foregroundData = 1
+    readAhead = 2
+    bulk = 3
+    classNames = ['foregroundMetaData', 'foregroundData', 'readAhead', 'bulk']
+
+    def __init__(self, maximumConcurrency):
+        # Lanes and their running operations and queued tickets, protected by the condition
+        self.condition = Condition()
+        self.lanes = []
+        self.defaultLane = self.addLane(maximumConcurrency)
+
+    def addLane(self, maximumConcurrency, isBackground=False):
+        """Adds a lane for the operations on another source"""
+        lane = IOLane(maximumConcurrency, isBackground)
+        with self.condition:
+            self.lanes.append(lane)
+        return lane
+
+    @staticmethod
+    def _getPriorityClass(priorityClass, fetch):
+        if (fetch is None) or (fetch.priorityClass is None):
+            return priorityClass
+        return min(priorityClass, fetch.priorityClass)
+
+    def _isAdmitted(self, lane, priorityClass, ticket):
+        if (lane.queues[priorityClass][0] is not ticket) or not lane.canRun(priorityClass):
+            return False
+
+        # Waiting operations of higher classes that can run go first
+        if any((len(lane.queues[higherClass]) > 0) and lane.canRun(higherClass) for higherClass in range(priorityClass)):
+            return False
+
+        # Background operations on other lanes would compete with waiting interactive operations for the link
+        return (priorityClass < IOScheduler.readAhead) or \
+            not any((len(otherLane.queues[IOScheduler.foregroundMetaData]) > 0) or
+                    (len(otherLane.queues[IOScheduler.foregroundData]) > 0)
+                    for otherLane in self.lanes if otherLane is not lane)
+
+    def raisePriority(self, fetch, priorityClass):
+        """Lets the remaining operations of a fetch run in at least the given priority class"""
+        with self.condition:
+            if (fetch.priorityClass is None) or (priorityClass < fetch.priorityClass):
+                fetch.priorityClass = priorityClass
+                self.condition.notify_all()
+
+    def removeLane(self, lane):
+        with self.condition:
+            self.lanes.remove(lane)
+            self.condition.notify_all()
+
+    @contextmanager
+    def schedule(self, priorityClass, lane=None, fetch=None):
+        """
+        Waits until an operation of the priority class may run on the lane and
+        keeps its slot for the duration of the with block. The operation of a
+        fetch runs in the raised priority class of the fetch, if that is higher.
+        """
+        lane = self.defaultLane if lane is None else lane
+        ticket = object()
+        startTime = time.monotonic()
+        with self.condition:
+            priorityClass = IOScheduler._getPriorityClass(priorityClass, fetch)
+            lane.queues[priorityClass].append(ticket)
+            while not self._isAdmitted(lane, priorityClass, ticket):
+                self.condition.wait()
+
+                # Move up if a more urgent thread started waiting for the fetch meanwhile
+                raisedPriorityClass = IOScheduler._getPriorityClass(priorityClass, fetch)
+                if raisedPriorityClass != priorityClass:
+                    lane.queues[priorityClass].remove(ticket)
+                    priorityClass = raisedPriorityClass
+                    lane.queues[priorityClass].append(ticket)
+            lane.queues[priorityClass].popleft()
+            lane.numberOfRunning[priorityClass] += 1
+            self.condition.notify_all()
+        statistics.record('scheduler.%s.wait' % IOScheduler.classNames[priorityClass], time.monotonic() - startTime)
+
+        try:
+            yield
+        finally:
+            with self.condition:
+                lane.numberOfRunning[priorityClass] -= 1
+                self.condition.notify_all()
+
+class ScheduledSource:
+    """
+    View on a source that runs every remote operation through an IOScheduler,
+    using one priority class for metadata and another for data. Streams are
+    scheduled in slices, so higher priority operations can get in between the
+    slices of a large transfer.
+    """
+    streamSliceSize = 4 * 1024 * 1024
+
+    def __init__(self, source, scheduler, metaDataClass, dataClass, lane=None, ownsSource=False):
+        self.source = source
+        self.scheduler = scheduler
+        self.metaDataClass = metaDataClass
+        self.dataClass = dataClass
+        self.lane = lane
+        self.ownsSource = ownsSource
+
+    def close(self):
+        # A shared source is closed by its owner
+        if self.ownsSource:
+            self.source.close()
+            if self.lane is not None:
+                self.scheduler.removeLane(self.lane)
+
+    def discardFile(self, path):
+        self.source.discardFile(path)
+
+    def getDirectoryEntries(self, path):
+        with self.scheduler.schedule(self.metaDataClass, self.lane):
+            return self.source.getDirectoryEntries(path)
+
+    def getEntry(self, path):
+        with self.scheduler.schedule(self.metaDataClass, self.lane):
+            return self.source.getEntry(path)
+
+    def getLinkTarget(self, path):
+        with self.scheduler.schedule(self.metaDataClass, self.lane):
+            return self.source.getLinkTarget(path)
+
+    def getRemoteDirectory(self):
+        return self.source.getRemoteDirectory()
+
+    def pinFile(self, path):
+        self.source.pinFile(path)
+
+    def raisePriority(self, fetch):
+        """Lets the thread downloading a fetch continue in our data class, since we are waiting for it"""
+        self.scheduler.raisePriority(fetch, self.dataClass)
+
+    def readData(self, path, offset, size):
+        return b''.join(self.readStream(path, offset, size))
+
+    def readStream(self, path, offset, size, fetch=None):
+        """Yields the data like the source does; given the fetch the range belongs to, it may be raised in priority"""
+        end = offset + size
+        for sliceOffset in range(offset, end, ScheduledSource.streamSliceSize):
+            with self.scheduler.schedule(self.dataClass, self.lane, fetch):
+                yield from self.source.readStream(path, sliceOffset, min(ScheduledSource.streamSliceSize, end - sliceOffset))
+
+    def unpinFile(self, path):
+        self.source.unpinFile(path)
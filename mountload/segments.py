@@ -0,0 +1,161 @@
+# Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
+# See the file LICENSE.txt for copying permission.
+
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from threading import RLock
+
+class RemoteSegmentSet:
+    """Sorted set of disjoint, inclusive (begin, end) ranges of a file that have not been downloaded yet"""
+
+    def __init__(self, segments=()):
+        self.begins = []
+        self.ends = []
+        for begin, end in sorted(segments):
+            self.begins.append(begin)
+            self.ends.append(end)
+
+    def getRange(self, begin, end):
+        """Returns all segments overlapping the range [begin, end] in ascending order"""
+        first, last = self._overlappingIndices(begin, end)
+        return list(zip(self.begins[first:last], self.ends[first:last]))
+
+    def getSegments(self):
+        return list(zip(self.begins, self.ends))
+
+    def getSize(self):
+        """Returns the total number of bytes in all segments"""
+        return sum(self.ends) - sum(self.begins) + len(self.begins)
+
+    def isEmpty(self):
+        return len(self.begins) == 0
+
+    def _overlappingIndices(self, begin, end):
+        # The first segment ending at or after begin up to the last segment starting at or before end
+        return (bisect_left(self.ends, begin), bisect_right(self.begins, end))
+
+    def remove(self, begin, end):
+        """
+        Removes the range [begin, end], shortening or splitting partially
+        overlapping segments. Returns the number of bytes removed.
+        """
+        first, last = self._overlappingIndices(begin, end)
+        if first >= last:
+            return 0
+        removed = sum(min(end, segmentEnd) - max(begin, segmentBegin) + 1
+                      for segmentBegin, segmentEnd in zip(self.begins[first:last], self.ends[first:last]))
+
+        newBegins = []
+        newEnds = []
+        if self.begins[first] < begin:
+            newBegins.append(self.begins[first])
+            newEnds.append(begin - 1)
+        if self.ends[last - 1] > end:
+            newBegins.append(end + 1)
+            newEnds.append(self.ends[last - 1])
+        self.begins[first:last] = newBegins
+        self.ends[first:last] = newEnds
+        return removed
+
+class RemoteSegmentCache:
+    """
+    Thread-safe cache of RemoteSegmentSets by path ID. Removed ranges are only
+    applied in memory; the metadata writer periodically flushes the changed sets.
+    """
+    capacity = 1024
+    maximumPendingChanges = 256
+
+    def __init__(self):
+        self.lock = RLock()
+        self.sets = OrderedDict()
+        self.dirtyPathIds = set()
+        self.flushingPathIds = set()
+        self.pendingChanges = 0
+        self.removedBytes = 0
+
+    def _evict(self):
+        # Only clean sets can be evicted; dirty sets are kept until they have been flushed
+        for pathId in list(self.sets.keys()):
+            if len(self.sets) <= RemoteSegmentCache.capacity:
+                break
+            if (pathId not in self.dirtyPathIds) and (pathId not in self.flushingPathIds):
+                del self.sets[pathId]
+
+    def abortFlush(self, removedBytes):
+        """Marks the path IDs of the last snapshot dirty again after it failed to be written"""
+        with self.lock:
+            self.dirtyPathIds.update(pathId for pathId in self.flushingPathIds if pathId in self.sets)
+            self.flushingPathIds = set()
+            self.removedBytes += removedBytes
+
+    def finishFlush(self):
+        """Allows the sets of the last snapshot to be evicted again"""
+        with self.lock:
+            self.flushingPathIds = set()
+
+    def get(self, pathId, loader):
+        """Returns the set for a path ID, calling loader(pathId) for its segments on a cache miss"""
+        with self.lock:
+            segmentSet = self.sets.get(pathId)
+            if segmentSet is None:
+                segmentSet = RemoteSegmentSet(loader(pathId))
+                self.sets[pathId] = segmentSet
+                self._evict()
+            else:
+                self.sets.move_to_end(pathId)
+            return segmentSet
+
+    def isFlushing(self, pathId):
+        """Returns whether the snapshot of a path ID taken by takeDirty() is still current"""
+        with self.lock:
+            return pathId in self.flushingPathIds
+
+    def invalidate(self, pathId):
+        with self.lock:
+            self.sets.pop(pathId, None)
+            self.dirtyPathIds.discard(pathId)
+
+    def hasDirty(self):
+        with self.lock:
+            return len(self.dirtyPathIds) > 0
+
+    def isFlushDue(self):
+        with self.lock:
+            return self.pendingChanges >= RemoteSegmentCache.maximumPendingChanges
+
+    def remove(self, pathId, begin, end, loader):
+        """Removes a range from the set of a path ID; returns whether the set is now empty"""
+        with self.lock:
+            segmentSet = self.get(pathId, loader)
+            removed = segmentSet.remove(begin, end)
+            if removed > 0:
+                self.dirtyPathIds.add(pathId)
+                self.pendingChanges += 1
+                self.removedBytes += removed
+            return segmentSet.isEmpty()
+
+    def replace(self, pathId, segments, loader):
+        """Replaces the set of a path ID, discarding its unflushed changes; returns the size of the replaced set in bytes"""
+        with self.lock:
+            replacedSize = self.get(pathId, loader).getSize()
+            self.sets[pathId] = RemoteSegmentSet(segments)
+            self.dirtyPathIds.discard(pathId)
+            self.flushingPathIds.discard(pathId)
+            return replacedSize
+
+    def takeDirty(self):
+        """
+        Returns a snapshot of the segments of all dirty path IDs and the number
+        of bytes removed from them since the last snapshot. The path IDs are
+        marked clean until finishFlush().
+        """
+        with self.lock:
+            snapshot = {}
+            for pathId in self.dirtyPathIds:
+                snapshot[pathId] = self.sets[pathId].getSegments()
+            removedBytes = self.removedBytes
+            self.flushingPathIds = self.dirtyPathIds
+            self.dirtyPathIds = set()
+            self.pendingChanges = 0
+            self.removedBytes = 0
+            return (snapshot, removedBytes)
@@ -1,55 +1,309 @@
 # Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
 # See the file LICENSE.txt for copying permission.
 
+from collections import Counter, deque
+from contextlib import contextmanager
 from errno import ENOENT
+import logging
+from mountload.handles import HandleCache
 from os.path import normpath
 from paramiko import SSHClient, WarningPolicy
+from paramiko.sftp import CMD_DATA, CMD_READ, CMD_STATUS, int64, SFTPError
+from mountload.stats import statistics
+from threading import Condition, Lock
+import time
 from urllib.parse import urlsplit
 
-class MountLoadSource:
-    def __init__(self, sourceURI, password):
-        # Split the source URI into components
-        components = urlsplit(sourceURI)
-        hostname = components.hostname
-        username = 'anonymous' if components.username is None else components.username
-        port = 22 if components.port is None else components.port
-        remoteDirectory = components.path
+class SFTPChannel:
+    """A single SFTP channel on an SSH connection, including a cache of the files opened on it"""
+    fileCacheCapacity = 16
+    fileCacheIdleTimeout = 30
 
-        # Normalize path
-        remoteDirectory = normpath(remoteDirectory)
-        if not remoteDirectory.startswith('/'):
-            raise RuntimeError('Remote directory %s is not an absolute path' % remoteDirectory)
-        self.remoteDirectory = remoteDirectory
+    def __init__(self, connection, sftp, isFilePinned):
+        self.connection = connection
+        self.sftp = sftp
+        self.files = HandleCache(lambda path: self.sftp.open(path, 'r'), SFTPChannel._closeFile,
+                                 SFTPChannel.fileCacheCapacity, SFTPChannel.fileCacheIdleTimeout, isFilePinned)
+
+    def close(self):
+        # Drop our references so SFTPFile performs an async close; this is necessary because we can't guarantee it's being
+        # closed by the same thread that opened the file. This happens during FUSE destroy() for example.
+        del self.files
+        self.sftp.close()
+
+    @staticmethod
+    def _closeFile(fp):
+        # The channel may already be gone, which closes the file on the server as well
+        try:
+            fp.close()
+        except Exception:
+            pass
+
+    def isHealthy(self):
+        return self.connection.isActive() and not self.sftp.get_channel().closed
+
+class SFTPPipelinedReader:
+    """
+    Reads a range of an open SFTP file while keeping a bounded number of read
+    requests in flight. Unlike paramiko's readv(), which issues its requests
+    from a thread that cannot be stopped, no requests are sent beyond what the
+    reader asks for, so close() only has to wait for the outstanding ones
+    before the channel can be used again.
+    """
+
+    def __init__(self, sftp, fp, offset, end, readWindow):
+        self.sftp = sftp
+        self.fp = fp
+        self.nextOffset = offset
+        self.end = end
+        self.readWindow = readWindow
+        self.buffer = b''
+
+        # Requests in the order they were sent, and responses that arrived before we waited for them
+        self.requests = deque()
+        self.responses = {}
+
+    def _async_response(self, packetType, msg, num):
+        # Called by paramiko for our responses that arrive while waiting for another request
+        self.responses[num] = (packetType, msg)
 
-        # Connect using SSH
+    def close(self):
+        """Waits for the outstanding requests, so their responses do not end up with the next user of the channel"""
+        while len(self.requests) > 0:
+            num, offset, length = self.requests.popleft()
+            if num in self.responses:
+                continue
+            try:
+                self.sftp._read_response(num)
+            except (EOFError, IOError, SFTPError):
+                pass
+        self.responses.clear()
+
+    def _nextPiece(self):
+        # Keep the window filled
+        while len(self.requests) < self.readWindow and self.nextOffset < self.end:
+            length = min(self.fp.MAX_REQUEST_SIZE, self.end - self.nextOffset)
+            self._sendRequest(self.nextOffset, length)
+            self.nextOffset += length
+
+        num, offset, length = self.requests.popleft()
+        if num in self.responses:
+            packetType, msg = self.responses.pop(num)
+            if packetType == CMD_STATUS:
+                self.sftp._convert_status(msg)
+        else:
+            packetType, msg = self.sftp._read_response(num)
+        if packetType != CMD_DATA:
+            raise SFTPError('Expected data')
+        data = msg.get_string()
+
+        # Servers may return less than requested; ask for the remainder first
+        if 0 < len(data) < length:
+            self._sendRequest(offset + len(data), length - len(data), True)
+        return data
+
+    def read(self, size):
+        """Returns the next size bytes of the range; raises EOFError if the file ends before that"""
+        pieces = [self.buffer]
+        numberOfBytes = len(self.buffer)
+        while numberOfBytes < size:
+            piece = self._nextPiece()
+            if len(piece) == 0:
+                raise EOFError()
+            pieces.append(piece)
+            numberOfBytes += len(piece)
+        data = b''.join(pieces)
+        self.buffer = data[size:]
+        return data[:size]
+
+    def _sendRequest(self, offset, length, isFirst=False):
+        num = self.sftp._async_request(self, CMD_READ, self.fp.handle, int64(offset), int(length))
+        if isFirst:
+            self.requests.appendleft((num, offset, length))
+        else:
+            self.requests.append((num, offset, length))
+
+class SFTPConnection:
+    """A single SSH connection that multiplexes a number of SFTP channels"""
+
+    def __init__(self, hostname, port, username, password):
         self.client = SSHClient()
         self.client.load_system_host_keys()
         self.client.set_missing_host_key_policy(WarningPolicy())
         self.client.connect(hostname=hostname, port=port, username=username, password=password, compress=True)
+        self.numberOfChannels = 0
+
+    def close(self):
+        self.client.close()
+
+    def isActive(self):
+        transport = self.client.get_transport()
+        return (transport is not None) and transport.is_active()
+
+class SFTPConnectionPool:
+    """
+    Lazily opens SSH connections and SFTP channels up to the configured limits
+    and lends channels to threads for the duration of a remote operation.
+    Unhealthy channels are discarded, together with their connection if it
+    has been dropped.
+    """
+
+    def __init__(self, hostname, port, username, password, maximumConnections, channelsPerConnection, isFilePinned=None):
+        self.connectionArguments = {'hostname': hostname, 'port': port, 'username': username, 'password': password}
+        self.isFilePinned = isFilePinned
+        self.maximumConnections = maximumConnections
+        self.channelsPerConnection = channelsPerConnection
+
+        # Connections and idle channels, protected by the condition
+        self.condition = Condition()
+        self.connections = []
+        self.idleChannels = []
+        self.busyChannels = set()
+        self.numberOfPendingConnections = 0
+
+    def _acquire(self):
+        with self.condition:
+            while True:
+                # Prefer idle channels, discarding any that went bad while idle
+                while len(self.idleChannels) > 0:
+                    channel = self.idleChannels.pop()
+                    if channel.isHealthy():
+                        return channel
+                    self._discard(channel)
+
+                # Forget about dropped connections without channels
+                self.connections = [c for c in self.connections if c.isActive() or c.numberOfChannels > 0]
 
-        # Open SFTP channel over SSH
-        self.sftp = self.client.open_sftp()
+                # Reserve a channel on an existing connection, or reserve a new connection
+                connection = next((c for c in self.connections
+                                   if c.isActive() and c.numberOfChannels < self.channelsPerConnection), None)
+                if connection is not None:
+                    connection.numberOfChannels += 1
+                    break
+                if len(self.connections) + self.numberOfPendingConnections < self.maximumConnections:
+                    self.numberOfPendingConnections += 1
+                    break
+                self.condition.wait()
 
-        # Keep track of the last opened file
-        self.lofFP = None
-        self.lofPath = None
+        # Connect outside of the lock since this involves network round trips
+        if connection is None:
+            try:
+                connection = SFTPConnection(**self.connectionArguments)
+            except:
+                with self.condition:
+                    self.numberOfPendingConnections -= 1
+                    self.condition.notify()
+                raise
+            with self.condition:
+                self.numberOfPendingConnections -= 1
+                self.connections.append(connection)
+                connection.numberOfChannels += 1
+
+        try:
+            return SFTPChannel(connection, connection.client.open_sftp(), self.isFilePinned)
+        except:
+            with self.condition:
+                connection.numberOfChannels -= 1
+                self.condition.notify()
+            raise
+
+    @contextmanager
+    def borrow(self):
+        """Lends a channel; the channel is discarded if it is no longer healthy afterwards"""
+        channel = self._acquire()
+        with self.condition:
+            self.busyChannels.add(channel)
+        try:
+            yield channel
+        finally:
+            self.release(channel)
 
     def close(self):
-        # Do a del so SFTPFile performs an async close; this is necessary because we can't guarantee it's being closed
-        # by the same thread that opened the file. This happens during FUSE destroy() for example.
-        if self.lofFP is not None:
-            del self.lofFP
+        with self.condition:
+            for channel in self.idleChannels:
+                channel.close()
+            self.idleChannels = []
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
 
-        # Close both SFTPClient and SSHClient; these work fine across threads
-        self.sftp.close()
-        self.client.close()
+    def discardFile(self, path):
+        """Closes the handles for a file on all channels; handles that are in use are closed once they are released"""
+        with self.condition:
+            for channel in self.idleChannels + list(self.busyChannels):
+                channel.files.discard(path)
+
+    def _discard(self, channel):
+        channel.connection.numberOfChannels -= 1
+        try:
+            channel.close()
+        except Exception:
+            pass
+        if not channel.connection.isActive() and channel.connection in self.connections:
+            self.connections.remove(channel.connection)
+            channel.connection.close()
+        self.condition.notify()
+
+    def release(self, channel):
+        with self.condition:
+            self.busyChannels.discard(channel)
+            if channel.isHealthy():
+                self.idleChannels.append(channel)
+                self.condition.notify()
+            else:
+                self._discard(channel)
+
+class MountLoadSource:
+    """Thread-safe SFTP source that performs every remote operation on a channel borrowed from its connection pool"""
+    defaultChannelsPerConnection = 4
+    defaultMaximumConnections = 2
+    defaultReadWindow = 64
+    streamChunkSize = 1024 * 1024
+
+    def __init__(self, sourceURI, password, readWindow=None, maximumConnections=None, channelsPerConnection=None):
+        hostname, port, username, self.remoteDirectory = MountLoadSource.parseSourceURI(sourceURI)
+
+        # SSH connections are opened lazily by the connection pool
+        if maximumConnections is None:
+            maximumConnections = MountLoadSource.defaultMaximumConnections
+        if channelsPerConnection is None:
+            channelsPerConnection = MountLoadSource.defaultChannelsPerConnection
+        self.connectionPool = SFTPConnectionPool(hostname, port, username, password, maximumConnections,
+                                                 channelsPerConnection, self._isFilePinned)
+        self.log = logging.getLogger('mountload.source')
+
+        # Number of FUSE file handles per remote path; channels keep pinned files open while idle
+        self.pinnedFilesLock = Lock()
+        self.pinnedFiles = Counter()
+
+        # Number of SFTP read requests we keep in flight while streaming
+        self.readWindow = MountLoadSource.defaultReadWindow if readWindow is None else readWindow
+
+    def close(self):
+        self.connectionPool.close()
+
+    def discardFile(self, path):
+        """Closes all handles of a remote file, so the next read opens it again; used when the file was replaced"""
+        self.connectionPool.discardFile(self.remoteDirectory + path)
+
+    def _execute(self, name, operation):
+        """Runs operation(channel) on a borrowed channel, retrying once on a fresh channel if the connection failed"""
+        for attempt in range(2):
+            with self.connectionPool.borrow() as channel:
+                try:
+                    with statistics.timer('sftp.' + name):
+                        return operation(channel)
+                except Exception:
+                    if attempt > 0 or channel.isHealthy():
+                        raise
+                    self.log.warning('SFTP connection failed; reconnecting')
 
     def getDirectoryEntries(self, path):
-        return self.sftp.listdir_attr(self.remoteDirectory + path)
+        return self._execute('listdir', lambda channel: channel.sftp.listdir_attr(self.remoteDirectory + path))
 
     def getEntry(self, path):
         try:
-            stat = self.sftp.stat(self.remoteDirectory + path)
+            stat = self._execute('stat', lambda channel: channel.sftp.stat(self.remoteDirectory + path))
         except IOError as e:
             if e.errno == ENOENT:
                 return None
@@ -57,19 +311,82 @@ class MountLoadSource:
         return stat
 
     def getLinkTarget(self, path):
-        return self.sftp.readlink(self.remoteDirectory + path)
+        return self._execute('readlink', lambda channel: channel.sftp.readlink(self.remoteDirectory + path))
+
+    def getMaximumConcurrency(self):
+        """Returns the number of remote operations that can run at once, one per channel"""
+        return self.connectionPool.maximumConnections * self.connectionPool.channelsPerConnection
 
     def getRemoteDirectory(self):
         return self.remoteDirectory
 
+    def _isFilePinned(self, remotePath):
+        return self.pinnedFiles[remotePath] > 0
+
+    def pinFile(self, path):
+        """Keeps the remote file open on the channels that read it until unpinFile() is called"""
+        with self.pinnedFilesLock:
+            self.pinnedFiles[self.remoteDirectory + path] += 1
+
+    @staticmethod
+    def parseSourceURI(sourceURI):
+        """Splits a source URI into its hostname, port, username and normalized remote directory"""
+        components = urlsplit(sourceURI)
+        hostname = components.hostname
+        username = 'anonymous' if components.username is None else components.username
+        port = 22 if components.port is None else components.port
+
+        # Normalize path
+        remoteDirectory = normpath(components.path)
+        if not remoteDirectory.startswith('/'):
+            raise RuntimeError('Remote directory %s is not an absolute path' % remoteDirectory)
+        return (hostname, port, username, remoteDirectory)
+
     def readData(self, path, offset, size):
-        # Open the file if not already open
-        if self.lofPath != path:
-            if self.lofFP is not None:
-                self.lofFP.close()
-            self.lofFP = self.sftp.open(self.remoteDirectory + path, 'r')
-            self.lofPath = path
-
-        # Perform prefetched reads
-        datachunks = self.lofFP.readv([(offset, size)])
-        return b''.join(datachunks)
+        return b''.join(self.readStream(path, offset, size))
+
+    def readStream(self, path, offset, size):
+        """
+        Yields the data for a range of a remote file as consecutive chunks of at
+        most streamChunkSize bytes. The range is read with readWindow SFTP read
+        requests in flight, so we do not pay a round trip for every chunk; when
+        the consumer stops early, no further requests are sent. The channel is
+        borrowed for the duration of the stream; if its connection fails, the
+        stream is resumed once on a fresh channel.
+        """
+        end = offset + size
+        hasRetried = False
+        while offset < end:
+            with self.connectionPool.borrow() as channel:
+                try:
+                    with channel.files.acquire(self.remoteDirectory + path) as fp:
+                        reader = SFTPPipelinedReader(channel.sftp, fp, offset, end, self.readWindow)
+                        try:
+                            while offset < end:
+                                chunkSize = min(MountLoadSource.streamChunkSize, end - offset)
+                                waitStart = time.monotonic()
+                                try:
+                                    data = reader.read(chunkSize)
+                                except EOFError:
+                                    raise IOError('Short read at offset %d of %s' % (offset, path))
+                                statistics.record('sftp.readChunk', time.monotonic() - waitStart)
+                                statistics.increment('sftp.bytesRead', chunkSize)
+                                offset += chunkSize
+                                yield data
+                        finally:
+                            if channel.isHealthy():
+                                reader.close()
+                except Exception:
+                    if hasRetried or channel.isHealthy():
+                        raise
+                    self.log.warning('SFTP connection failed while reading %s; reconnecting', path)
+                    hasRetried = True
+
+    def unpinFile(self, path):
+        remotePath = self.remoteDirectory + path
+        with self.pinnedFilesLock:
+            self.pinnedFiles[remotePath] -= 1
+            if self.pinnedFiles[remotePath] > 0:
+                return
+            del self.pinnedFiles[remotePath]
+        self.connectionPool.discardFile(remotePath)
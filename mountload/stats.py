@@ -0,0 +1,132 @@
+# Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
+# See the file LICENSE.txt for copying permission.
+
+from contextlib import contextmanager
+import json
+import logging
+import os
+from threading import Event, Lock, Thread
+import time
+
+class Histogram:
+    """Latency histogram with power of two buckets in microseconds"""
+    numberOfBuckets = 32
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.buckets = [0] * Histogram.numberOfBuckets
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+        self.buckets[min(Histogram.numberOfBuckets - 1, int(seconds * 1000000).bit_length())] += 1
+
+    def _percentile(self, fraction):
+        """Returns the upper bound of the bucket holding the percentile, in seconds"""
+        threshold = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= threshold:
+                return min(self.maximum, (1 << bucket) / 1000000)
+        return self.maximum
+
+    def toDict(self):
+        return {'count': self.count, 'total': self.total, 'mean': self.total / self.count if self.count > 0 else 0.0,
+                'p50': self._percentile(0.5), 'p90': self._percentile(0.9), 'p99': self._percentile(0.99),
+                'max': self.maximum}
+
+class Statistics:
+    """
+    Thread-safe counters and latency histograms by name. Updates only take a
+    lock and some arithmetic, so instrumentation can stay enabled permanently.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.startTime = time.monotonic()
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = Histogram()
+                self.histograms[name] = histogram
+            histogram.add(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """Records the duration of the with block"""
+        startTime = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - startTime)
+
+    def reset(self):
+        with self.lock:
+            self.startTime = time.monotonic()
+            self.counters = {}
+            self.histograms = {}
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict((name, histogram.toDict()) for name, histogram in self.histograms.items())
+        local = counters.get('read.localBytes', 0)
+        remote = counters.get('read.remoteBytes', 0)
+        return {'uptime': time.monotonic() - self.startTime, 'counters': counters, 'latencies': histograms,
+                'localReadRatio': local / (local + remote) if local + remote > 0 else None}
+
+    def toJSON(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True) + '\n'
+
+class StatisticsDumper:
+    """Background task that periodically writes the statistics to a file as JSON"""
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.log = logging.getLogger('mountload.stats')
+        self.stopEvent = Event()
+        self.thread = None
+
+    def dump(self):
+        # Replace the file atomically so readers never see a partial dump
+        temporaryPath = self.path + '.tmp'
+        with open(temporaryPath, 'w') as f:
+            f.write(statistics.toJSON())
+        os.replace(temporaryPath, self.path)
+
+    def _dumpSafely(self):
+        try:
+            self.dump()
+        except Exception:
+            self.log.exception('Failed to write statistics to %s', self.path)
+
+    def _run(self):
+        while not self.stopEvent.wait(self.interval):
+            self._dumpSafely()
+
+    def start(self):
+        self.thread = Thread(target=self._run, name='mountload-stats', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self._dumpSafely()
+
+# Process wide statistics, shared like loggers
+statistics = Statistics()
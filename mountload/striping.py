@@ -0,0 +1,116 @@
+# Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
+# See the file LICENSE.txt for copying permission.
+
+from mountload.stats import statistics
+from threading import Lock, Thread
+
+class Stripe:
+    """Range of a file that one worker downloads piece by piece; other workers can steal its tail by lowering end"""
+
+    def __init__(self, position, end):
+        self.position = position
+        self.end = end
+
+    def getRemainingSize(self):
+        return max(0, self.end - self.position + 1)
+
+class StripedDownload:
+    """
+    Downloads the remote segments of a large file over several controllers
+    with independent SSH connections. The range spanned by the remote segments
+    is divided into one stripe per controller. Every worker downloads its own
+    stripe in pieces, writing straight to its offset in the target; workers
+    that finish early steal the second half of the stripe with the most data
+    left, so a slow connection does not hold up the entire file.
+    """
+    pieceSize = 4 * 1024 * 1024
+
+    def __init__(self, controllers, pathInfo, chunkCallback=None):
+        self.controllers = controllers
+        self.pathInfo = pathInfo
+        self.chunkCallback = chunkCallback
+
+        # Pieces are whole chunks, so stripes never split a chunk that would otherwise be fetched at once
+        chunkSize = controllers[0].chunkSize
+        self.pieceSize = max(1, StripedDownload.pieceSize // chunkSize) * chunkSize
+
+        # Stripes and the abort state, protected by the lock
+        self.lock = Lock()
+        self.stripes = []
+        self.isAborted = False
+        self.error = None
+
+    def _chunkReceived(self, chunkSize):
+        if self.isAborted:
+            return False
+        if (self.chunkCallback is not None) and (self.chunkCallback(chunkSize) is False):
+            self.isAborted = True
+            return False
+        return True
+
+    def _nextPiece(self, stripe):
+        """Returns the next (begin, end) piece of a stripe and moves the stripe past it, or None if it is done"""
+        with self.lock:
+            if self.isAborted or (stripe.getRemainingSize() == 0):
+                return None
+            begin = stripe.position
+            end = min(stripe.end, begin + self.pieceSize - 1)
+            stripe.position = end + 1
+            return (begin, end)
+
+    def run(self):
+        """Downloads the file until it is done or the chunk callback aborts; returns whether all stripes completed"""
+        segments = self.controllers[0].metadata.getRemoteSegments(self.pathInfo['pathId'])
+        if len(segments) == 0:
+            return True
+        begin = segments[0][0] - segments[0][0] % self.controllers[0].chunkSize
+        end = segments[-1][1]
+
+        # Divide the range in stripes of whole pieces
+        stripeSize = -(-(end - begin + 1) // len(self.controllers))
+        stripeSize = -(-stripeSize // self.pieceSize) * self.pieceSize
+        self.stripes = [Stripe(position, min(end, position + stripeSize - 1))
+                        for position in range(begin, end + 1, stripeSize)]
+        statistics.increment('download.stripedFiles')
+
+        threads = [Thread(target=self._runWorker, args=(controller, stripe), name='mountload-stripe', daemon=True)
+                   for controller, stripe in zip(self.controllers, self.stripes)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self.error is not None:
+            raise self.error
+        return not self.isAborted
+
+    def _runWorker(self, controller, stripe):
+        try:
+            while stripe is not None:
+                piece = self._nextPiece(stripe)
+                while piece is not None:
+                    controller.downloadRange(self.pathInfo, piece[0], piece[1], self._chunkReceived)
+                    piece = self._nextPiece(stripe)
+                stripe = self._steal()
+        except Exception as e:
+            with self.lock:
+                self.isAborted = True
+                if self.error is None:
+                    self.error = e
+
+    def _steal(self):
+        """Splits off the second half of the stripe with the most data left as a new stripe, or returns None"""
+        with self.lock:
+            if self.isAborted:
+                return None
+            victim = max(self.stripes, key=Stripe.getRemainingSize)
+
+            # The victim is busy with its current piece, so a single remaining piece is taken over entirely
+            remainingPieces = -(-victim.getRemainingSize() // self.pieceSize)
+            if remainingPieces == 0:
+                return None
+            stolen = Stripe(victim.position + remainingPieces // 2 * self.pieceSize, victim.end)
+            victim.end = stolen.position - 1
+            self.stripes.append(stolen)
+        statistics.increment('download.steals')
+        return stolen
@@ -0,0 +1,136 @@
+# Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
+# See the file LICENSE.txt for copying permission.
+
+import logging
+from mountload.crawler import MetaDataCrawler
+from mountload.downloader import BackgroundDownloader
+import os
+from threading import Event, Thread
+import time
+
+class Synchronizer:
+    """
+    Downloads the remote tree, or only the given paths in it, to the target
+    without mounting anything. Directories are crawled while files are being
+    downloaded, and throughput and ETA are logged periodically. Since all state
+    lives in the metadata database, an interrupted sync resumes where it left
+    off.
+    """
+
+    def __init__(self, controllerPool, paths=None, numberOfCrawlThreads=16, numberOfDownloadThreads=8,
+                 bandwidthLimit=None, numberOfStripes=1, stripeThreshold=None, reportInterval=10.0):
+        self.pool = controllerPool
+        self.numberOfCrawlThreads = numberOfCrawlThreads
+        self.reportInterval = reportInterval
+        self.log = logging.getLogger('mountload.sync')
+
+        # Remote paths to sync, or None for the entire tree
+        self.paths = None
+        if paths is not None:
+            self.paths = sorted(set(os.path.normpath('/' + path) for path in paths))
+            if '/' in self.paths:
+                self.paths = None
+
+        self.downloader = BackgroundDownloader(controllerPool, numberOfDownloadThreads, bandwidthLimit, numberOfStripes,
+                                               stripeThreshold, None if self.paths is None else self._isSelected)
+        self.stopEvent = Event()
+
+    @staticmethod
+    def _formatBytes(numberOfBytes):
+        for unit in ['B', 'KiB', 'MiB', 'GiB']:
+            if abs(numberOfBytes) < 1024:
+                return '%.1f %s' % (numberOfBytes, unit)
+            numberOfBytes /= 1024
+        return '%.1f TiB' % numberOfBytes
+
+    @staticmethod
+    def _formatDuration(seconds):
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+    def getProgress(self):
+        """Returns the progress counters of the paths being synced"""
+        if self.paths is None:
+            return self.pool.metadata.getProgress()
+
+        progress = {'totalBytes': 0, 'downloadedBytes': 0, 'filesPending': 0, 'directoriesUnlisted': 0}
+        for path in self.paths:
+            subtreeProgress = self.pool.metadata.getSubtreeProgress(path)
+            for name in progress:
+                progress[name] += subtreeProgress[name]
+        progress['isComplete'] = (progress['filesPending'] == 0) and (progress['directoriesUnlisted'] == 0)
+        return progress
+
+    def _isSelected(self, pathInfo):
+        return any((pathInfo['path'] == path) or pathInfo['path'].startswith(path + '/') for path in self.paths)
+
+    def _report(self, startTime, startBytes):
+        previousTime = startTime
+        previousBytes = startBytes
+        while not self.stopEvent.wait(self.reportInterval):
+            progress = self.getProgress()
+            now = time.monotonic()
+            rate = (progress['downloadedBytes'] - previousBytes) / (now - previousTime)
+            averageRate = (progress['downloadedBytes'] - startBytes) / (now - startTime)
+            previousTime = now
+            previousBytes = progress['downloadedBytes']
+
+            # The total is not known until all directories have been listed
+            remainingBytes = progress['totalBytes'] - progress['downloadedBytes']
+            if progress['directoriesUnlisted'] > 0:
+                eta = 'unknown, %d directories left to list' % progress['directoriesUnlisted']
+            elif averageRate <= 0:
+                eta = 'unknown'
+            else:
+                eta = Synchronizer._formatDuration(remainingBytes / averageRate)
+
+            self.log.info('%s of %s, %d files left; %s/s; ETA %s', Synchronizer._formatBytes(progress['downloadedBytes']),
+                          Synchronizer._formatBytes(progress['totalBytes']), progress['filesPending'],
+                          Synchronizer._formatBytes(rate), eta)
+
+    def run(self):
+        """
+        Syncs until all selected paths have been downloaded, given up on or the
+        sync is interrupted; returns whether everything was synced
+        """
+        directories = None
+        with self.pool.acquire() as controller:
+            if self.paths is not None:
+                for path in self.paths:
+                    if controller.getStatForPath(path) is None:
+                        raise RuntimeError('Remote path %s does not exist' % path)
+                directories = [pathInfo for pathInfo in controller.getUnsyncedDirectories() if self._isSelected(pathInfo)]
+        crawler = MetaDataCrawler(self.pool, self.numberOfCrawlThreads, directories)
+
+        startTime = time.monotonic()
+        startBytes = self.getProgress()['downloadedBytes']
+        reporter = Thread(target=self._report, args=(startTime, startBytes), name='mountload-sync-report', daemon=True)
+        reporter.start()
+        try:
+            crawler.start()
+            self.downloader.start()
+            crawler.wait()
+
+            # The downloader may have run out of work while the crawler was still discovering paths
+            self.downloader.resume()
+            self.downloader.wait()
+        finally:
+            self.stopEvent.set()
+            reporter.join()
+            crawler.stop()
+            self.downloader.stop()
+
+        # Make sure the final state is on disk before reporting it
+        self.pool.metadata.flushRemoteSegments()
+        progress = self.getProgress()
+        duration = time.monotonic() - startTime
+        downloadedBytes = progress['downloadedBytes'] - startBytes
+        self.log.info('Downloaded %s in %s (%s/s); %d files left', Synchronizer._formatBytes(downloadedBytes),
+                      Synchronizer._formatDuration(duration), Synchronizer._formatBytes(downloadedBytes / max(duration, 0.001)),
+                      progress['filesPending'])
+
+        failedPaths = self.downloader.getFailedPaths()
+        if len(failedPaths) > 0:
+            self.log.error('Failed to sync %d paths:\n%s', len(failedPaths), '\n'.join(failedPaths))
+        return progress['isComplete'] and (len(failedPaths) == 0)
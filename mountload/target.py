@@ -1,20 +1,44 @@
 # Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
 # See the file LICENSE.txt for copying permission.
 
+from collections import Counter
+from errno import EINVAL, EOPNOTSUPP
+from mountload.handles import HandleCache
 import os
 from os.path import abspath, isdir
+from threading import Lock
 
 class MountLoadTarget:
-    def __init__(self, targetDirectory):
+    """
+    Local copy of the remote directory; file descriptors are cached so they can
+    be shared between threads. Written files are tracked until syncFiles() makes
+    their data durable.
+    """
+    fileCacheCapacity = 256
+    fileCacheIdleTimeout = 30
+
+    def __init__(self, targetDirectory, preallocate=False):
         self.databaseFilename = 'metadata.sqlite'
+        self.preallocate = preallocate
         self.targetDirectory = abspath(targetDirectory)
         self.metaDirectory = self.targetDirectory + '/.mountload'
         self.redirectionDirectory = self.metaDirectory + '/redirect'
 
         self._ensureDirectoriesExist([self.targetDirectory, self.metaDirectory, self.redirectionDirectory])
 
+        # Number of FUSE file handles per path; file descriptors of pinned files are not closed for being idle
+        self.pinnedFilesLock = Lock()
+        self.pinnedFiles = Counter()
+        self.files = HandleCache(lambda path: os.open(self._normalizePath(path), os.O_RDWR), os.close,
+                                 MountLoadTarget.fileCacheCapacity, MountLoadTarget.fileCacheIdleTimeout,
+                                 lambda path: self.pinnedFiles[path] > 0)
+
+        # Paths written to since the last syncFiles()
+        self.dirtyFilesLock = Lock()
+        self.dirtyFiles = set()
+
     def close(self):
-        pass
+        self.files.close()
 
     def createDirectory(self, relativePath, mode):
         dirpath = self._normalizePath(relativePath)
@@ -23,11 +47,35 @@ class MountLoadTarget:
         else:
             os.mkdir(dirpath, mode)
 
-    def createFile(self, relativePath, mode):
+    def createFile(self, relativePath, mode, size=0):
+        """Creates an empty file, or truncates an existing one, and preallocates size bytes (see preallocateFile())"""
         path = self._normalizePath(relativePath)
-        f = open(path, 'w')
-        f.close()
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600))
         os.chmod(path, mode)
+        self.preallocateFile(relativePath, size)
+
+    def preallocateFile(self, relativePath, size):
+        """
+        With preallocation, allocates disk space for size bytes of a file up
+        front, so files that are filled in out of order do not get fragmented;
+        if the filesystem does not support that, the file is extended sparsely
+        instead. Data already written is kept. Does nothing otherwise.
+        """
+        if not self.preallocate or (size == 0):
+            return
+        fd = os.open(self._normalizePath(relativePath), os.O_WRONLY)
+        try:
+            try:
+                if not hasattr(os, 'posix_fallocate'):
+                    raise OSError(EOPNOTSUPP, 'posix_fallocate() is not available')
+                os.posix_fallocate(fd, 0, size)
+            except OSError as e:
+                if e.errno not in (EINVAL, EOPNOTSUPP):
+                    raise
+                if os.fstat(fd).st_size < size:
+                    os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
 
     def createSymlink(self, relativePath, target):
         os.symlink(target, self._normalizePath(relativePath))
@@ -54,15 +102,69 @@ class MountLoadTarget:
             absolutePath = self.redirectionDirectory + relativePath
         return absolutePath
 
+    def openLocalFile(self, relativePath):
+        """Returns a new read-only file descriptor for a file; the caller is responsible for closing it"""
+        return os.open(self._normalizePath(relativePath), os.O_RDONLY)
+
+    def pinFile(self, relativePath):
+        """Keeps the file descriptor of a file open until unpinFile() is called"""
+        with self.pinnedFilesLock:
+            self.pinnedFiles[relativePath] += 1
+
     def readData(self, relativePath, offset, size):
-        f = open(self._normalizePath(relativePath), 'rb')
-        f.seek(offset, os.SEEK_SET)
-        data = f.read(size)
-        f.close()
-        return data
+        with self.files.acquire(relativePath) as fd:
+            return os.pread(fd, size, offset)
+
+    def readInto(self, relativePath, offset, view):
+        """Reads exactly len(view) bytes into a writable memoryview"""
+        with self.files.acquire(relativePath) as fd:
+            while len(view) > 0:
+                if hasattr(os, 'preadv'):
+                    numberOfBytes = os.preadv(fd, [view], offset)
+                else:
+                    data = os.pread(fd, len(view), offset)
+                    numberOfBytes = len(data)
+                    view[:numberOfBytes] = data
+                if numberOfBytes == 0:
+                    raise IOError('Unexpected end of file %s at offset %d' % (relativePath, offset))
+                view = view[numberOfBytes:]
+                offset += numberOfBytes
+
+    def syncFiles(self):
+        """Flushes the data of all files written since the last call to disk"""
+        with self.dirtyFilesLock:
+            paths = self.dirtyFiles
+            self.dirtyFiles = set()
+
+        # Syncing any descriptor of a file flushes all of its data, even if it was written through another one
+        remainingPaths = set(paths)
+        try:
+            for path in paths:
+                with self.files.acquire(path) as fd:
+                    if hasattr(os, 'fdatasync'):
+                        os.fdatasync(fd)
+                    else:
+                        os.fsync(fd)
+                remainingPaths.discard(path)
+        finally:
+            if len(remainingPaths) > 0:
+                with self.dirtyFilesLock:
+                    self.dirtyFiles.update(remainingPaths)
+
+    def unpinFile(self, relativePath):
+        with self.pinnedFilesLock:
+            self.pinnedFiles[relativePath] -= 1
+            if self.pinnedFiles[relativePath] > 0:
+                return
+            del self.pinnedFiles[relativePath]
+        self.files.discard(relativePath)
 
     def writeData(self, relativePath, offset, data):
-        f = open(self._normalizePath(relativePath), 'r+b')
-        f.seek(offset, os.SEEK_SET)
-        f.write(data)
-        f.close()
+        with self.files.acquire(relativePath) as fd:
+            view = memoryview(data)
+            while len(view) > 0:
+                written = os.pwrite(fd, view, offset)
+                view = view[written:]
+                offset += written
+        with self.dirtyFilesLock:
+            self.dirtyFiles.add(relativePath)
@@ -0,0 +1,56 @@
+# Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
+# See the file LICENSE.txt for copying permission.
+
+from mountload.source import MountLoadSource
+import os
+from paramiko import SFTPAttributes
+
+class LocalSource:
+    """Source with the same interface as MountLoadSource that serves the directory of the source URI from local disk"""
+
+    def __init__(self, sourceURI, password, readWindow=None, maximumConnections=None, channelsPerConnection=None):
+        self.remoteDirectory = MountLoadSource.parseSourceURI(sourceURI)[3]
+
+    def close(self):
+        pass
+
+    def discardFile(self, path):
+        pass
+
+    def getDirectoryEntries(self, path):
+        directory = self.remoteDirectory + path
+        return [SFTPAttributes.from_stat(os.lstat(os.path.join(directory, name)), name) for name in os.listdir(directory)]
+
+    def getEntry(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(self.remoteDirectory + path))
+        except FileNotFoundError:
+            return None
+
+    def getLinkTarget(self, path):
+        return os.readlink(self.remoteDirectory + path)
+
+    def getMaximumConcurrency(self):
+        return 4
+
+    def getRemoteDirectory(self):
+        return self.remoteDirectory
+
+    def pinFile(self, path):
+        pass
+
+    def readData(self, path, offset, size):
+        return b''.join(self.readStream(path, offset, size))
+
+    def readStream(self, path, offset, size):
+        with open(self.remoteDirectory + path, 'rb') as f:
+            f.seek(offset)
+            while size > 0:
+                data = f.read(min(MountLoadSource.streamChunkSize, size))
+                if len(data) == 0:
+                    raise IOError('Short read at offset %d of %s' % (f.tell(), path))
+                size -= len(data)
+                yield data
+
+    def unpinFile(self, path):
+        pass
@@ -0,0 +1,26 @@
+# Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
+# See the file LICENSE.txt for copying permission.
+
+from mountload.downloader import RateLimiter
+import time
+import unittest
+
+class RateLimiterTest(unittest.TestCase):
+    def testConsumeWithinBudget(self):
+        rateLimiter = RateLimiter(1024 * 1024)
+        startTime = time.monotonic()
+        self.assertTrue(rateLimiter.consume(1024))
+        self.assertLess(time.monotonic() - startTime, 0.05)
+
+    def testInterruptedWait(self):
+        # Paying off this debt takes 100 seconds, unless the wait is interrupted
+        rateLimiter = RateLimiter(1024)
+        interruptTime = time.monotonic() + 0.1
+        self.assertFalse(rateLimiter.consume(101 * 1024, lambda: time.monotonic() >= interruptTime))
+        self.assertLess(time.monotonic() - interruptTime, 0.5)
+
+        # The debt is kept, so the interrupted transfer still counts against the limit
+        self.assertFalse(rateLimiter.consume(1, lambda: True))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+# Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
+# See the file LICENSE.txt for copying permission.
+
+from mountload.metadata import MountLoadMetaData
+import os
+import sqlite3
+import stat
+import tempfile
+import unittest
+
+class UpgradeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.dbpath = os.path.join(self.directory.name, 'metadata.sqlite')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _createVersion1DB(self):
+        """Creates a database with the original (dirname, basename) path table and no progress counters"""
+        conn = sqlite3.connect(self.dbpath)
+        conn.execute('CREATE TABLE config (name TEXT PRIMARY KEY, value TEXT)')
+        conn.execute('CREATE TABLE path (pathId INTEGER PRIMARY KEY, dirname TEXT, basename TEXT, type TEXT, size INTEGER, mode INTEGER, atime INTEGER, mtime INTEGER, isSynced INTEGER, UNIQUE (dirname, basename))')
+        conn.execute('CREATE TABLE remoteSegment (remoteSegmentId INTEGER PRIMARY KEY, path INTEGER, begin INTEGER, end INTEGER, FOREIGN KEY (path) REFERENCES path (pathId))')
+        conn.execute('CREATE INDEX remoteSegment_path_idx ON remoteSegment (path)')
+        conn.execute('INSERT INTO config (name, value) VALUES (\'version\', 1)')
+        conn.executemany('INSERT INTO path (pathId, dirname, basename, type, size, mode, atime, mtime, isSynced) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', [
+            (1, '/', '', 'directory', 0, stat.S_IFDIR | 0o755, 0, 0, 1),
+            (2, '/', 'a', 'directory', 0, stat.S_IFDIR | 0o755, 0, 0, 1),
+            (3, '/', 'partial.bin', 'file', 1000, stat.S_IFREG | 0o644, 0, 0, 0),
+            (4, '/a/', 'synced.bin', 'file', 50, stat.S_IFREG | 0o644, 0, 0, 1),
+            (5, '/a/', 'b', 'directory', 0, stat.S_IFDIR | 0o755, 0, 0, 0)])
+        conn.executemany('INSERT INTO remoteSegment (path, begin, end) VALUES (?, ?, ?)', [(3, 0, 99), (3, 500, 999)])
+        conn.commit()
+        conn.close()
+
+    def testUpgradeFromVersion1(self):
+        self._createVersion1DB()
+        metadata = MountLoadMetaData(self.dbpath)
+        try:
+            self.assertEqual(metadata.getConfigInteger('version'), MountLoadMetaData.metaDataVersion)
+
+            # Paths keep their IDs and can be resolved by path
+            self.assertEqual(metadata.getPath('/partial.bin')['pathId'], 3)
+            self.assertEqual(metadata.getPath('/a/synced.bin')['pathId'], 4)
+            self.assertEqual(sorted(pathInfo['name'] for pathInfo in metadata.getSubPaths('/a')), ['b', 'synced.bin'])
+
+            # Remote segments and progress counters are preserved
+            self.assertEqual(metadata.getRemoteSegments(3), [(0, 99), (500, 999)])
+            progress = metadata.getProgress()
+            self.assertEqual(progress['totalBytes'], 1050)
+            self.assertEqual(progress['downloadedBytes'], 450)
+            self.assertEqual(progress['filesPending'], 1)
+            self.assertEqual(progress['directoriesUnlisted'], 1)
+        finally:
+            metadata.close()
+
+        # The counters are stored, not recomputed on every start
+        metadata = MountLoadMetaData(self.dbpath)
+        try:
+            self.assertEqual(metadata.getProgress()['downloadedBytes'], 450)
+        finally:
+            metadata.close()
+
+if __name__ == '__main__':
+    unittest.main()
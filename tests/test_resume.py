@@ -0,0 +1,58 @@
+# Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
+# See the file LICENSE.txt for copying permission.
+
+from mountload.controller import ControllerPool
+import os
+import tempfile
+from tests.localsource import LocalSource
+import unittest
+
+class ResumeTest(unittest.TestCase):
+    fileSize = 5 * 1024 * 1024 + 123
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.sourceDirectory = os.path.join(self.directory.name, 'source')
+        self.targetDirectory = os.path.join(self.directory.name, 'target')
+        os.mkdir(self.sourceDirectory)
+        self.data = os.urandom(ResumeTest.fileSize)
+        with open(os.path.join(self.sourceDirectory, 'file.bin'), 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _createPool(self):
+        return ControllerPool('sftp://localhost' + self.sourceDirectory, self.targetDirectory, None, sourceClass=LocalSource)
+
+    def testResumeFragmentedDownload(self):
+        # Download two ranges in the middle of the file, leaving three remote segments
+        pool = self._createPool()
+        with pool.acquire() as controller:
+            pathInfo = controller.getEntriesInDirectory('/')[0]
+            controller.downloadRange(pathInfo, 1024 * 1024, 2 * 1024 * 1024 - 1)
+            controller.downloadRange(pathInfo, 3 * 1024 * 1024, 4 * 1024 * 1024 - 1)
+        pool.close()
+
+        # Resume with fresh metadata, which loads the segments from the database
+        pool = self._createPool()
+        try:
+            self.assertEqual(pool.metadata.getProgress()['downloadedBytes'], 2 * 1024 * 1024)
+            with pool.acquire() as controller:
+                pathInfo = controller.getEntriesInDirectory('/')[0]
+                self.assertEqual(len(pool.metadata.getRemoteSegments(pathInfo['pathId'])), 3)
+                while controller.downloadNextSegment(pathInfo, 1024 * 1024) > 0:
+                    pass
+            pool.metadata.flushRemoteSegments()
+
+            progress = pool.metadata.getProgress()
+            self.assertTrue(progress['isComplete'])
+            self.assertEqual(progress['downloadedBytes'], ResumeTest.fileSize)
+            self.assertTrue(pool.metadata.getPath('/file.bin')['isSynced'])
+        finally:
+            pool.close()
+        with open(os.path.join(self.targetDirectory, 'file.bin'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
+# See the file LICENSE.txt for copying permission.
+
+from mountload.metadata import MountLoadMetaData
+from mountload.segments import RemoteSegmentSet
+import os
+import stat
+import tempfile
+import unittest
+
+class RemoteSegmentSetTest(unittest.TestCase):
+    def testConstructionSortsSegments(self):
+        segments = RemoteSegmentSet([(200, 299), (0, 99)])
+        self.assertEqual(segments.getSegments(), [(0, 99), (200, 299)])
+        self.assertEqual(segments.getSize(), 200)
+
+    def testRemoveSplitsSegment(self):
+        segments = RemoteSegmentSet([(0, 999)])
+        self.assertEqual(segments.remove(100, 199), 100)
+        self.assertEqual(segments.getSegments(), [(0, 99), (200, 999)])
+        self.assertEqual(segments.getSize(), 900)
+
+    def testRemoveShortensSegments(self):
+        segments = RemoteSegmentSet([(0, 99), (200, 299)])
+        self.assertEqual(segments.remove(50, 249), 100)
+        self.assertEqual(segments.getSegments(), [(0, 49), (250, 299)])
+
+    def testRemoveAcrossSegmentsMergesTheRemainder(self):
+        segments = RemoteSegmentSet([(0, 99), (200, 299), (400, 499), (600, 699)])
+        self.assertEqual(segments.remove(50, 649), 300)
+        self.assertEqual(segments.getSegments(), [(0, 49), (650, 699)])
+
+    def testRemoveOutsideSegments(self):
+        segments = RemoteSegmentSet([(100, 199)])
+        self.assertEqual(segments.remove(0, 99), 0)
+        self.assertEqual(segments.remove(200, 299), 0)
+        self.assertEqual(segments.getSegments(), [(100, 199)])
+
+    def testRemoveEverything(self):
+        segments = RemoteSegmentSet([(0, 99), (200, 299)])
+        self.assertEqual(segments.remove(0, 299), 200)
+        self.assertTrue(segments.isEmpty())
+
+    def testGetRange(self):
+        segments = RemoteSegmentSet([(0, 99), (200, 299), (400, 499)])
+        self.assertEqual(segments.getRange(100, 199), [])
+        self.assertEqual(segments.getRange(99, 200), [(0, 99), (200, 299)])
+        self.assertEqual(segments.getRange(450, 1000), [(400, 499)])
+
+class RemoteSegmentReloadTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.dbpath = os.path.join(self.directory.name, 'metadata.sqlite')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def testSplitSegmentsSurviveReopening(self):
+        metadata = MountLoadMetaData(self.dbpath)
+        metadata.addPaths(None, [('', 'directory', 0, stat.S_IFDIR | 0o755, 0, 0, True)])
+        metadata.addPaths('/', [('file', 'file', 1000, stat.S_IFREG | 0o644, 0, 0, False)])
+        pathId = metadata.getPath('/file')['pathId']
+        metadata.removeRemoteSegments(pathId, 100, 199)
+        metadata.removeRemoteSegments(pathId, 500, 599)
+        metadata.close()
+
+        metadata = MountLoadMetaData(self.dbpath)
+        try:
+            self.assertEqual(metadata.getRemoteSegments(pathId), [(0, 99), (200, 499), (600, 999)])
+            self.assertEqual(metadata.getProgress()['downloadedBytes'], 200)
+            self.assertFalse(metadata.isFullyDownloaded(pathId))
+        finally:
+            metadata.close()
+
+    def testSegmentsReloadAfterEviction(self):
+        metadata = MountLoadMetaData(self.dbpath)
+        try:
+            metadata.addPaths(None, [('', 'directory', 0, stat.S_IFDIR | 0o755, 0, 0, True)])
+            metadata.addPaths('/', [('file', 'file', 1000, stat.S_IFREG | 0o644, 0, 0, False)])
+            pathId = metadata.getPath('/file')['pathId']
+            metadata.removeRemoteSegments(pathId, 100, 199)
+            metadata.flushRemoteSegments()
+            metadata.segmentCache.invalidate(pathId)
+            self.assertEqual(metadata.getRemoteSegmentsRange(pathId, 0, 999), [(0, 99), (200, 999)])
+        finally:
+            metadata.close()
+
+if __name__ == '__main__':
+    unittest.main()
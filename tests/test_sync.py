@@ -0,0 +1,51 @@
+# Copyright (c) 2014 Jelle Raaijmakers <jelle@gmta.nl>
+# See the file LICENSE.txt for copying permission.
+
+from mountload.controller import ControllerPool
+from mountload.downloader import BackgroundDownloader
+from mountload.sync import Synchronizer
+import os
+import tempfile
+from tests.localsource import LocalSource
+import unittest
+
+class SynchronizerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.sourceDirectory = os.path.join(self.directory.name, 'source')
+        self.targetDirectory = os.path.join(self.directory.name, 'target')
+        os.makedirs(os.path.join(self.sourceDirectory, 'good'))
+        os.makedirs(os.path.join(self.sourceDirectory, 'bad'))
+        with open(os.path.join(self.sourceDirectory, 'good', 'file.bin'), 'wb') as f:
+            f.write(os.urandom(300000))
+
+        # Don't wait between the attempts at the failing directory
+        self.retryInterval = BackgroundDownloader.retryInterval
+        BackgroundDownloader.retryInterval = 0
+
+    def tearDown(self):
+        BackgroundDownloader.retryInterval = self.retryInterval
+        self.directory.cleanup()
+
+    def _sync(self):
+        pool = ControllerPool('sftp://localhost' + self.sourceDirectory, self.targetDirectory, None, sourceClass=LocalSource)
+        try:
+            synchronizer = Synchronizer(pool, numberOfCrawlThreads=2, numberOfDownloadThreads=2, reportInterval=60)
+            return (synchronizer.run(), synchronizer.downloader.getFailedPaths())
+        finally:
+            pool.close()
+
+    def testSync(self):
+        self.assertEqual(self._sync(), (True, []))
+        with open(os.path.join(self.targetDirectory, 'good', 'file.bin'), 'rb') as f, \
+                open(os.path.join(self.sourceDirectory, 'good', 'file.bin'), 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+
+    def testFailingPathIsGivenUpOn(self):
+        # Listing a directory with a FIFO in it fails every time
+        os.mkfifo(os.path.join(self.sourceDirectory, 'bad', 'fifo'))
+        self.assertEqual(self._sync(), (False, ['/bad']))
+        self.assertTrue(os.path.exists(os.path.join(self.targetDirectory, 'good', 'file.bin')))
+
+if __name__ == '__main__':
+    unittest.main()